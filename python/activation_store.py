@@ -0,0 +1,97 @@
+import os
+import numpy as np
+from utils import safe_mkdir
+
+# An activation store is a directory holding <blob>.npy, an N x D array of the
+# flattened activations of each blob for N images, and labels.npy.  Arrays are
+# preallocated as memory mapped files and filled a batch at a time, so the
+# activations of the whole dataset never need to fit in RAM, and are read back
+# with np.load(mmap_mode='r') without parsing or copying
+LABELS = "labels"
+DTYPES = ['float32', 'float16']
+
+
+def get_store_file(store_dir, name):
+	return os.path.join(store_dir, name + ".npy")
+
+
+class ActivationWriter(object):
+
+	# num_images is the capacity of every array.  Rows beyond it are dropped
+	def __init__(self, store_dir, num_images, dtype=np.float32):
+		self.store_dir = store_dir
+		self.num_images = num_images
+		self.dtype = np.dtype(dtype)
+		self.arrays = dict()
+		self.counts = dict()
+		safe_mkdir(store_dir)
+
+	# written to a tmp file and renamed in close(), so that a store being rewritten
+	# stays readable, including through earlier memory maps of it
+	def alloc(self, name, shape, dtype):
+		tmp_file = get_store_file(self.store_dir, name) + ".tmp"
+		self.arrays[name] = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+			shape=(self.num_images,) + shape)
+		self.counts[name] = 0
+
+	def append(self, name, rows, dtype):
+		if name not in self.arrays:
+			self.alloc(name, rows.shape[1:], dtype)
+		count = self.counts[name]
+		num = min(rows.shape[0], self.num_images - count)
+		self.arrays[name][count:count+num] = rows[:num]
+		self.counts[name] = count + num
+
+	# activations of a batch are flattened to batch_size x D
+	def write(self, blob, activations):
+		activations = np.asarray(activations)
+		self.append(blob, activations.reshape((activations.shape[0], -1)), self.dtype)
+
+	def write_labels(self, labels):
+		self.append(LABELS, np.asarray(labels, dtype=np.int64), np.int64)
+
+	# arrays that were not filled are truncated to the number of rows written
+	def close(self):
+		for name, arr in self.arrays.items():
+			count = self.counts[name]
+			tmp_file = arr.filename
+			if count < self.num_images:
+				out = np.lib.format.open_memmap(tmp_file + ".trunc", mode='w+', dtype=arr.dtype,
+					shape=(count,) + arr.shape[1:])
+				out[:] = arr[:count]
+				del out
+				os.rename(tmp_file + ".trunc", tmp_file)
+			else:
+				arr.flush()
+			os.rename(tmp_file, get_store_file(self.store_dir, name))
+		self.arrays = dict()
+
+
+# N x D activations of blob.  Falls back to the <blob>.txt dumps of older versions.
+# If dtype is given and differs from the stored one, the activations are converted
+def load_activations(store_dir, blob, dtype=None, mmap_mode='r'):
+	store_file = get_store_file(store_dir, blob)
+	if os.path.exists(store_file):
+		activations = np.load(store_file, mmap_mode=mmap_mode)
+	else:
+		activations = np.loadtxt(os.path.join(store_dir, blob + ".txt"), ndmin=2)
+	if dtype is not None:
+		activations = np.asarray(activations, dtype=dtype)
+	return activations
+
+
+# names of the blobs in a store, including <blob>.txt dumps of older versions
+def list_blobs(store_dir):
+	blobs = set()
+	for fname in os.listdir(store_dir):
+		name, ext = os.path.splitext(fname)
+		if ext in ['.npy', '.txt'] and name != LABELS:
+			blobs.add(name)
+	return sorted(blobs)
+
+
+def load_labels(store_dir):
+	store_file = get_store_file(store_dir, LABELS)
+	if os.path.exists(store_file):
+		return np.load(store_file, mmap_mode='r')
+	return np.loadtxt(os.path.join(store_dir, LABELS + ".txt"), dtype=np.int64, ndmin=1)
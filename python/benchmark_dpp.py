@@ -0,0 +1,115 @@
+import time
+import argparse
+import numpy as np
+from sklearn.metrics.pairwise import pairwise_kernels
+import dpp_tools
+
+try:
+	import dpp
+except ImportError:
+	dpp = None
+
+
+# synthetic activations of num_neurons correlated neurons over num_images images:
+# rectified mixtures of rank latent factors plus noise.  Scaled so that the rbf
+# kernel with gamma = 10 / num_images is not ~0 away from the diagonal
+def make_activations(num_images, num_neurons, rank, rng):
+	latent = rng.randn(num_images, rank)
+	mixing = rng.randn(rank, num_neurons) / np.sqrt(rank)
+	activations = np.dot(latent, mixing) + 0.5 * rng.randn(num_images, num_neurons)
+	return 0.2 * np.maximum(activations, 0).astype(np.float32)
+
+
+def timed(fn, *args):
+	start = time.time()
+	val = fn(*args)
+	return val, time.time() - start
+
+
+def log_det(L, indices):
+	if len(indices) == 0:
+		return 0.
+	return np.linalg.slogdet(L[np.ix_(indices, indices)])[1]
+
+
+def report(name, elapsed, indices=None, L=None, error=None):
+	line = "%-28s %9.3f" % (name, elapsed)
+	line += " %10s" % ("%.2e" % error if error is not None else "")
+	if indices is not None:
+		line += " %6d" % len(indices)
+		if L is not None:
+			line += " %12.2f" % log_det(L, indices)
+	print line
+
+
+def check(activations, args):
+	gamma = 10. / activations.shape[0]
+	kwargs = dict(gamma=gamma) if args.kernel in ['rbf', 'poly', 'polynomial', 'laplacian'] else {}
+	exact, exact_elapsed = timed(lambda: pairwise_kernels(activations.T.astype(np.float64),
+		metric=args.kernel, n_jobs=1, **kwargs))
+	report("exact gram", exact_elapsed)
+
+	if args.kernel in dpp_tools.KERNELS_FROM_GRAM:
+		streamed, elapsed = timed(lambda: dpp_tools.kernel_from_gram(dpp_tools.accumulate_gram(activations,
+			args.batch_size), args.kernel, gamma))
+		error = np.abs(streamed - exact).max() / np.abs(exact).max()
+		if error > 1e-8:
+			raise Exception("Streamed gram mismatch: %r" % error)
+		report("streamed gram", elapsed, error=error)
+
+	if dpp is not None:
+		indices, elapsed = timed(dpp.sample_dpp, exact, args.num_neurons)
+		report("dpp.sample_dpp", elapsed, indices, exact)
+	indices, elapsed = timed(dpp_tools.greedy_map_dpp_kernel, exact, args.num_neurons)
+	report("greedy map (exact)", elapsed, indices, exact)
+	if args.num_neurons:
+		eig_vals, eig_vecs = np.linalg.eigh(exact)
+		features = eig_vecs * np.sqrt(np.maximum(eig_vals, 0))
+		indices, elapsed = timed(dpp_tools.sample_low_rank_dpp, features, args.num_neurons, np.random.RandomState(args.seed))
+		report("k-dpp (exact)", elapsed, indices, exact)
+
+	for approx in ['rff', 'nystrom']:
+		if approx == 'rff' and args.kernel != 'rbf':
+			continue
+		features, elapsed = timed(dpp_tools.approx_kernel_features, activations, args.kernel, gamma, approx,
+			args.num_features, args.seed, args.batch_size)
+		error = np.linalg.norm(np.dot(features, features.T) - exact) / np.linalg.norm(exact)
+		report("%s features (D=%d)" % (approx, features.shape[1]), elapsed, error=error)
+		indices, elapsed = timed(dpp_tools.greedy_map_dpp_features, features, args.num_neurons)
+		report("greedy map (%s)" % approx, elapsed, indices, exact)
+		indices, elapsed = timed(dpp_tools.sample_low_rank_dpp, features, args.num_neurons, np.random.RandomState(args.seed))
+		report("low rank dpp (%s)" % approx, elapsed, indices, exact)
+
+
+def main(args):
+	rng = np.random.RandomState(args.seed)
+	for size in args.sizes.split(','):
+		num_images, num_neurons = map(int, size.split('x'))
+		print "\n%d images x %d neurons, %s kernel" % (num_images, num_neurons, args.kernel)
+		print "%-28s %9s %10s %6s %12s" % ("method", "sec", "rel err", "kept", "log det")
+		check(make_activations(num_images, num_neurons, args.rank, rng), args)
+
+
+def get_args():
+	parser = argparse.ArgumentParser(description="Times the exact gram matrix and DPP sampling used by divnet2.py "
+		"against the streamed gram, low rank kernel approximations and greedy MAP sampling")
+	parser.add_argument("--sizes", type=str, default="5000x512,20000x2048",
+				help="Comma separated NxD of synthetic activations of D neurons over N images")
+	parser.add_argument("--kernel", type=str, default="rbf",
+				help="Kernel of the neuron activations")
+	parser.add_argument("-k", "--num-neurons", type=int, default=64,
+				help="Number of neurons to keep.  0 for a variable sized sample")
+	parser.add_argument("--num-features", type=int, default=256,
+				help="Rank of the approximate kernels")
+	parser.add_argument("--rank", type=int, default=32,
+				help="Number of latent factors of the synthetic activations")
+	parser.add_argument("-b", "--batch-size", type=int, default=dpp_tools.GRAM_BATCH_SIZE,
+				help="Number of images in each accumulated batch")
+	parser.add_argument("--seed", type=int, default=1234,
+				help="Random seed")
+	return parser.parse_args()
+
+
+if __name__ == "__main__":
+	args = get_args()
+	main(args)
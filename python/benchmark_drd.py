@@ -0,0 +1,75 @@
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+from binary_eval import measure_drd, measure_drd_reference
+
+
+# synthetic page: gt with text-like blobs of foreground (0) on background (255),
+# and a prediction with a fraction noise of its pixels flipped
+def make_page(height, width, noise, rng):
+	gt = np.full((height, width), 255, dtype=np.int32)
+	num_blobs = height * width / 2000
+	ys = rng.randint(0, height, num_blobs)
+	xs = rng.randint(0, width, num_blobs)
+	for y, x in zip(ys, xs):
+		gt[y:y+rng.randint(2, 20), x:x+rng.randint(2, 40)] = 0
+	im = gt.copy()
+	flip = rng.rand(height, width) < noise
+	im[flip] = 255 - im[flip]
+	return im, gt
+
+
+def time_fn(fn, im, gt):
+	start = time.time()
+	val = fn(im, gt)
+	return val, time.time() - start
+
+
+def check(name, im, gt, args):
+	drd, elapsed = time_fn(measure_drd, im, gt)
+	line = "%-24s %10d %12.6f %10.3f" % (name, np.count_nonzero(im != gt), drd, elapsed)
+	if im.size <= args.reference_max_pixels:
+		ref_drd, ref_elapsed = time_fn(measure_drd_reference, im, gt)
+		if not np.isclose(drd, ref_drd, rtol=1e-10, atol=0):
+			raise Exception("DRD mismatch for %s: %r vs reference %r" % (name, drd, ref_drd))
+		line += " %10.3f %8.1fx" % (ref_elapsed, ref_elapsed / max(elapsed, 1e-6))
+	print line
+	sys.stdout.flush()
+
+
+def main(args):
+	rng = np.random.RandomState(args.seed)
+	print "%-24s %10s %12s %10s %10s %9s" % ("page", "mismatched", "drd", "sec", "ref sec", "speedup")
+	for size in args.sizes.split(','):
+		height, width = map(int, size.split('x'))
+		for noise in map(float, args.noise.split(',')):
+			im, gt = make_page(height, width, noise, rng)
+			check("%dx%d noise=%g" % (height, width, noise), im, gt, args)
+
+	for pair in args.images:
+		predict_fn, gt_fn = pair.split(':')
+		im = cv2.imread(predict_fn, -1).astype(np.int32)
+		gt = cv2.imread(gt_fn, -1).astype(np.int32)
+		check(predict_fn, im, gt, args)
+
+
+def get_args():
+	parser = argparse.ArgumentParser(description="Checks measure_drd against the per-pixel reference implementation and times both")
+	parser.add_argument("images", nargs='*',
+				help="Optional predict.png:gt.png pairs to check in addition to the synthetic pages")
+	parser.add_argument("--sizes", type=str, default="300x200,1000x800,4000x3000",
+				help="Comma separated HxW of synthetic pages")
+	parser.add_argument("--noise", type=str, default="0.01,0.1",
+				help="Comma separated fraction of flipped pixels in the synthetic predictions")
+	parser.add_argument("--reference-max-pixels", type=int, default=1000 * 1000,
+				help="Only run the (slow) reference on pages up to this many pixels")
+	parser.add_argument("--seed", type=int, default=1234,
+				help="Random seed for the synthetic pages")
+	return parser.parse_args()
+
+
+if __name__ == "__main__":
+	args = get_args()
+	main(args)
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import shutil
+import lmdb
+import create_doc_datum_db
+from image_encoders import BACKENDS
+
+
+def load_images(args):
+	lines = open(args.manifest, 'r').readlines()[:args.num_images]
+	ims = list()
+	for line in lines:
+		tokens = line.split()
+		ims.extend(create_doc_datum_db.process_im(os.path.join(args.imroot, tokens[0]), args))
+	return ims
+
+
+# returns images/sec for packaging ims into DocumentDatums, the total encoded bytes
+# and the size of the resulting lmdb
+def benchmark(ims, backend, encoding, args):
+	args.encoder = backend
+	args.encoding = encoding
+	start = time.time()
+	serialized = [create_doc_datum_db.package(im, 0, args).SerializeToString() for im in ims]
+	elapsed = time.time() - start
+
+	db_file = os.path.join(args.outdb, "%s_%s_lmdb" % (backend, encoding))
+	if os.path.exists(db_file):
+		shutil.rmtree(db_file)
+	env = lmdb.open(db_file, map_size=int(2 ** 40))
+	with env.begin(write=True) as txn:
+		for x, val in enumerate(serialized):
+			txn.put("%d" % x, val)
+	db_size = (env.info()['last_pgno'] + 1) * env.stat()['psize']
+	env.close()
+
+	return len(ims) / max(elapsed, 1e-6), sum(map(len, serialized)), db_size
+
+
+def main(args):
+	ims = load_images(args)
+	print "Loaded %d images" % len(ims)
+	try:
+		os.makedirs(args.outdb)
+	except OSError:
+		pass
+
+	print "%-12s %-10s %12s %12s %12s" % ("backend", "encoding", "images/sec", "encoded MB", "lmdb MB")
+	for encoding in args.encodings.split(','):
+		for backend in args.backends.split(','):
+			rate, encoded_bytes, db_size = benchmark(ims, backend, encoding, args)
+			print "%-12s %-10s %12.1f %12.2f %12.2f" % (backend, encoding, rate, encoded_bytes / 1e6, db_size / 1e6)
+			sys.stdout.flush()
+
+
+def get_args():
+	parser = create_doc_datum_db.get_parser("Compares encoder backends on a sample of a manifest.  " +
+		"outdb is a directory where one lmdb per backend and encoding is written")
+	parser.add_argument('--num-images', type=int, default=500,
+						help='Number of manifest lines to benchmark on')
+	parser.add_argument('--backends', type=str, default=",".join(BACKENDS),
+						help='Comma separated encoder backends to compare')
+	parser.add_argument('--encodings', type=str, default="png,jpeg",
+						help='Comma separated encodings to compare')
+	args = parser.parse_args()
+	return args
+
+
+if __name__ == "__main__":
+	args = get_args()
+	main(args)
@@ -38,23 +38,7 @@ def setup_network(network, weights):
 
 def fprop(network, ims, batchsize=BATCH_SIZE):
 	# batch up all transforms at once
-	idx = 0
-	responses = list()
-	while idx < len(ims):
-		sub_ims = ims[idx:idx+batchsize]
-		network.blobs["data"].reshape(len(sub_ims), 3, ims[0].shape[0], ims[0].shape[1]) 
-		for x, im in enumerate(sub_ims):
-			transposed = np.transpose(im, [2,0,1])
-			transposed = transposed[np.newaxis, :, :, :]
-			network.blobs["data"].data[x,:,:,:] = transposed
-		idx += batchsize
-
-		# propagate on batch
-		network.forward()
-		output = np.copy(network.blobs["prob"].data)
-		responses.append(output)
-		print "Progress %d%%" % int(100 * min(idx, len(ims)) / float(len(ims)))
-	return np.concatenate(responses, axis=0)
+	return network.forward_batched(ims, ["prob"], batchsize, "data")["prob"]
 
 
 def predict(network, ims):
@@ -11,15 +11,9 @@ import numpy as np
 import caffe
 import cv2
 import scipy.ndimage.morphology
+from tiling import TiledInference, prefetch
 
 
-
-LEFT_EDGE = -2
-TOP_EDGE = -1
-MIDDLE = 0
-RIGHT_EDGE = 1
-BOTTOM_EDGE = 2
-
 def safe_mkdir(_dir):
 	try:
 		os.makedirs(_dir)
@@ -38,104 +32,6 @@ def setup_network(args):
 	return network
 
 
-def fprop(network, ims, args):
-	idx = 0
-	responses = list()
-	while idx < len(ims):
-		sub_ims = ims[idx:idx+args.batch_size]
-		network.blobs["data"].reshape(len(sub_ims), ims[0].shape[2], ims[0].shape[0], ims[0].shape[1]) 
-		for x, im in enumerate(sub_ims):
-			transposed = np.transpose(im, [2,0,1])
-			transposed = transposed[np.newaxis, :, :, :]
-			network.blobs["data"].data[x,:,:,:] = transposed
-		idx += args.batch_size
-
-		# propagate on batch
-		network.forward()
-		output = np.copy(network.blobs[args.out_blob].data)
-		responses.append(output)
-		print "Progress %d%%" % int(100 * min(idx, len(ims)) / float(len(ims)))
-	return np.concatenate(responses, axis=0)
-
-
-def predict(network, ims, args):
-	all_outputs = np.squeeze(fprop(network, ims, args), axis=1)
-
-	high_indices = all_outputs >= args.threshold
-	predictions = np.zeros_like(all_outputs)
-	predictions[high_indices] = 1
-	return all_outputs, predictions
-
-
-def get_subwindows(im, pad_size, tile_size):
-	height, width = tile_size, tile_size
-	y_stride, x_stride = tile_size - (2 * pad_size), tile_size - (2 * pad_size)
-	if (height > im.shape[0]) or (width > im.shape[1]):
-		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, (height, width))
-		exit(1)
-	ims = list()
-	locations = list()
-	y = 0
-	y_done = False
-	while y  <= im.shape[0] and not y_done:
-		x = 0
-		if y + height > im.shape[0]:
-			y = im.shape[0] - height
-			y_done = True
-		x_done = False
-		while x <= im.shape[1] and not x_done:
-			if x + width > im.shape[1]:
-				x = im.shape[1] - width
-				x_done = True
-			locations.append( ((y, x, y + height, x + width), 
-					(y + pad_size, x + pad_size, y + y_stride, x + x_stride),
-					 TOP_EDGE if y == 0 else (BOTTOM_EDGE if y == (im.shape[0] - height) else MIDDLE),
-					  LEFT_EDGE if x == 0 else (RIGHT_EDGE if x == (im.shape[1] - width) else MIDDLE) 
-			) )
-			ims.append(im[y:y+height,x:x+width])
-			x += x_stride
-		y += y_stride
-
-	return locations, ims
-
-
-def stich_together(locations, subwindows, size, dtype, pad_size, tile_size):
-	output = np.zeros(size, dtype=dtype)
-	for location, subwindow in zip(locations, subwindows):
-		outer_bounding_box, inner_bounding_box, y_type, x_type = location
-		y_paste, x_paste, y_cut, x_cut, height_paste, width_paste = -1, -1, -1, -1, -1, -1
-
-		if y_type == TOP_EDGE:
-			y_cut = 0
-			y_paste = 0
-			height_paste = tile_size - pad_size
-		elif y_type == MIDDLE:
-			y_cut = pad_size
-			y_paste = inner_bounding_box[0]
-			height_paste = tile_size - 2 * pad_size
-		elif y_type == BOTTOM_EDGE:
-			y_cut = pad_size
-			y_paste = inner_bounding_box[0]
-			height_paste = tile_size - pad_size
-
-		if x_type == LEFT_EDGE:
-			x_cut = 0
-			x_paste = 0
-			width_paste = tile_size - pad_size
-		elif x_type == MIDDLE:
-			x_cut = pad_size
-			x_paste = inner_bounding_box[1]
-			width_paste = tile_size - 2 * pad_size
-		elif x_type == RIGHT_EDGE:
-			x_cut = pad_size
-			x_paste = inner_bounding_box[1]
-			width_paste = tile_size - pad_size
-
-		output[y_paste:y_paste+height_paste, x_paste:x_paste+width_paste] = subwindow[y_cut:y_cut+height_paste, x_cut:x_cut+width_paste]
-
-	return output
-
-
 def save_histo(data, fname, title, weights=None):
 	if weights is not None:
 		weights = weights.flatten()
@@ -194,9 +90,9 @@ def load_im(im_file, im_dirs, args):
 	return im
 
 
-def write_output(locations, raw_subwindows, binarized_subwindows, im_file, image, pad_size, im, args):
-	binary_result = stich_together(locations, binarized_subwindows, tuple(image.shape[0:2]), 
-		np.uint8, pad_size, args.tile_size)
+def write_output(raw_result, im_file, im, args):
+	binary_result = np.zeros(raw_result.shape, dtype=np.uint8)
+	binary_result[raw_result >= args.threshold] = 1
 	binary_result = 255 * (1 - binary_result)
 	binary_out_file = os.path.join(args.out_dir, 'basic', im_file)
 	cv2.imwrite(binary_out_file, binary_result)
@@ -210,8 +106,6 @@ def write_output(locations, raw_subwindows, binarized_subwindows, im_file, image
 		cv2.imwrite(binary_out_file, binary_result)
 
 		# raw probabilities
-		raw_result = stich_together(locations, raw_subwindows, tuple(image.shape[0:2]), 
-			np.float, pad_size, args.tile_size)
 		raw_out_file = out_prefix + "_raw.png"
 		cv2.imwrite(raw_out_file, 255 * (1 - raw_result))
 
@@ -242,19 +136,24 @@ def write_output(locations, raw_subwindows, binarized_subwindows, im_file, image
 def main(args):
 	network = setup_network(args)
 	im_files, im_dirs = get_ims_files(args)
-	pad_size = args.pad
 	safe_mkdir(os.path.join(args.out_dir, 'basic'))
-	for idx, im_file in enumerate(im_files):
-		image = load_im(im_file, im_dirs, args)
+	if args.memmap_dir:
+		safe_mkdir(args.memmap_dir)
+
+	# pages are read in the background while the network runs, and tiles from
+	# consecutive pages are batched together
+	engine = TiledInference(network, args.tile_size, args.pad, args.batch_size, args.out_blob,
+		memmap_dir=args.memmap_dir or None, stride=args.stride, blend=args.blend)
+	pages = prefetch(((im_file, load_im(im_file, im_dirs, args)) for im_file in im_files), args.prefetch)
+	for idx, (im_file, image, raw_result) in enumerate(engine.run(pages)):
 		if idx == 0:
 			print image.shape
 		if idx and idx % args.print_count == 0:
 			print "Processed %d/%d Images" % (idx, len(im_files))
-		locations, subwindows = get_subwindows(image, pad_size, args.tile_size)
-		raw_subwindows, binarized_subwindows = predict(network, subwindows, args)
-		write_output(locations, raw_subwindows, binarized_subwindows, im_file, image, pad_size, image, args)
+		write_output(raw_result[:,:,0], im_file, image, args)
+	print engine.report()
+
 
-	
 
 def get_args():
 	parser = argparse.ArgumentParser(description="Outputs binary predictions")
@@ -280,11 +179,15 @@ def get_args():
 	parser.add_argument("--print-count", default=1, type=int, 
 				help="Print every print-count images processed")
 	parser.add_argument("-b", "--batch-size", default=8, type=int, 
-				help="Max number of transforms in single batch per original image")
+				help="Max number of tiles in a single batch.  Tiles of consecutive images share batches")
 	parser.add_argument("-p", "--pad", default=64, type=int, 
 				help="Padding size")
 	parser.add_argument("-t", "--tile-size", default=256, type=int, 
 				help="Size of tiles to extract")
+	parser.add_argument("--stride", default=0, type=int,
+				help="Offset between tiles.  Defaults to tile-size - 2 * pad.  Larger strides (up to tile-size) need --blend")
+	parser.add_argument("--blend", default=False, action='store_true',
+				help="Blend overlapping tiles with weights that fade out over the padding instead of cutting the padding off")
 	parser.add_argument("--im-dirs", default='original_images', type=str, 
 				help="comma separated list of input images to the network")
 	parser.add_argument("--threshold", default=0.5, type=float, 
@@ -293,6 +196,10 @@ def get_args():
 				help="Write auxiliary images for analysis")
 	parser.add_argument("--out-blob", default='prob', type=str,
 				help="Output blob of net")
+	parser.add_argument("--prefetch", default=2, type=int,
+				help="Number of images read ahead of the network")
+	parser.add_argument("--memmap-dir", default="", type=str,
+				help="Keep the per-image outputs in memory mapped files in this directory (for very large images)")
 
 	args = parser.parse_args()
 	print args
@@ -1,6 +1,9 @@
 
 import os
-import sys
+import argparse
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 import scipy.ndimage
 import cv2
@@ -26,7 +29,42 @@ def measure_psnr(im, gt):
 	return 10 * np.log10(_max * _max / mse)
 
 
+def get_drd_weights():
+	W = np.zeros((5,5))
+	for i in [-2, -1, 0, 1, 2]:
+		for j in [-2, -1, 0, 1, 2]:
+			if i or j:
+				W[i+2,j+2] = 1 / np.sqrt(i*i + j*j)
+	return W / W.sum()
+
+
 def measure_drd(im, gt):
+	W = get_drd_weights()
+	height, width = gt.shape[:2]
+	mismatch = im != gt
+
+	# for each offset in the 5x5 neighborhood, count the mismatched pixels whose
+	# value differs from the (in bounds) gt pixel at that offset
+	total = 0
+	for i in [-2, -1, 0, 1, 2]:
+		for j in [-2, -1, 0, 1, 2]:
+			if not (i or j):
+				continue
+			ys, ye = max(0, -i), min(height, height - i)
+			xs, xe = max(0, -j), min(width, width - j)
+			differs = im[ys:ye,xs:xe] != gt[ys+i:ye+i,xs+j:xe+j]
+			total += W[i+2,j+2] * np.count_nonzero(differs & mismatch[ys:ye,xs:xe])
+	numer = total
+
+	# 8x8 blocks of gt that are not all 0 or all 255
+	blocks = gt[:height - height % 8,:width - width % 8]
+	blocks = blocks.reshape(height / 8, 8, width / 8, 8).mean(axis=(1,3))
+	num_non_uniform = np.count_nonzero((blocks != 0) & (blocks != 255))
+	return numer / float(num_non_uniform)
+
+
+# the original per-pixel implementation, kept as a reference for measure_drd
+def measure_drd_reference(im, gt):
 	diff = (im - gt)
 	gt = gt 
 	im = im 
@@ -100,11 +138,39 @@ def measure_psuedo_fmeasure(im, gt, r_weights, p_weights):
 	return f_measure, precision, recall
 	
 
-def get_metrics(predict_fn, gt_fn, recall_fn, precision_fn):
+# The .dat weight files are slow to parse, so the parsed weights are saved as
+# .npy next to them (or in cache_dir) and memory mapped on later runs.  The cache
+# file is keyed by the path, size and modification time of the .dat file, so
+# files with the same name in different dirs don't collide and edits are seen
+def load_weights(dat_fn, shape, cache_dir=None):
+	if cache_dir is None:
+		return np.loadtxt(dat_fn).reshape(shape)
+	stat = os.stat(dat_fn)
+	md5 = hashlib.md5()
+	md5.update("%s %d %d" % (os.path.abspath(dat_fn), stat.st_size, int(stat.st_mtime)))
+	base = os.path.splitext(os.path.basename(dat_fn))[0]
+	npy_fn = os.path.join(cache_dir or os.path.dirname(dat_fn), "%s.%s.npy" % (base, md5.hexdigest()))
+	if os.path.exists(npy_fn):
+		weights = np.load(npy_fn, mmap_mode='r')
+		if weights.shape == shape:
+			return weights
+
+	weights = np.loadtxt(dat_fn).reshape(shape)
+	try:
+		# write then rename so concurrent runs never read a partial file
+		tmp_fn = "%s.%d.tmp.npy" % (npy_fn[:-4], os.getpid())
+		np.save(tmp_fn, weights)
+		os.rename(tmp_fn, npy_fn)
+	except (IOError, OSError) as e:
+		print "Could not cache %s: %s" % (dat_fn, e)
+	return weights
+
+
+def get_metrics(predict_fn, gt_fn, recall_fn, precision_fn, cache_dir=None):
 	predict_im = cv2.imread(predict_fn, -1).astype(np.int32)
 	gt_im = cv2.imread(gt_fn, -1).astype(np.int32)
-	recall_weights = np.loadtxt(recall_fn).reshape(gt_im.shape)
-	precision_weights = np.loadtxt(precision_fn).reshape(gt_im.shape) + 1
+	recall_weights = load_weights(recall_fn, gt_im.shape, cache_dir)
+	precision_weights = load_weights(precision_fn, gt_im.shape, cache_dir) + 1
 
 	assert predict_im.shape == gt_im.shape
 
@@ -116,33 +182,77 @@ def get_metrics(predict_fn, gt_fn, recall_fn, precision_fn):
 
 	return pf, pp, pr, f, p, r, drd, psnr, accuracy
 
-def main(predict_dir, pr_dat_dir, out_file, summary_file):
-	fd = open(out_file, 'w')
-	all_metrics = list()
-	for fn in os.listdir(predict_dir):
-		print fn
-		predict_fn = os.path.join(predict_dir, fn)
-		gt_fn = os.path.join(pr_dat_dir, fn)
-		base = os.path.splitext(fn)[0]
-		recall_fn = os.path.join(pr_dat_dir, base + "_RWeights.dat")
-		precision_fn = os.path.join(pr_dat_dir, base + "_PWeights.dat")
-		metrics = get_metrics(predict_fn, gt_fn, recall_fn, precision_fn)
-		all_metrics.append(metrics)
-		fd.write("%s  %s\n" % (fn, "  ".join(map(lambda f: "%.4f" % f, metrics))))
 
-	fd.close()
+# task is (fn, predict_dir, pr_dat_dir, cache_dir).  Top level so that it can run in a pool
+def get_file_metrics(task):
+	fn, predict_dir, pr_dat_dir, cache_dir = task
+	predict_fn = os.path.join(predict_dir, fn)
+	gt_fn = os.path.join(pr_dat_dir, fn)
+	base = os.path.splitext(fn)[0]
+	recall_fn = os.path.join(pr_dat_dir, base + "_RWeights.dat")
+	precision_fn = os.path.join(pr_dat_dir, base + "_PWeights.dat")
+	return fn, get_metrics(predict_fn, gt_fn, recall_fn, precision_fn, cache_dir)
+
+
+def main(args):
+	fns = sorted(os.listdir(args.predict_dir))
+	if args.no_cache:
+		cache_dir = None
+	else:
+		# empty string caches next to the .dat files
+		cache_dir = args.cache_dir
+		if cache_dir and not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+	tasks = [(fn, args.predict_dir, args.pr_dat_dir, cache_dir) for fn in fns]
+
+	pool = None
+	if args.workers > 1:
+		pool = multiprocessing.Pool(args.workers)
+		results = pool.imap(get_file_metrics, tasks)
+	else:
+		results = itertools.imap(get_file_metrics, tasks)
+
+	# rows are written (in file order) as soon as they are done
+	fd = open(args.out_file, 'w')
+	all_metrics = list()
+	try:
+		for idx, (fn, metrics) in enumerate(results):
+			print "%d/%d %s" % (idx + 1, len(fns), fn)
+			all_metrics.append(metrics)
+			fd.write("%s  %s\n" % (fn, "  ".join(map(lambda f: "%.4f" % f, metrics))))
+			fd.flush()
+	finally:
+		fd.close()
+		if pool is not None:
+			pool.terminate()
 
 	# summary stuff
-	fd = open(summary_file, 'w')
+	fd = open(args.summary_file, 'w')
 	avg_metrics = np.mean(all_metrics, axis=0)
 	fd.write("avg:  %s\n" % "  ".join(map(lambda f: "%.4f" % f, avg_metrics)))
 	fd.close()
-		
+
+
+def get_args():
+	parser = argparse.ArgumentParser(description="Evaluates binarized images against DIBCO style ground truth")
+	parser.add_argument("predict_dir",
+				help="Directory of predicted binary images")
+	parser.add_argument("pr_dat_dir",
+				help="Directory of ground truth images and their _RWeights.dat/_PWeights.dat files")
+	parser.add_argument("out_file",
+				help="Output file of per image metrics")
+	parser.add_argument("summary_file",
+				help="Output file of the average metrics")
+
+	parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(),
+				help="Number of processes evaluating images.  1 evaluates in this process")
+	parser.add_argument("--cache-dir", type=str, default="",
+				help="Where to cache the parsed .dat weights as .npy.  Defaults to next to the .dat files")
+	parser.add_argument("--no-cache", default=False, action="store_true",
+				help="Always parse the .dat weight files")
+	return parser.parse_args()
+
 
 if __name__ == "__main__":
-	predict_dir = sys.argv[1]
-	pr_dat_dir = sys.argv[2]
-	out_file = sys.argv[3]
-	summary_file = sys.argv[4]
-	main(predict_dir, pr_dat_dir, out_file, summary_file)
-	
+	args = get_args()
+	main(args)
@@ -179,6 +179,78 @@ def _Net_forward_all(self, blobs=None, **kwargs):
     return all_outs
 
 
+def _Net_forward_batched(self, ims, blobs=None, batch_size=64, in_blob=None,
+                         channels_last=True):
+    """
+    Run net forward on any number of images in batches of at most batch_size.
+
+    Each batch is written straight into the input blob, which is only
+    reshaped when the batch shape changes, and the outputs are copied into
+    arrays preallocated for all of the images.
+
+    Parameters
+    ----------
+    ims : N x H x W x C ndarray (N x C x H x W if not channels_last), or a
+          list of equally sized H x W (x C) images.
+    blobs : list of blobs to extract.  Defaults to the net outputs.
+    batch_size : max number of images in a forward pass.
+    in_blob : name of the input blob.  Defaults to the first net input.
+    channels_last : whether ims are laid out as H x W x C.
+
+    Returns
+    -------
+    all_outs : {blob name: N x ... ndarray} dict.
+    """
+    if blobs is None:
+        blobs = self.outputs
+    if in_blob is None:
+        in_blob = self.inputs[0] if self.inputs else 'data'
+    input_blob = self.blobs[in_blob]
+
+    num = len(ims)
+    all_outs = {}
+    for i in range(0, num, batch_size):
+        batch = ims[i:i + batch_size]
+        if isinstance(batch, np.ndarray):
+            if batch.ndim == 3:
+                # single channel N x H x W
+                batch = batch[:, np.newaxis]
+            elif channels_last:
+                batch = batch.transpose(0, 3, 1, 2)
+            shape = batch.shape
+        else:
+            im = np.asarray(batch[0])
+            if im.ndim == 2:
+                shape = (len(batch), 1) + im.shape
+            elif channels_last:
+                shape = (len(batch), im.shape[2]) + im.shape[:2]
+            else:
+                shape = (len(batch),) + im.shape
+
+        if input_blob.data.shape != shape:
+            input_blob.reshape(*shape)
+        if isinstance(batch, np.ndarray):
+            input_blob.data[...] = batch
+        else:
+            for x, im in enumerate(batch):
+                im = np.asarray(im)
+                if im.ndim == 2:
+                    input_blob.data[x, 0] = im
+                elif channels_last:
+                    input_blob.data[x] = im.transpose(2, 0, 1)
+                else:
+                    input_blob.data[x] = im
+
+        self.forward()
+        for out in blobs:
+            out_data = self.blobs[out].data
+            if out not in all_outs:
+                all_outs[out] = np.empty((num,) + out_data.shape[1:],
+                                         dtype=out_data.dtype)
+            all_outs[out][i:i + shape[0]] = out_data
+    return all_outs
+
+
 def _Net_forward_backward_all(self, blobs=None, diffs=None, **kwargs):
     """
     Run net forward + backward in batches.
@@ -278,6 +350,7 @@ Net.params = _Net_params
 Net.forward = _Net_forward
 Net.backward = _Net_backward
 Net.forward_all = _Net_forward_all
+Net.forward_batched = _Net_forward_batched
 Net.forward_backward_all = _Net_forward_backward_all
 Net.set_input_arrays = _Net_set_input_arrays
 Net._batch = _Net_batch
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+from binary_eval import measure_drd, measure_drd_reference
+
+
+def random_page(rng, shape, ink=0.3):
+	return np.where(rng.rand(*shape) < ink, 0, 255).astype(np.int32)
+
+
+def flip(im, mask):
+	out = im.copy()
+	out[mask] = 255 - out[mask]
+	return out
+
+
+class DRDTest(unittest.TestCase):
+
+	def setUp(self):
+		self.rng = np.random.RandomState(1234)
+
+	def check(self, im, gt):
+		self.assertAlmostEqual(measure_drd(im, gt), measure_drd_reference(im, gt), places=10)
+
+	def test_random_pages(self):
+		for shape in [(8, 8), (16, 24), (37, 53), (64, 41)]:
+			gt = random_page(self.rng, shape)
+			self.check(flip(gt, self.rng.rand(*shape) < 0.1), gt)
+			self.check(random_page(self.rng, shape), gt)
+
+	def test_identical(self):
+		gt = random_page(self.rng, (24, 32))
+		self.assertEqual(measure_drd(gt, gt), 0)
+		self.check(gt, gt)
+
+	def test_border_mismatches(self):
+		gt = random_page(self.rng, (21, 30))
+		border = np.zeros(gt.shape, dtype=bool)
+		border[:2] = border[-2:] = True
+		border[:,:2] = border[:,-2:] = True
+		self.check(flip(gt, border), gt)
+
+	def test_corners(self):
+		gt = random_page(self.rng, (19, 17))
+		for y, x in [(0, 0), (0, -1), (-1, 0), (-1, -1)]:
+			mask = np.zeros(gt.shape, dtype=bool)
+			mask[y, x] = True
+			self.check(flip(gt, mask), gt)
+
+	def test_uniform_blocks(self):
+		# all white except one block, so only one 8x8 block is non uniform
+		gt = np.full((16, 20), 255, dtype=np.int32)
+		gt[9:12, 10:13] = 0
+		self.check(flip(gt, self.rng.rand(*gt.shape) < 0.2), gt)
+		self.check(np.zeros_like(gt), gt)
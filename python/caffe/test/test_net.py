@@ -78,3 +78,60 @@ class TestNet(unittest.TestCase):
             for i in range(len(self.net.params[name])):
                 self.assertEqual(abs(self.net.params[name][i].data
                     - net2.params[name][i].data).sum(), 0)
+
+
+def input_net_file():
+    """Make a net with a plain input blob, returning the name of the
+    (temporary) file."""
+
+    f = tempfile.NamedTemporaryFile(delete=False)
+    f.write("""name: 'inputnet'
+    input: 'data' input_shape { dim: 2 dim: 3 dim: 4 dim: 5 }
+    layer { type: 'Convolution' name: 'conv' bottom: 'data' top: 'conv'
+      convolution_param { num_output: 7 kernel_size: 2
+        weight_filler { type: 'gaussian' std: 1 }
+        bias_filler { type: 'constant' value: 2 } } }
+    layer { type: 'InnerProduct' name: 'ip' bottom: 'conv' top: 'ip'
+      inner_product_param { num_output: 6
+        weight_filler { type: 'gaussian' std: 1 } } }""")
+    f.close()
+    return f.name
+
+
+class TestForwardBatched(unittest.TestCase):
+    def setUp(self):
+        net_file = input_net_file()
+        self.net = caffe.Net(net_file, caffe.TEST)
+        os.remove(net_file)
+        self.ims = np.random.rand(11, 4, 5, 3).astype(np.float32)
+
+    def forward_one(self, im):
+        self.net.blobs['data'].reshape(1, 3, 4, 5)
+        self.net.blobs['data'].data[...] = im.transpose(2, 0, 1)
+        self.net.forward()
+        return self.net.blobs['ip'].data[0].copy(), \
+            self.net.blobs['conv'].data[0].copy()
+
+    def test_matches_single_forward(self):
+        outs = self.net.forward_batched(self.ims, blobs=['ip', 'conv'],
+                                        batch_size=4)
+        self.assertEqual(outs['ip'].shape, (11, 6))
+        self.assertEqual(outs['conv'].shape, (11, 7, 3, 4))
+        for i, im in enumerate(self.ims):
+            ip, conv = self.forward_one(im)
+            np.testing.assert_allclose(outs['ip'][i], ip, rtol=1e-5)
+            np.testing.assert_allclose(outs['conv'][i], conv, rtol=1e-5)
+
+    def test_layouts(self):
+        outs = self.net.forward_batched(self.ims, blobs=['ip'])
+        chw = self.net.forward_batched(self.ims.transpose(0, 3, 1, 2),
+                                       blobs=['ip'], channels_last=False)
+        as_list = self.net.forward_batched(list(self.ims), blobs=['ip'],
+                                           batch_size=3)
+        np.testing.assert_allclose(chw['ip'], outs['ip'], rtol=1e-5)
+        np.testing.assert_allclose(as_list['ip'], outs['ip'], rtol=1e-5)
+
+    def test_default_outputs(self):
+        outs = self.net.forward_batched(self.ims, batch_size=5)
+        self.assertEqual(list(outs.keys()), self.net.outputs)
+        self.assertEqual(self.net.blobs['data'].data.shape, (1, 3, 4, 5))
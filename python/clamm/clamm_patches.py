@@ -1,19 +1,22 @@
 
 import os
 import sys
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import time
+import json
 import caffe
 import cv2
 import math
 import lmdb
 import random
+import hashlib
 import argparse
-import StringIO
+import multiprocessing
 import numpy as np
 import caffe.proto.caffe_pb2
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from image_encoders import add_encoder_args, get_encoder
+
 np.set_printoptions(precision=2, linewidth=170, suppress=True)
 
 def init_caffe(args):
@@ -266,30 +269,11 @@ def scale_shift_im(im, slice_idx, args):
 	preprocessed_im = scale_val * (im - mean_vals)
 	return preprocessed_im
 
-def get_vote_for_label(ims, caffenet, label, args):
+def fprop(caffenet, ims, batchsize=64):
 	# batch up all transforms at once
-	all_outputs = fprop(caffenet, ims, args.batch_size)
-	return all_outputs[:, label]
+	return caffenet.forward_batched(ims, ["prob"], batchsize, "data")["prob"]
 
 
-def fprop(caffenet, ims, batchsize=64):
-	# batch up all transforms at once
-	idx = 0
-	responses = list()
-	while idx < len(ims):
-		sub_ims = ims[idx:idx+batchsize]
-		caffenet.blobs["data"].reshape(len(sub_ims), ims[0].shape[2], ims[0].shape[0], ims[0].shape[1]) 
-		for x, im in enumerate(sub_ims):
-			transposed = np.transpose(im, [2,0,1])
-			transposed = transposed[np.newaxis, :, :, :]
-			caffenet.blobs["data"].data[x,:,:,:] = transposed
-		idx += batchsize
-
-		# propagate on batch
-		caffenet.forward()
-		responses.append(np.copy(caffenet.blobs["prob"].data))
-	return np.concatenate(responses, axis=0)
-	
 def open_dbs(db_paths, write=False):
 	dbs = list()
 	for path in db_paths:
@@ -300,17 +284,18 @@ def open_dbs(db_paths, write=False):
 		dbs.append( (env, txn, cursor) )
 	return dbs
 
-def close_dbs(dbs):
+def close_dbs(dbs, write=False):
 	for env, txn, cursor in dbs:
 		txn.commit()
-		env.sync()
+		if write:
+			env.sync()
 		env.close()
 
 def log(args, s, newline=True):
 	print s
 	if args.log_file:
 		if not hasattr(args, 'log'):
-			args.log = open(args.log_file, 'w')
+			args.log = open(args.log_file, 'a' if args.resume else 'w')
 		if newline:
 			args.log.write("%s\n" % s)
 		else:
@@ -366,7 +351,7 @@ def prepare_images(test_dbs, transforms, args):
 
 	return ims, original_slice_transforms, label
 
-def package(im, prob):
+def package(im, prob, encoder):
 	doc_datum = caffe.proto.caffe_pb2.DocumentDatum()
 	doc_datum.decade = prob
 	datum_im = doc_datum.image
@@ -376,31 +361,118 @@ def package(im, prob):
 	datum_im.height = im.shape[0]
 	datum_im.encoding = 'jpeg'
 
-	# image data
-	buf = StringIO.StringIO()
-	if datum_im.channels == 1:
-		plt.imsave(buf, im, format='jpeg', vmin=0, vmax=256, cmap='gray')
-	else:
-		# do BGR -> RGB
-		im = im[(2, 1, 0), :, :]
-		plt.imsave(buf, im, format='jpeg', vmin=0, vmax=256)
-	datum_im.data = buf.getvalue()
+	# image data, cv2 decoded images are BGR
+	datum_im.data = encoder.encode(im)
 
 	return doc_datum
 
-def write_patches(ims, prob_of_label, out_dbs):
-	num_slices = len(out_dbs)
-	num_patches = len(ims[0])
-	for slice_idx in xrange(num_slices):
-		for patch_idx in xrange(num_patches):
-			patch = ims[slice_idx][patch_idx]
-			prob = float(prob_of_label[patch_idx])
 
-			doc_datum = package(patch, prob)
+# (patch, prob, encoder) -> serialized DocumentDatum.  Runs in the encoding pool
+def encode_patch(task):
+	patch, prob, encoder = task
+	return package(patch, prob, encoder).SerializeToString()
+
+
+# keys sort in the order the patches were mined
+def get_patch_key(patch_idx, src_key):
+	return "%010d:%s" % (patch_idx, src_key)
+
+
+# every step (one visit of a source image) draws its transforms from its own
+# seed, so the patches do not depend on where a resumed run started
+def seed_step(step, args):
+	random.seed(args.seed * 1000003 + step)
+
+
+def advance_dbs(dbs):
+	for env, txn, cursor in dbs:
+		has_next = cursor.next()
+		if not has_next:
+			cursor.first()
+
+
+# args that do not change the mined patches
+JOURNAL_IGNORED_ARGS = ['gpu', 'log_file', 'print_count', 'workers', 'score_batch_size',
+						'commit_interval', 'resume']
+
+def get_fingerprint(args):
+	opts = dict( (key, val) for key, val in vars(args).items() if key not in JOURNAL_IGNORED_ARGS and key != 'log')
+	return hashlib.md5(json.dumps(opts, sort_keys=True)).hexdigest()
+
+
+def get_journal_file(args):
+	return args.out_lmdbs.split(args.delimiter)[0].rstrip('/') + ".progress.json"
+
+
+# The journal records the next step and the number of patches committed to every out lmdb
+def load_journal(args):
+	journal_file = get_journal_file(args)
+	if not args.resume:
+		return {'fingerprint': get_fingerprint(args), 'step': 0, 'num_patches': 0}
+	if not os.path.exists(journal_file):
+		raise Exception("Cannot resume, no journal found at %s" % journal_file)
+	journal = json.load(open(journal_file, 'r'))
+	if journal['fingerprint'] != get_fingerprint(args):
+		raise Exception("Cannot resume, arguments differ from those in %s" % journal_file)
+	return journal
+
 
-			out_txn = out_dbs[slice_idx][1]
-			key = str(patch_idx + 1000 * random.randint(0,100000000))
-			out_txn.put(key, doc_datum.SerializeToString())
+def save_journal(journal, args):
+	journal_file = get_journal_file(args)
+	tmp_file = journal_file + ".tmp"
+	with open(tmp_file, 'w') as f:
+		json.dump(journal, f, indent=4, sort_keys=True)
+	os.rename(tmp_file, journal_file)
+
+
+def commit_dbs(dbs, journal, args):
+	for idx, (env, txn, cursor) in enumerate(dbs):
+		txn.commit()
+		env.sync()
+		txn = env.begin(write=True)
+		dbs[idx] = (env, txn, txn.cursor())
+	save_journal(journal, args)
+
+
+# Mines the patches of consecutive steps until at least score_batch_size patches
+# are ready.  Returns the patches of each slice, their probs of the true label and
+# their keys.  All patches are scored by one batched forward pass
+def mine_patches(caffenet, test_dbs, journal, args):
+	preprocessed_ims = list()
+	slice_patches = [list() for _ in test_dbs]
+	labels = list()
+	keys = list()
+	num_total = journal['num_patches']
+	while len(labels) < args.score_batch_size and num_total + len(labels) < args.num_patches:
+		seed_step(journal['step'], args)
+		transforms = get_transforms(args)
+		step_ims, step_patches, label = prepare_images(test_dbs, transforms, args)
+		src_key = test_dbs[0][2].key()
+
+		# make sure to get exactly args.num_patches
+		num = min(len(step_ims), args.num_patches - num_total - len(labels))
+		for idx in xrange(num):
+			keys.append(get_patch_key(num_total + len(labels), src_key))
+			labels.append(label)
+		preprocessed_ims.extend(step_ims[:num])
+		for patches, step_slice_patches in zip(slice_patches, step_patches):
+			patches.extend(step_slice_patches[:num])
+
+		advance_dbs(test_dbs)
+		journal['step'] += 1
+
+	all_outputs = fprop(caffenet, preprocessed_ims, args.batch_size)
+	probs = all_outputs[np.arange(len(labels)), labels]
+	return slice_patches, probs, keys
+
+
+def write_patches(slice_patches, probs, keys, out_dbs, pool, encoder):
+	for slice_idx, patches in enumerate(slice_patches):
+		tasks = [(patch, float(prob), encoder) for patch, prob in zip(patches, probs)]
+		serialized = pool.imap(encode_patch, tasks, chunksize=16) if pool else map(encode_patch, tasks)
+		out_txn = out_dbs[slice_idx][1]
+		for key, value in zip(keys, serialized):
+			out_txn.put(key, value)
 
 
 def main(args):
@@ -412,32 +484,42 @@ def main(args):
 	test_dbs = open_dbs(args.test_lmdbs.split(args.delimiter))
 	out_dbs = open_dbs(args.out_lmdbs.split(args.delimiter), write=True)
 
-	num_total = 0
-	while num_total < args.num_patches:
-		transforms = get_transforms(args)
-		if num_total % args.print_count == 0:
-			print "Processed %d patches" % num_total
-
-		preprocessed_ims, ims, label = prepare_images(test_dbs, transforms, args)
-		prob_of_label = get_vote_for_label(preprocessed_ims, caffenet, label, args)
-
-		# make sure to get exactly args.num_patches
-		if num_total + len(ims) > args.num_patches:
-			ims = ims[:args.num_patches - num_total]
-			prob_of_label = prob_of_label[:args.num_patches - num_total]
-
-		write_patches(ims, prob_of_label, out_dbs)
-
-		for env, txn, cursor in test_dbs:
-			has_next = cursor.next() 
-			if not has_next:
-				cursor.first()
-		num_total += len(ims)
-
+	journal = load_journal(args)
+	if journal['step']:
+		log(args, "Resuming at step %d with %d patches" % (journal['step'], journal['num_patches']))
+		num_records = test_dbs[0][0].stat()['entries']
+		for _ in xrange(journal['step'] % num_records):
+			advance_dbs(test_dbs)
+
+	encoder = get_encoder('jpeg', args, bgr=True)
+	pool = multiprocessing.Pool(args.workers) if args.workers > 0 else None
+	start_time = time.time()
+	num_start = journal['num_patches']
+	num_uncommitted = 0
+	try:
+		while journal['num_patches'] < args.num_patches:
+			slice_patches, probs, keys = mine_patches(caffenet, test_dbs, journal, args)
+			write_patches(slice_patches, probs, keys, out_dbs, pool, encoder)
+
+			num_total = journal['num_patches'] + len(keys)
+			if num_total // args.print_count > journal['num_patches'] // args.print_count:
+				elapsed = time.time() - start_time
+				print "Processed %d patches (%.1f patches/sec)" % (num_total, (num_total - num_start) / max(elapsed, 1e-6))
+			journal['num_patches'] = num_total
+
+			num_uncommitted += len(keys)
+			if num_uncommitted >= args.commit_interval:
+				commit_dbs(out_dbs, journal, args)
+				num_uncommitted = 0
+	finally:
+		if pool:
+			pool.terminate()
+
+	commit_dbs(out_dbs, journal, args)
 	log(args, "Done")
 
 	close_dbs(test_dbs)
-	close_dbs(out_dbs)
+	close_dbs(out_dbs, write=True)
 		
 
 def check_args(args):
@@ -494,6 +576,17 @@ def get_args():
 				help="Delimiter used for indicating multiple image slice parameters")
 	parser.add_argument("-b", "--batch-size", default=64, type=int, 
 				help="Max number of transforms in single batch per original image")
+	parser.add_argument("--score-batch-size", default=256, type=int,
+				help="Min number of patches (from consecutive images) scored and written together")
+	parser.add_argument("-w", "--workers", default=4, type=int,
+				help="Number of processes encoding patches.  0 encodes in the main process")
+	parser.add_argument("--commit-interval", default=10000, type=int,
+				help="Commit the out lmdbs and update the journal every this many patches")
+	parser.add_argument("--seed", default=0, type=int,
+				help="Seed for the random crops and scales")
+	parser.add_argument("-r", "--resume", default=False, action="store_true",
+				help="Continue an interrupted run from its journal ($out_lmdb.progress.json)")
+	add_encoder_args(parser)
 
 	args = parser.parse_args()
 
@@ -1,6 +1,7 @@
 
 import os
 import sys
+import time
 import numpy as np
 import scipy.spatial.distance
 import caffe
@@ -12,7 +13,8 @@ NET_CONFIG_FILE = "./networks_fast.txt"
 # acceptable image suffixes
 IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.tif', '.tiff', '.png', '.bmp', '.ppm', '.pgm')
 
-# number of subwindows processed by a network in a batch
+# number of subwindows processed by a network in a batch.  Subwindows of
+# consecutive images share batches.
 # Higher numbers speed up processing (only marginally if BATCH_SIZE > 16)
 # The larger the batch size, the more memory is consumed (both CPU and GPU)
 BATCH_SIZE=4
@@ -28,6 +30,12 @@ STRIDE_X = 100
 MEAN = 127.
 SCALE = 0.0039
 
+# max number of distance matrix entries held in memory at once
+DIST_BLOCK_ELEMENTS = 2 ** 24
+
+# also write the distance matrix as a binary task_matrix.npy (--npy-matrix)
+WRITE_NPY_MATRIX = False
+
 
 def setup_networks():
 	networks = list()
@@ -52,33 +60,20 @@ def setup_networks():
 
 def fprop(network, ims, batchsize=BATCH_SIZE):
 	# batch up all transforms at once
-	idx = 0
-	responses = list()
-	while idx < len(ims):
-		sub_ims = ims[idx:idx+batchsize]
-		network.blobs["data"].reshape(len(sub_ims), 1, ims[0].shape[1], ims[0].shape[0]) 
-		for x, im in enumerate(sub_ims):
-			transposed = im[np.newaxis, np.newaxis, :, :]
-			network.blobs["data"].data[x,:,:,:] = transposed
-		idx += batchsize
-
-		# propagate on batch
-		network.forward()
-		output = np.squeeze(np.copy(network.blobs["prob"].data), axis=(2,3))
-		responses.append(output)
-	return np.concatenate(responses, axis=0)
+	outputs = network.forward_batched(ims, ["prob"], batchsize, "data")["prob"]
+	return np.squeeze(outputs, axis=(2,3))
 
 
-def predict(network, ims):
-	all_outputs = fprop(network, ims)
-
+# average prediction over the subwindow outputs of one image
+def average_outputs(all_outputs):
 	# throw out non-script predictions
-	for idx in xrange(all_outputs.shape[0]):
-		all_outputs[idx][0] = 0
-		all_outputs[idx][13:] = 0
-		
-	mean_outputs = np.average(all_outputs, axis=0)
-	return mean_outputs
+	all_outputs[:,0] = 0
+	all_outputs[:,13:] = 0
+	return np.average(all_outputs, axis=0)
+
+
+def predict(network, ims):
+	return average_outputs(fprop(network, ims))
 
 
 def resize(im, scale_factor):
@@ -87,84 +82,169 @@ def resize(im, scale_factor):
 	return cv2.resize(im, (new_width, new_height))
 
 
+# start offsets of the subwindows along one axis.  Once the next stride would
+# run past the end, the last subwindow is aligned with the end of the axis
+def get_subwindow_starts(length, size, stride):
+	starts = list()
+	pos = 0
+	while (pos + size) <= length:
+		if (pos + size + stride) > length:
+			pos = length - size
+		starts.append(pos)
+		pos += stride
+	return starts
+
+
 def get_subwindows(im):
 	height, width, = TILE_SIZE, TILE_SIZE
-	y_stride, x_stride, = Y_STRIDE, X_STRIDE
 	if (height > im.shape[0]) or (width > im.shape[1]):
-		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
+		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, (height, width))
 		exit(1)
 	ims = list()
-	y = 0
-	while (y + height) <= im.shape[0]:
-		x = 0
-		if (y + height + y_stride) > im.shape[0]:
-			y = im.shape[0] - height
-		while (x + width) <= im.shape[1]:
-			if (x + width + x_stride) > im.shape[1]:
-				x = im.shape[1] - width
+	for y in get_subwindow_starts(im.shape[0], height, STRIDE_Y):
+		for x in get_subwindow_starts(im.shape[1], width, STRIDE_X):
 			ims.append(im[y:y+height,x:x+width])
-			x += x_stride
-		y += y_stride
-
 	return ims
 
-	
-def evaluate(networks, image_dir):
-	predictions = list()
+
+def list_images(image_dir):
 	image_files = list()
-	image_num = 0
 	for image_file in os.listdir(image_dir):
-		image_path = os.path.join(image_dir, image_file)
-		if not image_path.lower().endswith(IMAGE_SUFFIXES):
+		if not image_file.lower().endswith(IMAGE_SUFFIXES):
 			print "Skipping non-image file", image_file
 			continue
-		# keep track of filenames for output file bookkeeping
 		image_files.append(image_file)
+	return image_files
+
 
+# yields (image_idx, {scale: subwindows}), computing each pyramid level once no
+# matter how many networks use it
+def load_pyramids(image_dir, image_files, scales):
+	for image_idx, image_file in enumerate(image_files):
 		# load, shift, and scale pixel values
-		image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+		image = cv2.imread(os.path.join(image_dir, image_file), cv2.IMREAD_GRAYSCALE)
 		image = SCALE * (image - MEAN)
 
-		network_predictions = list()
-		for scale, network in networks:
-			# resize image if necessary
-			if scale == 100:
-				resized_image = np.copy(image)
-			else:
-				resized_image = resize(np.copy(image), scale / 100.)
+		pyramid = dict()
+		for scale in scales:
+			resized_image = image if scale == 100 else resize(image, scale / 100.)
+			pyramid[scale] = get_subwindows(resized_image)
+		yield image_idx, pyramid
+
+
+# Runs one network over the subwindows of consecutive images, packed into full
+# batches.  The averaged prediction of each image is stored in predictions once
+# all of its subwindows have been run.  Networks run one after the other in the
+# main thread, as caffe's mode and device are per process and the forward passes
+# would hold the GIL anyway
+class NetworkBatcher(object):
+
+	def __init__(self, scale, network, batch_size):
+		self.scale = scale
+		self.network = network
+		self.batch_size = batch_size
+		self.predictions = dict()
+		self.pending = list()
+		self.image_outputs = dict()
+		self.image_remaining = dict()
+
+		self.num_subwindows = 0
+		self.num_batches = 0
+		self.busy = 0.
+
+	def run_batch(self):
+		start_time = time.time()
+		outputs = fprop(self.network, [subwindow for image_idx, subwindow in self.pending], len(self.pending))
+		self.busy += time.time() - start_time
+		self.num_batches += 1
+		self.num_subwindows += len(self.pending)
+		for (image_idx, subwindow), output in zip(self.pending, outputs):
+			self.image_outputs[image_idx].append(output)
+			self.image_remaining[image_idx] -= 1
+			if self.image_remaining[image_idx] == 0:
+				self.predictions[image_idx] = average_outputs(np.asarray(self.image_outputs.pop(image_idx)))
+				del self.image_remaining[image_idx]
+		self.pending = list()
+
+	def add(self, image_idx, subwindows):
+		self.image_outputs[image_idx] = list()
+		self.image_remaining[image_idx] = len(subwindows)
+		for subwindow in subwindows:
+			self.pending.append( (image_idx, subwindow) )
+			if len(self.pending) == self.batch_size:
+				self.run_batch()
+
+	def flush(self):
+		if self.pending:
+			self.run_batch()
+
+
+def report(num_images, elapsed, batchers):
+	lines = ["%d images in %.1f s (%.2f images/s)" % (num_images, elapsed, num_images / max(elapsed, 1e-9))]
+	for idx, batcher in enumerate(batchers):
+		lines.append("\tnetwork %d (scale %d): %d subwindows in %d batches, %.1f s busy (%.1f subwindows/s)" % (
+			idx, batcher.scale, batcher.num_subwindows, batcher.num_batches, batcher.busy,
+			batcher.num_subwindows / max(batcher.busy, 1e-9)))
+	return "\n".join(lines)
 
-			subwindows = get_subwindows(resized_image)
 
-			# get the average prediction over all the subwindows
-			network_prediction = predict(network, subwindows)
-			network_predictions.append(network_prediction)
+def evaluate(networks, image_dir):
+	# keep track of filenames for output file bookkeeping
+	image_files = list_images(image_dir)
+	batchers = [NetworkBatcher(scale, network, BATCH_SIZE) for scale, network in networks]
+	start_time = time.time()
+	scales = sorted(set(batcher.scale for batcher in batchers))
+	for image_idx, pyramid in load_pyramids(image_dir, image_files, scales):
+		for batcher in batchers:
+			batcher.add(image_idx, pyramid[batcher.scale])
+		print "Loaded %d images" % (image_idx + 1)
+	for batcher in batchers:
+		batcher.flush()
+	print report(len(image_files), time.time() - start_time, batchers)
+
+	# average predictions over all the networks
+	predictions = list()
+	for image_idx in xrange(len(image_files)):
+		network_predictions = np.asarray([batcher.predictions[image_idx] for batcher in batchers])
+		predictions.append(np.average(network_predictions, axis=0))
+	return image_files, np.asarray(predictions)
 
-		# average predictions over all the networks
-		network_predictions = np.asarray(network_predictions)
-		average_prediction = np.average(network_predictions, axis=0)
-		predictions.append(average_prediction)
 
-		image_num += 1
-		print "Processed %d images" % image_num
+# rows of the pairwise euclidean distance matrix of predictions, block_size rows at a time
+def iter_dist_blocks(predictions, block_size):
+	for start in xrange(0, predictions.shape[0], block_size):
+		yield start, scipy.spatial.distance.cdist(predictions[start:start+block_size], predictions, metric='euclidean')
 
-	return image_files, np.asarray(predictions)
 
+# Streams the distance matrix, normalized to sum to 1, to dist_matrix_file (and
+# optionally npy_file) in row blocks of about DIST_BLOCK_ELEMENTS entries.  The
+# normalization is summed in a first pass, so the full matrix is never in memory
+def write_dist_matrix(image_files, predictions, dist_matrix_file, npy_file=None):
+	num = len(image_files)
+	block_size = max(1, DIST_BLOCK_ELEMENTS // max(num, 1))
+	total = sum(block.sum() for start, block in iter_dist_blocks(predictions, block_size))
 
-def write_dist_matrix(image_files, dist_matrix, dist_matrix_file):
+	if npy_file is not None:
+		npy_matrix = np.lib.format.open_memmap(npy_file + ".tmp", mode='w+', dtype=np.float64, shape=(num, num))
 	fd = open(dist_matrix_file, 'w')
 
 	# write header
 	header = ", ".join(["N/A"] + image_files)
 	fd.write("%s\n" % header)
 
-	for idx in xrange(len(image_files)):
-		image_file = image_files[idx]
-		values = map(str, list(dist_matrix[idx]))
-		row = ", ".join([image_file] + values)
-		fd.write("%s\n" % row)
+	# %r gives the same shortest round trip strings as str()
+	row_format = "%s, " + ", ".join(["%r"] * num) + "\n"
+	for start, block in iter_dist_blocks(predictions, block_size):
+		block /= total
+		fd.write("".join([row_format % ((image_files[start + idx],) + tuple(row)) for idx, row in enumerate(block)]))
+		if npy_file is not None:
+			npy_matrix[start:start+block.shape[0]] = block
 
 	fd.close()
-	
+	if npy_file is not None:
+		del npy_matrix
+		os.rename(npy_file + ".tmp", npy_file)
+
 
 def write_single_class_predictions(image_files, single_class_predictions, single_class_prediction_file):
 	fd = open(single_class_prediction_file, 'w')
@@ -189,15 +269,11 @@ def write_all_class_predictions(image_files, predictions, predictions_file):
 	fd.close()
 
 
-def write_results(image_files, predictions, out_dir):
-	# pairwise distance matrix
-	dist_matrix = scipy.spatial.distance.pdist(predictions, metric='euclidean')
-	dist_matrix = scipy.spatial.distance.squareform(dist_matrix)
-	dist_matrix /= np.sum(dist_matrix.flatten())
-
-	# distance matrix output
+def write_results(image_files, predictions, out_dir, write_npy_matrix=WRITE_NPY_MATRIX):
+	# pairwise distance matrix output
 	dist_matrix_file = os.path.join(out_dir, "task_matrix.txt")
-	write_dist_matrix(image_files, dist_matrix, dist_matrix_file)
+	npy_file = os.path.join(out_dir, "task_matrix.npy") if write_npy_matrix else None
+	write_dist_matrix(image_files, predictions, dist_matrix_file, npy_file)
 
 	# single class classification
 	single_class_predictions = np.argmax(predictions, axis=1)
@@ -209,26 +285,30 @@ def write_results(image_files, predictions, out_dir):
 	write_all_class_predictions(image_files, predictions, all_class_prediction_file)
 
 
-def main(image_dir, out_dir):
+def main(image_dir, out_dir, write_npy_matrix=WRITE_NPY_MATRIX):
 	networks = setup_networks()
 	image_files, predictions = evaluate(networks, image_dir)
-	write_results(image_files, predictions, out_dir)
+	write_results(image_files, predictions, out_dir, write_npy_matrix)
 
 
 if __name__ == "__main__":
-	if len(sys.argv) < 2:
-		print "USAGE: python clamm_submission.py image_directory [output_directory] [gpu#] [netconfig]"
+	# optional flag, anywhere on the command line
+	write_npy_matrix = '--npy-matrix' in sys.argv
+	argv = [arg for arg in sys.argv if arg != '--npy-matrix']
+	if len(argv) < 2:
+		print "USAGE: python clamm_submission.py image_directory [output_directory] [gpu#] [netconfig] [--npy-matrix]"
 		print "\timage_directory is the input directory containing the test images"
 		print "\toutput_directory is where the output files will be written (defauts to '.')"
 		print "\tgpu is an integer device ID to run networks on the specified GPU.  If ommitted, CPU mode is used"
 		print "\tnetconfig is a file specifying which models to use"
+		print "\t--npy-matrix also writes the distance matrix as a binary task_matrix.npy"
 		exit(1)
 	# only required argument
-	image_dir = sys.argv[1]
+	image_dir = argv[1]
 
 	# attempt to parse an output directory
 	try:
-		out_dir = sys.argv[2]
+		out_dir = argv[2]
 		try:
 			os.makedirs(out_dir)
 		except:
@@ -238,7 +318,7 @@ if __name__ == "__main__":
 
 	# use gpu if specified
 	try:
-		gpu = int(sys.argv[3])
+		gpu = int(argv[3])
 		if gpu >= 0:
 			caffe.set_mode_gpu()
 			caffe.set_device(gpu)
@@ -246,9 +326,9 @@ if __name__ == "__main__":
 		caffe.set_mode_cpu()
 
 	try:
-		NET_CONFIG_FILE = sys.argv[4]
+		NET_CONFIG_FILE = argv[4]
 	except:
 		pass
 
-	main(image_dir, out_dir)
+	main(image_dir, out_dir, write_npy_matrix)
 	
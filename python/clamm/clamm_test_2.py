@@ -282,22 +282,8 @@ def scale_shift_im(im, slice_idx, args):
 
 def fprop(caffenet, ims, batchsize=64, out_blob="prob"):
 	# batch up all transforms at once
-	idx = 0
-	responses = list()
-	while idx < len(ims):
-		sub_ims = ims[idx:idx+batchsize]
-		caffenet.blobs["data"].reshape(len(sub_ims), ims[0].shape[2], ims[0].shape[0], ims[0].shape[1]) 
-		for x, im in enumerate(sub_ims):
-			transposed = np.transpose(im, [2,0,1])
-			transposed = transposed[np.newaxis, :, :, :]
-			caffenet.blobs["data"].data[x,:,:,:] = transposed
-		idx += batchsize
-
-		# propagate on batch
-		caffenet.forward()
-		responses.append(np.copy(caffenet.blobs[out_blob].data))
-	return np.concatenate(responses, axis=0)
-	
+	return caffenet.forward_batched(ims, [out_blob], batchsize, "data")[out_blob]
+
 
 def predict(ims, caffenet, args, weights=None):
 	# set up transform weights
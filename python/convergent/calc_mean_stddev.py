@@ -1,34 +1,38 @@
-
 import numpy as np
 import sys
 import os
-import errno
 
-def safe_mkdir(_dir):
-	try:
-		os.makedirs(os.path.join(_dir))
-	except OSError as exc:
-		if exc.errno != errno.EEXIST:
-			raise
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from activation_store import ActivationWriter, list_blobs, load_activations, load_labels
 
-in_dir = sys.argv[1]
-centered_dir = sys.argv[2]
-normalized_dir = sys.argv[3]
+# rows read at once from the memory mapped activations
+BATCH_SIZE = 4096
 
-safe_mkdir(centered_dir)
-safe_mkdir(normalized_dir)
 
-for fname in os.listdir(in_dir):
-	if fname == "labels.txt":
-		continue
-	arr = np.loadtxt(os.path.join(in_dir, fname))
-	col_means = np.mean(arr, axis=0)
-	col_std = np.std(arr, axis=0)
+def iter_batches(arr):
+	for start in xrange(0, arr.shape[0], BATCH_SIZE):
+		yield np.asarray(arr[start:start + BATCH_SIZE], dtype=np.float64)
 
-	arr = arr - col_means[np.newaxis, :]
-	np.savetxt(os.path.join(centered_dir, fname), arr, "%7.4f")
+in_dir = sys.argv[1]
+centered_dir = sys.argv[2]
+normalized_dir = sys.argv[3]
 
-	arr = arr / col_std[np.newaxis, :]
-	np.savetxt(os.path.join(normalized_dir, fname), arr, "%7.4f")
+labels = load_labels(in_dir)
+centered = ActivationWriter(centered_dir, labels.shape[0])
+normalized = ActivationWriter(normalized_dir, labels.shape[0])
+centered.write_labels(labels)
+normalized.write_labels(labels)
+
+for blob in list_blobs(in_dir):
+	arr = load_activations(in_dir, blob)
+	col_means = sum(batch.sum(axis=0) for batch in iter_batches(arr)) / arr.shape[0]
+	col_std = np.sqrt(sum(((batch - col_means) ** 2).sum(axis=0) for batch in iter_batches(arr)) / arr.shape[0])
+
+	for batch in iter_batches(arr):
+		batch = batch - col_means[np.newaxis, :]
+		centered.write(blob, batch)
+		normalized.write(blob, batch / col_std[np.newaxis, :])
 	del arr
 
+centered.close()
+normalized.close()
@@ -11,7 +11,9 @@ import numpy as np
 import caffe.proto.caffe_pb2
 import scipy.ndimage
 import traceback
-import errno
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from activation_store import ActivationWriter, DTYPES
 
 
 def init_model(network_file, weights_file, gpu=0):
@@ -96,31 +98,9 @@ def fprop(model, ims, args):
 	model.forward()
 
 
-def safe_mkdir(_dir):
-	try:
-		os.makedirs(os.path.join(_dir))
-	except OSError as exc:
-		if exc.errno != errno.EEXIST:
-			raise
-
-
-def init_fds(args, blobs):
-	fds = dict()
-	safe_mkdir(args.out_dir)
-
-	for blob in blobs:
-		fds[blob] = open(os.path.join(args.out_dir, blob + ".txt"), 'w')
-	return fds
-
-
-def record_activation(model, blob, fd, args):
-	activations = model.blobs[blob].data
-	if activations.ndim > 2:
-		# pool over spatial regions
-		#activations = np.max(activations, axis=(2,3))
-		activations = activations.reshape((activations.shape[0], -1))
-	#print blob, activations.shape
-	np.savetxt(fd, activations, "%7.4f")
+def record_activation(model, blob, writer, args):
+	# activations are flattened to 2D
+	writer.write(blob, model.blobs[blob].data)
 
 
 def main(args):
@@ -137,27 +117,23 @@ def main(args):
 	else:
 		blobs = args.blobs.split(',')
 	print "Recording blobs:", blobs
-	print "Opening Output Files..."
-	fds = init_fds(args, blobs)
-	label_fd = open(os.path.join(args.out_dir, "labels.txt"), 'w')
+	print "Opening Activation Store..."
+	writer = ActivationWriter(args.out_dir, max_images, args.activation_dtype)
 
 	print "Starting Activation Extraction..."
 	for iter_num in xrange(max_iters):
 		ims, labels = get_batch(cursor, batch_size=args.batch_size, means=args.means, scale=args.scale)
 		fprop(model, ims, args)
 		for blob in blobs:
-			record_activation(model, blob, fds[blob], args)
-		for label in labels:
-			label_fd.write("%d\n" % label)
+			record_activation(model, blob, writer, args)
+		writer.write_labels(labels)
 
 		if iter_num > 0 and iter_num % 10 == 0:
 			print "%.2f%% (%d/%d) Batches" % (100. * iter_num / max_iters, iter_num, max_iters)
 	print "Done"
 
 	print "Closing Files..."
-	label_fd.close()
-	for fd in fds.values():
-		fd.close()
+	writer.close()
 
 	print "Closing LMDB..."
 	env.close()
@@ -174,7 +150,7 @@ def get_args():
 	parser.add_argument("test_lmdb", 
 				help="LMDB of images (encoded DocDatums), used to gather activation values")
 	parser.add_argument("out_dir",
-				help="Output directory of where to store the activations")
+				help="Output directory of where to store the activations (one <blob>.npy per blob)")
 
 	parser.add_argument("-m", "--means", type=str, default="0",
 				help="Optional mean values per channel " 
@@ -191,6 +167,8 @@ def get_args():
 				help="Name of input blob")
 	parser.add_argument("--blobs", type=str, default="_all",
 				help="Comma separated list of blobs to include")
+	parser.add_argument("--activation-dtype", type=str, default="float32", choices=DTYPES,
+				help="Type of the recorded activations.  float16 halves the disk space and IO")
 
 	args = parser.parse_args()
 
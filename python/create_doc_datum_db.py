@@ -2,10 +2,6 @@ import os
 import sys
 import argparse
 import lmdb
-import StringIO
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import caffe
 import caffe.proto.caffe_pb2
 import random
@@ -19,6 +15,13 @@ import skimage.color
 import skimage.filters
 import shutil
 import cv2
+import time
+import Queue
+import threading
+import multiprocessing
+import hashlib
+from image_encoders import add_encoder_args, get_encoder
+from lmdb_shards import SHARD_METHODS, get_shard, get_shard_path, build_shard_index, merge_shard_index
 
 def get_size(size, args):
 	longer = max(size)
@@ -165,9 +168,88 @@ def extract_surf(im, args):
 
 
 def open_db(db_file):
+	parent = os.path.dirname(db_file)
+	if parent and not os.path.isdir(parent):
+		os.makedirs(parent)
 	env = lmdb.open(db_file, readonly=False, map_size=int(2 ** 42), max_readers=2000, writemap=True)
 	txn = env.begin(write=True)
 	return env, txn
+
+
+# args that do not change the contents of the dbs
+JOURNAL_IGNORED_ARGS = ['workers', 'queue_size', 'resume', 'checkpoint_interval', 'out_dir', 'num_samples', 'seed',
+						'index_only']
+
+# identifies the manifest and the processing options of a build
+def get_fingerprint(lines, args):
+	md5 = hashlib.md5()
+	for line in lines:
+		md5.update(line)
+	opts = dict( (key, val) for key, val in vars(args).items() if key not in JOURNAL_IGNORED_ARGS)
+	md5.update(json.dumps(opts, sort_keys=True))
+	return md5.hexdigest()
+
+
+def get_journal_file(args):
+	if args.shard_id >= 0:
+		return args.outdb.rstrip('/') + ".shard_%d.progress.json" % args.shard_id
+	return args.outdb.rstrip('/') + ".progress.json"
+
+
+# The journal records, for each output db, the index of the last manifest line whose
+# records are committed to it, so that an interrupted build can be resumed.  A db is
+# journaled as soon as it is opened, as committed up to the line before its first record.
+# class_counts only counts committed records.  Keys starting with _ are not saved:
+# _pending_class_counts are the per db counts of uncommitted records and
+# _seen_class_counts count every record written in this run, for saving samples
+def new_journal(fingerprint, args):
+	journal = {'fingerprint': fingerprint, 'seed': args.seed, 'done': False,
+			'last_index': dict(), 'entries': collections.Counter(), 'class_counts': collections.Counter()}
+	init_class_counts(journal)
+	return journal
+
+
+def init_class_counts(journal):
+	journal['_pending_class_counts'] = collections.defaultdict(collections.Counter)
+	journal['_seen_class_counts'] = collections.Counter(journal['class_counts'])
+
+
+def load_journal(fingerprint, args):
+	journal_file = get_journal_file(args)
+	if not os.path.exists(journal_file):
+		raise Exception("Cannot resume, no journal found at %s" % journal_file)
+	journal = json.load(open(journal_file, 'r'))
+	if journal['fingerprint'] != fingerprint:
+		raise Exception("Cannot resume, manifest or arguments differ from those in %s" % journal_file)
+	journal['entries'] = collections.Counter(journal['entries'])
+	journal['class_counts'] = collections.Counter(dict( (int(key), val) for key, val in journal['class_counts'].items()))
+	init_class_counts(journal)
+	return journal
+
+
+def save_journal(journal, args):
+	journal_file = get_journal_file(args)
+	tmp_file = journal_file + ".tmp"
+	saved = dict( (key, val) for key, val in journal.items() if not key.startswith('_'))
+	with open(tmp_file, 'w') as f:
+		json.dump(saved, f, indent=4, sort_keys=True)
+	os.rename(tmp_file, journal_file)  # atomic, so a crash never leaves a partial journal
+
+
+def commit_db(db_file, x, dbs, journal):
+	env, txn = dbs[db_file]
+	txn.commit()
+	env.sync()
+	dbs[db_file] = (env, env.begin(write=True))
+	journal['last_index'][db_file] = x
+	journal['class_counts'].update(journal['_pending_class_counts'].pop(db_file, {}))
+
+
+# commits every db so that all lines up to x can be skipped on resume
+def checkpoint(x, dbs, journal, args):
+	for db_file in dbs:
+		commit_db(db_file, x, dbs, journal)
+	save_journal(journal, args)
 	
 def package(im, dbid, args):
 	doc_datum = caffe.proto.caffe_pb2.DocumentDatum()
@@ -180,20 +262,233 @@ def package(im, dbid, args):
 	datum_im.encoding = args.encoding
 
 	# image data
-	if args.encoding != 'none':
-		buf = StringIO.StringIO()
-		if datum_im.channels == 1:
-			plt.imsave(buf, im, format=args.encoding, vmin=0, vmax=1, cmap='gray')
-		else:
-			plt.imsave(buf, im, format=args.encoding, vmin=0, vmax=1)
-		datum_im.data = buf.getvalue()
-	else:
-		pix = im.transpose(2, 0, 1)
-		datum_im.data = pix.tostring()
+	datum_im.data = get_encoder(args.encoding, args).encode(im)
 
 	return doc_datum
 
+
+def get_db_file(im, idx, shard, args):
+	if args.multiple_db:
+		db_file = os.path.join(args.outdb, "%dx%d_lmdb" % im.shape[:2])
+	elif args.dense_surf:
+		db_file = os.path.join(args.outdb, "surf_%d_lmdb" % idx)
+	else:
+		db_file = args.outdb
+	if args.shards > 1:
+		db_file = get_shard_path(db_file, shard)
+	return db_file
+
+
+# all records of a manifest line go to the same shard
+def get_line_shard(x, line, args):
+	tokens = line.split()
+	name = os.path.splitext(os.path.basename(tokens[0]))[0] if tokens else ""
+	return get_shard(x, name, args.shards, args.shard_method)
+
+
+# reads, resizes and encodes all of the DocumentDatums for a single manifest line
+# returns a list of (db_file, key, serialized doc_datum, dbid, im_file, im) and the
+# time spent in each stage.  im is only kept when samples are being saved.
+def process_line(x, line, args):
+	records = list()
+	times = collections.Counter()
+	im_file = line.rstrip()
+	try:
+		tokens = line.rstrip().split()
+		im_file = os.path.join(args.imroot, tokens[0])
+		start = time.time()
+		ims = process_im(im_file, args)
+		dbid = int(tokens[1])
+		times['decode'] += time.time() - start
+
+		start = time.time()
+		base = os.path.splitext(os.path.basename(im_file))[0]
+		shard = get_line_shard(x, line, args)
+		for idx, im in enumerate(ims):
+			doc_datum = package(im, dbid, args)
+			db_file = get_db_file(im, idx, shard, args)
+			key = "%d:%s" % (x, base)
+			sample = im if args.out_dir else None
+			records.append( (db_file, key, doc_datum.SerializeToString(), dbid, im_file, sample) )
+		times['encode'] += time.time() - start
+	except Exception as e:
+		print e
+		print traceback.print_exc(file=sys.stdout)
+		print "Error occured on:", im_file
+	return records, times
+
+
+def save_sample(im, serialized, dbid, im_file, args):
+	doc_datum = caffe.proto.caffe_pb2.DocumentDatum()
+	doc_datum.ParseFromString(serialized)
+	base = os.path.splitext(os.path.basename(im_file))[0]
+	fname1 = os.path.join(args.out_dir, str(dbid), "%s.png" % base)
+	fname2 = os.path.join(args.out_dir, str(dbid), "%s_db_entry.%s" % (base, args.encoding))
+	try:
+		skimage.io.imsave(fname1, im)
+		open(fname2, 'wb').write(doc_datum.image.data)
+	except:
+		print traceback.print_exc(file=sys.stdout)
+		print "Could not save to:", fname1
+		print "Original image: ", im_file
+
+
+# puts the records of manifest line x into their dbs.  Must be called in manifest order
+# from a single process so that the output is the same regardless of --workers
+def write_records(x, records, dbs, journal, args):
+	c = journal['entries']
+	db_c = journal['_seen_class_counts']
+	for db_file, key, serialized, dbid, im_file, im in records:
+		try:
+			if x <= journal['last_index'].get(db_file, -1):
+				# already committed before the build was resumed
+				continue
+			if db_file not in dbs:
+				dbs[db_file] = open_db(db_file)
+				print "\tOpening %s" % db_file
+				# nothing before line x goes to this db, so a resume must not skip past x
+				journal['last_index'][db_file] = x - 1
+				save_journal(journal, args)
+			env, txn = dbs[db_file]
+			txn.put(key, serialized)
+			c[db_file] += 1
+			journal['_pending_class_counts'][db_file][dbid] += 1
+			if c[db_file] % 1000 == 0:
+				commit_db(db_file, x, dbs, journal)
+				save_journal(journal, args)
+				print db_file
+				print env.stat()
+				print env.info()
+
+			if args.out_dir and dbid not in db_c:
+				dirname = os.path.join(args.out_dir, str(dbid))
+				try:
+					os.makedirs(dirname)
+				except:
+					print traceback.print_exc(file=sys.stdout)
+					print "Could not create:", dirname
+
+			db_c[dbid] += 1
+			if args.out_dir and db_c[dbid] <= args.num_samples:
+				save_sample(im, serialized, dbid, im_file, args)
+		except Exception as e:
+			print e
+			print traceback.print_exc(file=sys.stdout)
+			print "Error occured on:", im_file
+
+
+def print_throughput(num_images, stage_times, start_time, args):
+	elapsed = time.time() - start_time
+	print "Throughput: %d images in %.1fs (%.1f images/sec)" % (num_images, elapsed, num_images / max(elapsed, 1e-6))
+	for stage in ['decode', 'encode', 'write']:
+		if stage_times[stage] > 0:
+			print "\t%s: %.1f images/sec per process" % (stage, num_images / stage_times[stage])
+
+
+# xs are the manifest indices to process, in order
+def process_serial(lines, xs, dbs, journal, args):
+	stage_times = collections.Counter()
+	start_time = time.time()
+	for i, x in enumerate(xs):
+		if i and i % 1000 == 0:
+			print "Processed %d images" % i
+			print_throughput(i, stage_times, start_time, args)
+		records, times = process_line(x, lines[x], args)
+		stage_times.update(times)
+
+		start = time.time()
+		write_records(x, records, dbs, journal, args)
+		if (i + 1) % args.checkpoint_interval == 0:
+			checkpoint(x, dbs, journal, args)
+		stage_times['write'] += time.time() - start
+	print_throughput(len(xs), stage_times, start_time, args)
+
+
+def worker(task_queue, result_queue, args):
+	while True:
+		task = task_queue.get()
+		if task is None:
+			break
+		i, x, line = task
+		records, times = process_line(x, line, args)
+		result_queue.put( (i, records, times) )
+
+
+# seconds to wait for a result before checking that the workers are still alive
+WORKER_CHECK_INTERVAL = 5
+
+
+# Workers read/decode/resize/encode manifest lines and this process writes the
+# results in manifest order.  At most args.queue_size lines are in flight
+# (queued, being processed, or waiting to be written) so memory stays bounded.
+# If a worker dies (e.g. killed for running out of memory), its lines would never
+# arrive, so what was written is checkpointed and the run stops for --resume
+def process_parallel(lines, xs, dbs, journal, args):
+	task_queue = multiprocessing.Queue(args.queue_size)
+	result_queue = multiprocessing.Queue(args.queue_size)
+	in_flight = threading.BoundedSemaphore(args.queue_size)
+
+	workers = list()
+	for _ in xrange(args.workers):
+		p = multiprocessing.Process(target=worker, args=(task_queue, result_queue, args))
+		p.daemon = True
+		p.start()
+		workers.append(p)
+
+	def feed():
+		for i, x in enumerate(xs):
+			in_flight.acquire()
+			task_queue.put( (i, x, lines[x]) )
+		for _ in workers:
+			task_queue.put(None)
+
+	feeder = threading.Thread(target=feed)
+	feeder.daemon = True
+	feeder.start()
+
+	stage_times = collections.Counter()
+	start_time = time.time()
+	pending = dict()
+	next_i = 0
+	while next_i < len(xs):
+		try:
+			i, records, times = result_queue.get(timeout=WORKER_CHECK_INTERVAL)
+		except Queue.Empty:
+			dead = [proc for proc in workers if not proc.is_alive() and proc.exitcode != 0]
+			if not dead:
+				continue
+			if next_i:
+				checkpoint(xs[next_i - 1], dbs, journal, args)
+			for proc in workers:
+				proc.terminate()
+			raise Exception("Worker process %d died with exit code %r after %d images.  Run again with --resume to continue" % (
+				dead[0].pid, dead[0].exitcode, next_i))
+		pending[i] = records
+		stage_times.update(times)
+		while next_i in pending:
+			if next_i and next_i % 1000 == 0:
+				print "Processed %d images" % next_i
+				print_throughput(next_i, stage_times, start_time, args)
+			x = xs[next_i]
+			start = time.time()
+			write_records(x, pending.pop(next_i), dbs, journal, args)
+			if (next_i + 1) % args.checkpoint_interval == 0:
+				checkpoint(x, dbs, journal, args)
+			stage_times['write'] += time.time() - start
+			in_flight.release()
+			next_i += 1
+
+	feeder.join()
+	for p in workers:
+		p.join()
+	print_throughput(len(xs), stage_times, start_time, args)
+
+
 def main(args):
+	if args.index_only:
+		write_shard_index(args)
+		return
+
 	dbs = {}
 	if args.multiple_db:
 		try:
@@ -202,7 +497,7 @@ def main(args):
 			pass
 
 	# delete and recreate
-	if args.out_dir:
+	if args.out_dir and not args.resume:
 		try:
 			if os.path.exists(args.out_dir):
 				shutil.rmtree(args.out_dir)
@@ -218,72 +513,41 @@ def main(args):
 
 	print "Reading Manifest..."
 	lines = open(args.manifest, 'r').readlines()
+	fingerprint = get_fingerprint(lines, args)
+
+	start_x = 0
+	if args.resume:
+		journal = load_journal(fingerprint, args)
+		args.seed = journal['seed']
+		if journal['last_index']:
+			start_x = min(journal['last_index'].values()) + 1
+		for db_file in journal['last_index']:
+			print "\tReopening %s" % db_file
+			dbs[db_file] = open_db(db_file)
+			journal['entries'][db_file] = dbs[db_file][0].stat()['entries']
+		print "Resuming from manifest line %d" % start_x
+	else:
+		if args.shuffle and args.seed is None and args.shard_id >= 0:
+			# each process must split the same order of lines into shards
+			raise Exception("--shard-id with shuffling needs a --seed shared by all of the shard processes")
+		if args.shuffle and args.seed is None:
+			# record a seed so the shuffle can be reproduced on resume
+			args.seed = random.randint(0, 2 ** 31 - 1)
+		journal = new_journal(fingerprint, args)
+
 	if args.shuffle:
 		print "Shuffling Data..."
+		random.seed(args.seed)
 		random.shuffle(lines)
 
-	c = collections.Counter()
-	db_c = collections.Counter()
-	for x,line in enumerate(lines):
-		if x and x % 1000 == 0:
-			print "Processed %d images" % x
-		try:
-			line = line.rstrip()
-			tokens = line.split()
-			im_file = os.path.join(args.imroot, tokens[0])
-			ims = process_im(im_file, args)
-			dbid = int(tokens[1])
-
-			for idx, im in enumerate(ims):
-				doc_datum = package(im, dbid, args)
-				if args.multiple_db:
-					db_file = os.path.join(args.outdb, "%dx%d_lmdb" % im.shape[:2])
-				elif args.dense_surf:
-					db_file = os.path.join(args.outdb, "surf_%d_lmdb" % idx)
-				else:
-					db_file = args.outdb
-				if db_file not in dbs:
-					dbs[db_file] = open_db(db_file)
-					print "\tOpening %s" % db_file
-				env, txn = dbs[db_file]
-				key = "%d:%s" % (x, os.path.splitext(os.path.basename(im_file))[0])
-				txn.put(key, doc_datum.SerializeToString())
-				c[db_file] += 1
-				if c[db_file] % 1000 == 0:
-					txn.commit()
-					env.sync()
-					print db_file
-					print env.stat()
-					print env.info()
-					txn = env.begin(write=True)
-					dbs[db_file] = (env, txn)
-
-				if args.out_dir and dbid not in db_c:
-					dirname = os.path.join(args.out_dir, str(dbid))
-					try:
-						os.makedirs(dirname)
-					except:
-						print traceback.print_exc(file=sys.stdout)
-						print "Could not create:", dirname
-						
-				db_c[dbid] += 1
-				if args.out_dir and db_c[dbid] <= args.num_samples:
-					base = os.path.splitext(os.path.basename(im_file))[0]
-					fname1 = os.path.join(args.out_dir, str(dbid), "%s.png" % base)
-					fname2 = os.path.join(args.out_dir, str(dbid), "%s_db_entry.%s" % (base, args.encoding))
-					try:
-						skimage.io.imsave(fname1, im)
-						open(fname2, 'wb').write(doc_datum.image.data)
-					except:
-						print traceback.print_exc(file=sys.stdout)
-						print "Could not save to:", fname1
-						print "Original image: ", im_file
-
-		except Exception as e:
-			print e
-			print traceback.print_exc(file=sys.stdout)
-			print "Error occured on:", im_file
+	xs = range(start_x, len(lines))
+	if args.shard_id >= 0:
+		xs = [x for x in xs if get_line_shard(x, lines[x], args) == args.shard_id]
 
+	if args.workers > 0:
+		process_parallel(lines, xs, dbs, journal, args)
+	else:
+		process_serial(lines, xs, dbs, journal, args)
 
 	print "Done Processing Images"
 
@@ -292,10 +556,36 @@ def main(args):
 		env, txn = val
 		txn.commit()
 		env.close()
+		journal['last_index'][key] = len(lines) - 1
+		journal['class_counts'].update(journal['_pending_class_counts'].pop(key, {}))
+	journal['done'] = True
+	save_journal(journal, args)
+
+	if args.shards > 1 and args.shard_id >= 0:
+		# other shard processes may still be writing, and may create dbs this one never opened
+		print "Run again with --index-only once every --shard-id has finished to write the shard index"
+	elif args.shards > 1:
+		write_shard_index(args)
+
+
+# indexes every shard of every sharded db in $outdb and merges the index of each db.
+# Must only run once all shards are finished
+def write_shard_index(args):
+	if args.multiple_db or args.dense_surf:
+		db_dirs = [os.path.join(args.outdb, name) for name in os.listdir(args.outdb) if name.endswith("_lmdb")]
+	else:
+		db_dirs = [args.outdb]
 
+	for db_dir in sorted(db_dirs):
+		for shard in xrange(args.shards):
+			shard_index = build_shard_index(db_dir, shard, args.shard_method)
+			print "Indexed %s: %d entries" % (get_shard_path(db_dir, shard), shard_index['count'])
+		if merge_shard_index(db_dir, args.shards):
+			print "Wrote shard index for %s" % db_dir
 
-def get_args():
-	parser = argparse.ArgumentParser(description="Creates an LMDB of DocumentDatums")
+
+def get_parser(description="Creates an LMDB of DocumentDatums"):
+	parser = argparse.ArgumentParser(description=description)
 	parser.add_argument('manifest', type=str,
 						help='file listing image-paths and metadata-paths, one per line')
 	parser.add_argument('imroot', type=str,
@@ -317,6 +607,8 @@ def get_args():
 						help='How to store the image in the DocumentDatum')
 	parser.add_argument('--no-shuffle', dest="shuffle", default=True, action="store_false",
 						help='How to store the image in the DocumentDatum')
+	parser.add_argument('--seed', type=int, default=None,
+						help='Seed for shuffling the manifest.  Fix it to get identical dbs across runs')
 	parser.add_argument('-s', '--size-str', type=str, default="",
 						help='The size string: e.g. 256, 256x384, 256l, 384s')
 	parser.add_argument('-i', '--invert', default=False, action="store_true",
@@ -330,6 +622,8 @@ def get_args():
 	parser.add_argument('--surf-radius', default=2, type=float, 
 						help='Size of each surf descriptor as a multiple of the grid resolution')
 
+	add_encoder_args(parser)
+
 	group = parser.add_argument_group('Multiple AR', 'These parameters control the creation of many LMDBS, with one per Aspect Ratio')
 	group.add_argument('-a', '--aspect-ratio-bin', type=int, default=32,
 						help='When sizing image, round it to the nearest aspect ratio')
@@ -340,13 +634,40 @@ def get_args():
 	group.add_argument('-t', '--truncate', type=float, default='2',
 						help='Upper/Lower bound on the image AR')
 
+	group = parser.add_argument_group('Parallelism', 'Read/decode/resize/encode images in worker processes')
+	group.add_argument('-w', '--workers', type=int, default=0,
+						help='Number of worker processes.  0 processes everything in the writer process')
+	group.add_argument('--queue-size', type=int, default=256,
+						help='Max number of manifest lines in flight between the workers and the writer')
+
+	group = parser.add_argument_group('Sharding', 'Partition records into $outdb/shard_<i> lmdbs with an $outdb/index.json')
+	group.add_argument('--shards', type=int, default=1,
+						help='Number of shards.  1 writes a single lmdb')
+	group.add_argument('--shard-method', type=str, default='hash', choices=SHARD_METHODS,
+						help='Partition by a hash of the image name or round-robin over the manifest')
+	group.add_argument('--shard-id', type=int, default=-1,
+						help='Only write this shard, so that several processes can write the shards concurrently.  '
+						'Needs a --seed when shuffling')
+	group.add_argument('--index-only', default=False, action="store_true",
+						help='Only write the shard index of $outdb, e.g. after all --shard-id processes finish')
+
+	group = parser.add_argument_group('Resuming', 'Progress is journaled to $outdb.progress.json')
+	group.add_argument('-r', '--resume', default=False, action="store_true",
+						help='Reopen the dbs of an interrupted build and skip the lines already committed')
+	group.add_argument('--checkpoint-interval', type=int, default=10000,
+						help='Commit all dbs and update the journal every this many manifest lines')
+
 	group = parser.add_argument_group('Samples', 'Save samples of processed images')
 	parser.add_argument('-o', '--out-dir', type=str, default='',
 						help='Where to store samples of each class.  Will delete any existing directory.')
 	parser.add_argument('-n', '--num-samples', type=int, default=1,
 						help='How many samples of each class to save')
 	
-	args = parser.parse_args()
+	return parser
+
+
+def get_args():
+	args = get_parser().parse_args()
 	return args
 
 
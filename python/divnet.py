@@ -1,11 +1,11 @@
 
-import os
 import dpp
 import caffe
 import argparse
 import numpy as np
 import caffe.proto.caffe_pb2
 import google.protobuf.text_format
+from activation_store import load_activations
 from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn import linear_model
 
@@ -144,15 +144,15 @@ def main(args):
             raise Exception("Layer %s does not exist in file %s" % \
                 (layer_name, args.network_file))
         bottom_blob_name = layer_param.bottom[0]
-        bottom_activations_file = os.path.join(args.activations_dir,
-                                                "%s.txt" % bottom_blob_name)
-        bottom_activations = np.loadtxt(bottom_activations_file)
+        # float64 like the .txt dumps of older versions, whatever the stored type
+        bottom_activations = load_activations(args.activations_dir,
+                                              bottom_blob_name,
+                                              dtype=np.float64)
         log(args, "Bottom shape: %s" % str(bottom_activations.shape))
 
         top_blob_name = layer_param.top[0]
-        top_activations_file = os.path.join(args.activations_dir,
-            "%s.txt" % top_blob_name)
-        top_activations = np.loadtxt(top_activations_file)
+        top_activations = load_activations(args.activations_dir,
+            top_blob_name, dtype=np.float64)
         log(args, "Top shape: %s" % str(top_activations.shape))
 
         # row = instance, col = neuron,
@@ -213,7 +213,8 @@ def get_args():
     parser.add_argument("weight_file",
                 help="The model weight file (e.g. net.caffemodel)")
     parser.add_argument("activations_dir",
-                help="directory of activation values for each layer")
+                help="directory of activation values for each layer, as written \
+                    by convergent/record_activations.py")
     parser.add_argument("out_network_file",
                 help="Outfile for the pruned caffe architecture")
     parser.add_argument("out_weight_file",
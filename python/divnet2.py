@@ -3,13 +3,17 @@ import os
 import sys
 import cv2
 import dpp
+import dpp_tools
+import least_squares
 import lmdb
 import caffe
+import time
 import shutil
 import argparse
 import tempfile
 import numpy as np
 import caffe.proto.caffe_pb2
+from activation_store import ActivationWriter, load_activations, DTYPES
 from sklearn import linear_model
 import google.protobuf.text_format
 from sklearn.metrics.pairwise import pairwise_kernels
@@ -37,19 +41,49 @@ def init_caffe(args):
 	return model
 
 
-def gram(mat, args):
-	'''Computes the gram matrix of mat according to a specified kernel function'''
-	kwargs = {}
+def get_gamma(activations):
+	return 10. / activations.shape[0]
+
+
+def gram(activations, args):
+	'''
+	Computes the gram matrix of the neurons (columns) of activations according to a specified
+		kernel function.  Kernels of inner products are accumulated over batches of images
+	'''
+	if args.kernel in dpp_tools.KERNELS_FROM_GRAM:
+		return dpp_tools.kernel_from_gram(dpp_tools.accumulate_gram(activations), args.kernel, get_gamma(activations))
 
-	if args.kernel in ['rbf', 'polynomial', 'poly', 'laplacian']:
+	kwargs = {}
+	if args.kernel == 'laplacian':
 		# gamma for chi squared should be left to default
-		kwargs = dict(gamma=10. / mat_a.shape[1])
-	output = pairwise_kernels(mat, metric=args.kernel, n_jobs=1, **kwargs)
+		kwargs = dict(gamma=get_gamma(activations))
+	output = pairwise_kernels(activations.transpose(), metric=args.kernel, n_jobs=1, **kwargs)
 	return output
 
 
-def sample_neurons(L, args):
-	return dpp.sample_dpp(L, args.num_neurons)
+def sample_neurons(activations, args):
+	'''
+	Samples diverse neurons through a DPP whose kernel is the gram matrix of activations, or
+		its low rank approximation with args.kernel_approx
+	'''
+	start_time = time.time()
+	if args.kernel_approx == 'none':
+		L = gram(activations, args)
+		log(args, "Gram Matrix shape: %s (%.2f s)" % (str(L.shape), time.time() - start_time))
+		if args.sampler == 'greedy':
+			neuron_indices = dpp_tools.greedy_map_dpp_kernel(L, args.num_neurons)
+		else:
+			neuron_indices = dpp.sample_dpp(L, args.num_neurons)
+	else:
+		features = dpp_tools.approx_kernel_features(activations, args.kernel, get_gamma(activations), args.kernel_approx,
+			args.num_features, args.seed)
+		log(args, "Kernel features shape: %s (%.2f s)" % (str(features.shape), time.time() - start_time))
+		if args.sampler == 'greedy':
+			neuron_indices = dpp_tools.greedy_map_dpp_features(features, args.num_neurons)
+		else:
+			neuron_indices = dpp_tools.sample_low_rank_dpp(features, args.num_neurons, np.random.RandomState(args.seed))
+	log(args, "Kept %d neurons (%.2f s)" % (len(neuron_indices), time.time() - start_time))
+	return neuron_indices
 
 
 def get_layer(layer_name, model):
@@ -81,10 +115,20 @@ def get_layer_param(layer_name, netspec):
 		return None
 
 
-def update_weights(inputs, keep, output):
-	inputs = inputs[:,keep]
-	clf = linear_model.LinearRegression(fit_intercept=True)
-	clf.fit(inputs, output)
+def update_weights(inputs, keep, output, args):
+	'''
+	Regresses output on the kept neurons of inputs.  The normal equations solver reads the
+		activations a batch at a time, while sklearn needs them all in memory
+	'''
+	if args.solver == 'normal':
+		return least_squares.fit_least_squares(inputs, output, keep, args.ridge)
+
+	inputs = np.asarray(inputs[:,keep], dtype=np.float32)
+	if args.ridge > 0:
+		clf = linear_model.Ridge(alpha=args.ridge, fit_intercept=True)
+	else:
+		clf = linear_model.LinearRegression(fit_intercept=True)
+	clf.fit(inputs, np.asarray(output, dtype=np.float32))
 	weights = clf.coef_
 	intercept = clf.intercept_
 
@@ -116,17 +160,6 @@ def open_lmdb(lmdb_path):
 	return env, txn, cursor
 
 
-def init_fds(out_dir, blobs):
-	'''
-	Opens file descriptors for each blob in out_dir
-	'''
-	fds = dict()
-
-	for blob in blobs:
-		fds[blob] = open(os.path.join(out_dir, blob + ".txt"), 'w')
-	return fds
-
-
 def get_image(cursor):
 	'''
 	Returns a single image from the cursor.  The LMDB is assumed to
@@ -208,27 +241,27 @@ def fprop(model, batch, args):
 	model.forward()
 
 
-def record_blob_activation(model, blob, fd):
+def record_blob_activation(model, blob, writer, spatial_pool='none'):
 	'''
-	Saves the activations of the named blob of the model to the file fd
-	Activations are flattened to 2D
+	Appends the activations of the named blob of the model to the activation store
+	Activations are optionally pooled over spatial regions and flattened to 2D
 	'''
 	activations = model.blobs[blob].data
-	if activations.ndim > 2:
-		# pool over spatial regions
-		#activations = np.max(activations, axis=(2,3))
-		activations = activations.reshape((activations.shape[0], -1))
-	np.savetxt(fd, activations, "%7.4f")
+	if activations.ndim > 2 and spatial_pool == 'max':
+		activations = np.max(activations, axis=(2,3))
+	elif activations.ndim > 2 and spatial_pool == 'avg':
+		activations = np.mean(activations, axis=(2,3))
+	writer.write(blob, activations)
 
 
-def record_activations(model, out_dir, args):
+def record_activations(model, out_dir, blob_names, args):
 	'''
-	Uses args.lmdb as inputs to the model to record activation vectors for every unique
-		layer value (blob) in model.  Note that in place operations reuse the same blob,
+	Uses args.lmdb as inputs to the model to record activation vectors for the named
+		layer values (blobs) in model.  Note that in place operations reuse the same blob,
 		so the recorded activations will be after the final operation on that blob.  It
 		is recommended to remove in-place operations in the model prototxt.
-	Activations are written to files in out_dir, where the file name is 
-		$out_dir/<blob_name>.txt.  This is done so that we don't need to store all
+	Activations are written to an activation store in out_dir, where the file name is 
+		$out_dir/<blob_name>.npy.  This is done so that we don't need to store all
 		activations for the entire dataset in RAM (it's big).
 	'''
 	log(args, "Opening LMDB")
@@ -239,28 +272,23 @@ def record_activations(model, out_dir, args):
 	num_batches = (num_images + args.batch_size - 1) / args.batch_size
 	log(args, "Will execute for %d batches" % num_batches)
 
-	# get the blob names and open files for each one
-	blob_names = model.blobs.keys()
+	# preallocate the store for num_images
 	log(args, "Recording activations for blobs: %r" % blob_names)
-	fds = init_fds(out_dir, blob_names)
-	label_fd = open(os.path.join(out_dir, "labels.txt"), 'w')
+	writer = ActivationWriter(out_dir, num_images, args.activation_dtype)
 	
 	for batch_num in xrange(num_batches):
 		batch, labels = get_batch(cursor, batch_size=args.batch_size, means=args.means, scale=args.scale)
 		fprop(model, batch, args)
 		for blob_name in blob_names:
-			record_blob_activation(model, blob_name, fds[blob_name])
-		for label in labels:
-			label_fd.write("%d\n" % label)
+			record_blob_activation(model, blob_name, writer, args.spatial_pool)
+		writer.write_labels(labels)
 
 		if batch_num > 0 and batch_num % 10 == 0:
 			log(args, "%.2f%% (%d/%d) Batches" % (100. * batch_num / num_batches, batch_num, num_batches))
 
 	log(args, "Done Extracting activations")
 	log(args, "Closing Files")
-	label_fd.close()
-	for fd in fds.values():
-		fd.close()
+	writer.close()
 
 	log(args, "Closing LMDB")
 	env.close()
@@ -286,6 +314,44 @@ def get_all_ip_layer_names(model):
 	return [name for (layer, name) in zip(model.layers, model._layer_names) if layer.type == "InnerProduct"]
 
 
+def get_prunable_layer_names(layer_names, model, args):
+	all_ip_layer_names = get_all_ip_layer_names(model)
+	prunable = list()
+	for layer_name in layer_names:
+		if layer_name == all_ip_layer_names[0]:
+			log(args, "Skipping Layer %s.  Cannot prune input neurons" % layer_name)
+		elif layer_name not in all_ip_layer_names:
+			log(args, "Skipping Layer %s.  Not an InnerProduct Layer" % layer_name)
+		else:
+			prunable.append(layer_name)
+	# in network order, so that each layer is downstream of the ones pruned before it
+	prunable.sort(key=all_ip_layer_names.index)
+	return prunable
+
+
+def get_layer_blobs(layer_name, netspec, args):
+	'''
+	Returns the (bottom, top) blob names that prune_layer reads for layer_name
+	'''
+	layer_param = get_layer_param(layer_name, netspec)
+	if layer_param is None:
+		raise Exception("Layer %s does not exist in file %s" % (layer_name, args.network_file))
+	return layer_param.bottom[0], layer_param.top[0]
+
+
+def get_original_blobs(layer_names, netspec, args):
+	'''
+	Blobs to record from the unpruned model: the top of every layer to prune, and the bottom
+		of the first one, which is the only bottom that is unchanged by earlier pruning
+	'''
+	blob_names = [get_layer_blobs(layer_names[0], netspec, args)[0]]
+	for layer_name in layer_names:
+		top_blob_name = get_layer_blobs(layer_name, netspec, args)[1]
+		if top_blob_name not in blob_names:
+			blob_names.append(top_blob_name)
+	return blob_names
+
+
 def prune_prev_layer(cur_layer_name, neuron_indices_to_keep, model, netspec, args):
 	# reshape weights of previous layer
 	all_ip_layer_names = get_all_ip_layer_names(model)
@@ -328,21 +394,20 @@ def prune_layer(layer_name, model, netspec, original_activations_dir, current_ac
 	if layer_param is None:
 		raise Exception("Layer %s does not exist in file %s" % (layer_name, args.network_file))
 	bottom_blob_name = layer_param.bottom[0]
-	bottom_activations_file = os.path.join(current_activations_dir, "%s.txt" % bottom_blob_name)
-	bottom_activations = np.loadtxt(bottom_activations_file)
+	# memory mapped, and read a batch at a time
+	bottom_activations = load_activations(current_activations_dir, bottom_blob_name)
 	log(args, "Bottom shape: %s" % str(bottom_activations.shape))
 
 	top_blob_name = layer_param.top[0]
-	top_activations_file = os.path.join(original_activations_dir, "%s.txt" % top_blob_name)
-	top_activations = np.loadtxt(top_activations_file)
+	top_activations = load_activations(original_activations_dir, top_blob_name)
 	log(args, "Top shape: %s" % str(top_activations.shape))
 
-	# row = instance, col = neuron, so to get neuron similarity, we transpose
-	gram_matrix = gram(bottom_activations.transpose(), args)
-	log(args, "Gram Matrix shape: %s" % str(gram_matrix.shape))
-	neuron_indices_to_keep = sample_neurons(gram_matrix, args)
+	# row = instance, col = neuron
+	neuron_indices_to_keep = sample_neurons(bottom_activations, args)
 
-	weights, bias = update_weights(bottom_activations, neuron_indices_to_keep, top_activations)
+	start_time = time.time()
+	weights, bias = update_weights(bottom_activations, neuron_indices_to_keep, top_activations, args)
+	log(args, "Updated weights (%.2f s)" % (time.time() - start_time))
 	log(args, "New Weight shape: %s" % str(weights.shape))
 	log(args, "New Bias shape: %s" % str(bias.shape))
 
@@ -351,7 +416,46 @@ def prune_layer(layer_name, model, netspec, original_activations_dir, current_ac
 	layer.blobs[0].data[:] = weights[:]
 
 	prune_prev_layer(layer_name, neuron_indices_to_keep, model, netspec, args)
+	return neuron_indices_to_keep
+
 
+def reload_model(model, netspec, tmp_dir):
+	'''
+	Rebuilds the model from the pruned netspec and weights.  Layers cache the sizes of
+		their inputs and outputs when the net is set up, so a model pruned in place
+		cannot be run forward
+	'''
+	network_file = os.path.join(tmp_dir, "pruned.prototxt")
+	weight_file = os.path.join(tmp_dir, "pruned.caffemodel")
+	with open(network_file, 'w') as fd:
+		fd.write(str(netspec))
+	model.save(weight_file)
+	return caffe.Net(network_file, weight_file, caffe.TEST)
+
+
+def record_suffix_activations(model, layer_name, next_layer_name, netspec, bottom_activations,
+		neuron_indices_to_keep, out_dir, args):
+	'''
+	After pruning layer_name, records the bottom of next_layer_name by running only the
+		layers from layer_name up to next_layer_name.  The input of layer_name is the
+		cached bottom_activations with the pruned neurons removed, since the layers
+		before it only changed by dropping those neurons.
+	'''
+	start_ind = list(model._layer_names).index(layer_name)
+	end_ind = list(model._layer_names).index(next_layer_name) - 1
+	bottom_blob_name = get_layer_blobs(layer_name, netspec, args)[0]
+	next_bottom_blob_name = get_layer_blobs(next_layer_name, netspec, args)[0]
+	log(args, "Recording %s from layers %d-%d" % (next_bottom_blob_name, start_ind, end_ind))
+
+	num_images = bottom_activations.shape[0]
+	writer = ActivationWriter(out_dir, num_images, args.activation_dtype)
+	for start in xrange(0, num_images, args.batch_size):
+		batch = bottom_activations[start:start + args.batch_size][:,neuron_indices_to_keep]
+		model.blobs[bottom_blob_name].reshape(*batch.shape)
+		model.blobs[bottom_blob_name].data[...] = batch
+		model._forward(start_ind, end_ind)
+		record_blob_activation(model, next_bottom_blob_name, writer, args.spatial_pool)
+	writer.close()
 
 
 def main(args):
@@ -366,30 +470,30 @@ def main(args):
 	log(args, "Creating tmp dirs")
 	original_activations_dir, current_activations_dir = set_up_tmp_dirs()
 
+	log(args, "\nParsing network file")
+	netspec = load_net_spec(args)
+
+	layer_names = get_prunable_layer_names(get_layer_names(args, model), model, args)
+	log(args, "Pruning Layers: %r\n" % layer_names)
+	if not layer_names:
+		raise Exception("No layers to prune")
+
+	# only the blobs read by prune_layer are recorded
 	log(args, "Computing initial activations")
-	record_activations(model, original_activations_dir, args)
+	record_activations(model, original_activations_dir, get_original_blobs(layer_names, netspec, args), args)
 
 	# copy over the activations to avoid recomputing them
 	copy_files(original_activations_dir, current_activations_dir)
 
-	log(args, "\nParsing network file")
-	netspec = load_net_spec(args)
-
-	layer_names = get_layer_names(args, model)
-	all_ip_layer_names = get_all_ip_layer_names(model)
-	log(args, "Pruning Layers: %r\n" % layer_names)
-	first = True
-	for layer_name in layer_names:
-		if layer_name == all_ip_layer_names[0]:
-			log(args, "Skipping Layer %s.  Cannot prune input neurons" % layer_name)
-			continue
-		if layer_name not in all_ip_layer_names:
-			log(args, "Skipping Layer %s.  Not an InnerProduct Layer" % layer_name)
-			continue
-		if not first:
-			record_activations(model, current_activations_dir, args)
-		first = False
-		prune_layer(layer_name, model, netspec, original_activations_dir, current_activations_dir, args)
+	tmp_dir = os.path.dirname(original_activations_dir)
+	for idx, layer_name in enumerate(layer_names):
+		neuron_indices_to_keep = prune_layer(layer_name, model, netspec, original_activations_dir, current_activations_dir, args)
+		if idx + 1 < len(layer_names):
+			# only the layers from layer_name on are rerun for the next layer
+			model = reload_model(model, netspec, tmp_dir)
+			bottom_activations = load_activations(current_activations_dir, get_layer_blobs(layer_name, netspec, args)[0])
+			record_suffix_activations(model, layer_name, layer_names[idx + 1], netspec, bottom_activations,
+				neuron_indices_to_keep, current_activations_dir, args)
 
 	save_net_spec(netspec, args)
 	model.save(args.out_weight_file)
@@ -418,6 +522,19 @@ def get_args():
 				help="Log File")
 	parser.add_argument("--kernel", type=str, default='linear',
 				help="Kernel used to construct Gram Matrix")
+	parser.add_argument("--kernel-approx", type=str, default='none', choices=dpp_tools.APPROXIMATIONS,
+				help="Low rank approximation of the kernel, from random fourier features (rbf only) or the Nystrom method")
+	parser.add_argument("--num-features", type=int, default=1024,
+				help="Rank of the approximate kernel")
+	parser.add_argument("--sampler", type=str, default='dpp', choices=dpp_tools.SAMPLERS,
+				help="Sample neurons from the DPP, or greedily take the most diverse set (MAP inference)")
+	parser.add_argument("--seed", type=int, default=None,
+				help="Random seed for the kernel approximation and low rank sampling")
+	parser.add_argument("--solver", type=str, default='normal', choices=['normal', 'sklearn'],
+				help="Reconstruct the weights from normal equations accumulated over batches of images, " 
+				"or with sklearn on all activations in memory")
+	parser.add_argument("--ridge", type=float, default=0.,
+				help="Ridge (L2) regularization of the reconstructed weights")
 	parser.add_argument("-b", "--batch-size", default=64, type=int, 
 				help="Max number of images in a batch for activation extraction")
 	parser.add_argument("--print-count", default=1000, type=int, 
@@ -434,6 +551,11 @@ def get_args():
 				help="GPU to use for running the network")
 	parser.add_argument("--input-blob", type=str, default="data",
 				help="Name of input blob")
+	parser.add_argument("--activation-dtype", type=str, default="float32", choices=DTYPES,
+				help="Type of the recorded activations.  float16 halves the disk space and IO")
+	parser.add_argument("--spatial-pool", type=str, default="none", choices=['none', 'max', 'avg'],
+				help="Pool recorded blobs with spatial dimensions over them, instead of flattening each location.  " 
+				"Only for blobs whose consumers take one value per channel")
 
 	args = parser.parse_args()
 
@@ -0,0 +1,208 @@
+import itertools
+import threading
+import Queue
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+import cv2
+import lmdb
+import caffe.proto.caffe_pb2
+from utils import apply_all_transforms
+from lmdb_shards import get_shard_paths
+
+
+def decode_cv2(doc_datum, num_channels):
+	nparr = np.fromstring(doc_datum.image.data, np.uint8)
+	im = cv2.imdecode(nparr, int(num_channels == 3))
+	if im.ndim == 2:
+		# explicit single channel to match dimensions of color
+		im = im[:,:,np.newaxis]
+	return im
+
+
+# per-slice (num_channels, mean_vals, scale_val) from the delimited --channels, --means and --scales.
+# The last value is used for any remaining slices
+def get_slice_params(num_slices, args):
+	channel_tokens = args.channels.split(args.delimiter)
+	means_tokens = args.means.split(args.delimiter)
+	scale_tokens = args.scales.split(args.delimiter)
+
+	slice_params = list()
+	for slice_idx in xrange(num_slices):
+		num_channels = int(channel_tokens[min(slice_idx, len(channel_tokens) - 1)])
+		mean_str = means_tokens[min(slice_idx, len(means_tokens) - 1)]
+		mean_vals = np.asarray(map(int, mean_str.split(',')) if mean_str else [0], dtype=np.float32)
+		scale_val = float(scale_tokens[min(slice_idx, len(scale_tokens) - 1)])
+		slice_params.append( (num_channels, mean_vals, scale_val) )
+	return slice_params
+
+
+# Turns the serialized DocumentDatums of one record (one per slice) into an
+# NCHW float32 array with one image per transform.  Each slice is decoded,
+# transformed, scaled and shifted independently, then the slices are stacked
+# along channels.  Must be picklable to be used with a process pool.
+class DocDatumProcessor(object):
+
+	def __init__(self, slice_params, transforms=None, decode_fn=decode_cv2, transform_fn=apply_all_transforms):
+		self.slice_params = slice_params
+		self.transforms = transforms if transforms else ['none']
+		self.decode_fn = decode_fn
+		self.transform_fn = transform_fn
+
+	def __call__(self, values, keys):
+		doc_datum = caffe.proto.caffe_pb2.DocumentDatum()
+		ims_slice_transforms = list()
+		labels = list()
+		for slice_idx, value in enumerate(values):
+			num_channels, mean_vals, scale_val = self.slice_params[slice_idx]
+			doc_datum.ParseFromString(value)
+			labels.append(doc_datum.dbid)
+
+			im_slice = self.decode_fn(doc_datum, num_channels)
+			transformed = self.transform_fn(im_slice, self.transforms)
+			ims_slice_transforms.append([scale_val * (np.atleast_3d(im) - mean_vals) for im in transformed])
+
+		key, label = self.check_record(keys, labels)
+
+		# stack each set of slices (along channels) into a single array
+		num_transforms = len(ims_slice_transforms[0])
+		ims = np.asarray([np.concatenate([transforms[idx] for transforms in ims_slice_transforms], axis=2)
+			for idx in xrange(num_transforms)], dtype=np.float32)
+		return np.ascontiguousarray(ims.transpose(0, 3, 1, 2)), label, key
+
+	def check_record(self, keys, labels):
+		key = keys[0]
+		for slice_idx, _key in enumerate(keys):
+			if _key != key:
+				print "WARNING!, keys differ %s vs %s for slices %d and %d" % (key, _key, 0, slice_idx)
+		label = labels[0]
+		for slice_idx, _label in enumerate(labels):
+			if _label != label:
+				print "WARNING!, key %s has differing labels: %d vs %d for slices %d and %d" % (key, label, _label, 0, slice_idx)
+		return key, label
+
+
+# Iterates aligned lmdbs (one per image slice, each possibly sharded) and runs
+# process_fn on every record in a pool of background threads or processes.  At
+# most prefetch records are read ahead of the consumer, and results are yielded
+# in db order.
+class DocDatumReader(object):
+
+	def __init__(self, db_paths, process_fn, max_images=None, num_workers=4, prefetch=64, use_processes=False):
+		self.db_paths = db_paths
+		self.process_fn = process_fn
+		self.max_images = max_images
+		self.num_workers = num_workers
+		self.prefetch = max(prefetch, 1)
+		self.use_processes = use_processes
+
+	def num_entries(self):
+		total = 0
+		for path in get_shard_paths(self.db_paths[0]):
+			env = lmdb.open(path, readonly=True, map_size=int(2 ** 42))
+			total += env.stat()['entries']
+			env.close()
+		return total
+
+	def __len__(self):
+		num = self.num_entries()
+		return num if self.max_images is None else min(num, self.max_images)
+
+	# yields the serialized values and keys of each record, shard by shard.
+	# lmdb transactions are tied to the thread that opens them
+	def read_records(self):
+		num_read = 0
+		slice_shards = [get_shard_paths(path) for path in self.db_paths]
+		for shard_paths in zip(*slice_shards):
+			envs = [lmdb.open(path, readonly=True, map_size=int(2 ** 42)) for path in shard_paths]
+			txns = [env.begin(write=False) for env in envs]
+			try:
+				for entries in itertools.izip(*[txn.cursor().iternext() for txn in txns]):
+					if num_read == self.max_images:
+						return
+					num_read += 1
+					yield tuple(val for key, val in entries), tuple(key for key, val in entries)
+			finally:
+				for env, txn in zip(envs, txns):
+					txn.abort()
+					env.close()
+
+	def produce(self, pool, queue, stop):
+		try:
+			for values, keys in self.read_records():
+				if stop.is_set():
+					break
+				queue.put(pool.apply_async(self.process_fn, (values, keys)))
+		except Exception as e:
+			queue.put(e)
+		finally:
+			queue.put(None)
+
+	def __iter__(self):
+		if self.num_workers <= 0:
+			for values, keys in self.read_records():
+				yield self.process_fn(values, keys)
+			return
+
+		if self.use_processes:
+			pool = multiprocessing.Pool(self.num_workers)
+		else:
+			pool = multiprocessing.pool.ThreadPool(self.num_workers)
+		queue = Queue.Queue(self.prefetch)
+		stop = threading.Event()
+		producer = threading.Thread(target=self.produce, args=(pool, queue, stop))
+		producer.daemon = True
+		producer.start()
+		try:
+			while True:
+				result = queue.get()
+				if result is None:
+					break
+				if isinstance(result, Exception):
+					raise result
+				yield result.get()
+		finally:
+			# unblock the producer if iteration stopped early
+			stop.set()
+			while producer.is_alive():
+				try:
+					queue.get(timeout=0.1)
+				except Queue.Empty:
+					pass
+			pool.terminate()
+
+	# packs whole records into NCHW batches of at most batch_size images (unless one
+	# record has more).  A new batch is also started when the image shape changes.
+	# yields (batch, per-image labels, per-image keys)
+	def iter_batches(self, batch_size):
+		batch, labels, keys = list(), list(), list()
+		num_ims = 0
+		for ims, label, key in self:
+			if batch and (num_ims + len(ims) > batch_size or ims.shape[1:] != batch[0].shape[1:]):
+				yield np.concatenate(batch, axis=0), np.asarray(labels), keys
+				batch, labels, keys = list(), list(), list()
+				num_ims = 0
+			batch.append(ims)
+			labels.extend([label] * len(ims))
+			keys.extend([key] * len(ims))
+			num_ims += len(ims)
+		if batch:
+			yield np.concatenate(batch, axis=0), np.asarray(labels), keys
+
+
+def add_reader_args(parser):
+	group = parser.add_argument_group('Reader', 'Decoding of the lmdbs in the background')
+	group.add_argument("--workers", type=int, default=4,
+				help="Number of background threads (or processes) decoding and transforming images.  0 decodes in the main thread")
+	group.add_argument("--prefetch", type=int, default=64,
+				help="Max number of images decoded ahead of the network")
+	group.add_argument("--worker-processes", default=False, action="store_true",
+				help="Use processes instead of threads for decoding")
+	return group
+
+
+# db_str is a delimited list of aligned lmdbs, one per image slice
+def get_reader(db_str, args, transforms=None, max_images=None, processor_cls=DocDatumProcessor, **kwargs):
+	db_paths = db_str.split(args.delimiter)
+	process_fn = processor_cls(get_slice_params(len(db_paths), args), transforms, **kwargs)
+	return DocDatumReader(db_paths, process_fn, max_images, args.workers, args.prefetch, args.worker_processes)
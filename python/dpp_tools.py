@@ -0,0 +1,205 @@
+import numpy as np
+
+# Kernels between neurons, where neuron i is column i of an N x n matrix of
+# activations over N images, and DPP samplers for picking diverse neurons.
+#
+# Kernels that are functions of inner products are computed from the n x n
+# gram matrix A^T A, which is accumulated over batches of images.  For large n,
+# the rbf kernel can be approximated by n x D features F, K ~= F F^T, from random
+# Fourier features or the Nystrom method, which are also accumulated over
+# batches and let the samplers work without forming K
+KERNELS_FROM_GRAM = ['linear', 'rbf', 'poly', 'polynomial', 'cosine']
+APPROXIMATIONS = ['none', 'rff', 'nystrom']
+SAMPLERS = ['dpp', 'greedy']
+
+# number of images in each accumulated batch
+GRAM_BATCH_SIZE = 4096
+
+
+def iter_row_batches(mat, batch_size=GRAM_BATCH_SIZE):
+	for start in xrange(0, mat.shape[0], batch_size):
+		yield np.asarray(mat[start:start + batch_size], dtype=np.float64)
+
+
+class GramAccumulator(object):
+
+	def __init__(self, dim):
+		self.gram = np.zeros((dim, dim), dtype=np.float64)
+		self.num_rows = 0
+
+	def add(self, batch):
+		batch = np.asarray(batch, dtype=np.float64)
+		self.gram += np.dot(batch.T, batch)
+		self.num_rows += batch.shape[0]
+
+
+def accumulate_gram(mat, batch_size=GRAM_BATCH_SIZE):
+	acc = GramAccumulator(mat.shape[1])
+	for batch in iter_row_batches(mat, batch_size):
+		acc.add(batch)
+	return acc.gram
+
+
+# kernel values from the inner products of two sets of neurons, whose squared norms
+# are row_norms and col_norms (the diagonal of gram by default).  Same kernel
+# definitions as sklearn.metrics.pairwise_kernels, with polynomials of degree 3
+def kernel_from_gram(gram, kernel, gamma, row_norms=None, col_norms=None):
+	if row_norms is None:
+		row_norms = col_norms = np.diag(gram).copy()
+	if kernel == 'linear':
+		return gram
+	elif kernel == 'rbf':
+		sq_dists = row_norms[:,np.newaxis] + col_norms[np.newaxis,:] - 2 * gram
+		return np.exp(-gamma * np.maximum(sq_dists, 0))
+	elif kernel in ['poly', 'polynomial']:
+		return (gamma * gram + 1) ** 3
+	elif kernel == 'cosine':
+		norms = np.sqrt(np.outer(row_norms, col_norms))
+		return gram / np.where(norms > 0, norms, 1)
+	else:
+		raise Exception("Kernel %s cannot be computed from inner products" % kernel)
+
+
+# Random Fourier features of the rbf kernel exp(-gamma * |x - y|^2).  The projection
+# of the neurons onto num_features random directions in image space is accumulated
+# over batches of images, which are drawn in order from one seeded generator
+class RandomFeatureAccumulator(object):
+
+	def __init__(self, dim, num_features, gamma, seed=None):
+		self.rng = np.random.RandomState(seed)
+		self.scale = np.sqrt(2 * gamma)
+		self.proj = np.zeros((dim, num_features), dtype=np.float64)
+		self.offsets = self.rng.uniform(0, 2 * np.pi, num_features)
+
+	def add(self, batch):
+		directions = self.rng.normal(0, self.scale, (batch.shape[0], self.proj.shape[1]))
+		self.proj += np.dot(np.asarray(batch, dtype=np.float64).T, directions)
+
+	def features(self):
+		return np.sqrt(2. / self.proj.shape[1]) * np.cos(self.proj + self.offsets)
+
+
+# Nystrom features from the kernel between all neurons and num_features landmark
+# neurons, which needs only the n x m inner products with the landmarks
+class NystromAccumulator(object):
+
+	def __init__(self, dim, num_features, kernel, gamma, seed=None):
+		rng = np.random.RandomState(seed)
+		self.landmarks = np.sort(rng.choice(dim, min(num_features, dim), replace=False))
+		self.kernel = kernel
+		self.gamma = gamma
+		self.cross_gram = np.zeros((dim, len(self.landmarks)), dtype=np.float64)
+		self.norms = np.zeros(dim, dtype=np.float64)
+
+	def add(self, batch):
+		batch = np.asarray(batch, dtype=np.float64)
+		self.cross_gram += np.dot(batch.T, batch[:,self.landmarks])
+		self.norms += np.sum(batch ** 2, axis=0)
+
+	# K_nm K_mm^(-1/2), dropping the directions of K_mm with ~0 eigenvalues
+	def features(self):
+		k_nm = kernel_from_gram(self.cross_gram, self.kernel, self.gamma, self.norms, self.norms[self.landmarks])
+		eig_vals, eig_vecs = np.linalg.eigh(k_nm[self.landmarks])
+		keep = eig_vals > eig_vals.max() * 1e-10
+		return np.dot(k_nm, eig_vecs[:,keep] / np.sqrt(eig_vals[keep]))
+
+
+def approx_kernel_features(mat, kernel, gamma, approx, num_features, seed=None, batch_size=GRAM_BATCH_SIZE):
+	if approx == 'rff':
+		if kernel != 'rbf':
+			raise Exception("Random features are only for the rbf kernel, not %s" % kernel)
+		acc = RandomFeatureAccumulator(mat.shape[1], num_features, gamma, seed)
+	elif approx == 'nystrom':
+		acc = NystromAccumulator(mat.shape[1], num_features, kernel, gamma, seed)
+	else:
+		raise Exception("Unknown kernel approximation %s" % approx)
+	for batch in iter_row_batches(mat, batch_size):
+		acc.add(batch)
+	return acc.features()
+
+
+# Greedy MAP inference for a DPP (Chen et al. 2018): repeatedly adds the item that
+# most increases log det(L_Y), keeping an incremental Cholesky factor so that each
+# step costs O(n |Y|).  column(j) returns L[:,j].  With k = 0, stops once no item
+# increases the determinant, as a stand in for a variable sized sample
+def greedy_map_dpp(diag, column, k=0):
+	num = diag.shape[0]
+	max_size = k if k else num
+	factors = np.zeros((min(max_size, num), num), dtype=np.float64)
+	gains = np.asarray(diag, dtype=np.float64).copy()
+	selected = list()
+	while len(selected) < factors.shape[0]:
+		j = np.argmax(gains)
+		if gains[j] <= 1e-12 or (not k and gains[j] < 1):
+			break
+		m = len(selected)
+		e = (column(j) - np.dot(factors[:m,j], factors[:m])) / np.sqrt(gains[j])
+		factors[m] = e
+		gains -= e ** 2
+		gains[j] = -np.inf
+		selected.append(j)
+	return np.asarray(sorted(selected), dtype=np.int64)
+
+
+def greedy_map_dpp_kernel(L, k=0):
+	return greedy_map_dpp(np.diag(L), lambda j: L[:,j], k)
+
+
+def greedy_map_dpp_features(features, k=0):
+	return greedy_map_dpp(np.sum(features ** 2, axis=1), lambda j: np.dot(features, features[j]), k)
+
+
+# E[l, n] is the l-th elementary symmetric polynomial of the first n eigenvalues
+def elementary_symmetric_polynomials(eig_vals, k):
+	E = np.zeros((k + 1, len(eig_vals) + 1))
+	E[0] = 1
+	for l in xrange(1, k + 1):
+		for n in xrange(1, len(eig_vals) + 1):
+			E[l, n] = E[l, n - 1] + eig_vals[n - 1] * E[l - 1, n - 1]
+	return E
+
+
+# indices of the eigenvectors of an elementary DPP, for a DPP (k = 0) or a k-DPP
+def sample_eigenvectors(eig_vals, k, rng):
+	if not k:
+		return np.flatnonzero(rng.rand(len(eig_vals)) < eig_vals / (eig_vals + 1))
+	if k > np.count_nonzero(eig_vals > 0):
+		raise Exception("Cannot sample %d items from a kernel of rank %d" % (k, np.count_nonzero(eig_vals > 0)))
+	# the ratios below don't change with the scale of the eigenvalues
+	eig_vals = eig_vals / eig_vals.mean()
+	E = elementary_symmetric_polynomials(eig_vals, k)
+	selected = list()
+	l = k
+	for n in xrange(len(eig_vals), 0, -1):
+		if l == 0:
+			break
+		if n == l or rng.rand() < eig_vals[n - 1] * E[l - 1, n - 1] / E[l, n]:
+			selected.append(n - 1)
+			l -= 1
+	return np.asarray(selected, dtype=np.int64)
+
+
+# Exact sample of a DPP (or k-DPP) with kernel L = F F^T for n x D features F, from the
+# eigendecomposition of the D x D dual kernel F^T F (Kulesza and Taskar 2012)
+def sample_low_rank_dpp(features, k=0, rng=None):
+	if rng is None:
+		rng = np.random
+	eig_vals, eig_vecs = np.linalg.eigh(np.dot(features.T, features))
+	eig_vals = np.maximum(eig_vals, 0)
+	chosen = sample_eigenvectors(eig_vals, k, rng)
+	chosen = chosen[eig_vals[chosen] > 0]
+	# orthonormal eigenvectors of L
+	V = np.dot(features, eig_vecs[:,chosen] / np.sqrt(eig_vals[chosen]))
+
+	selected = list()
+	while V.shape[1] > 0:
+		probs = np.sum(V ** 2, axis=1)
+		i = rng.choice(V.shape[0], p=probs / probs.sum())
+		selected.append(i)
+		# project the basis onto the complement of e_i
+		j = np.argmax(np.abs(V[i]))
+		V = V - np.outer(V[:,j], V[i] / V[i, j])
+		V = np.delete(V, j, axis=1)
+		if V.shape[1] > 0:
+			V = np.linalg.qr(V)[0]
+	return np.asarray(sorted(selected), dtype=np.int64)
@@ -0,0 +1,601 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import argparse
+import collections
+import numpy as np
+import caffe
+import utils
+import skimage_transforms
+from doc_reader import DocDatumProcessor, decode_cv2, get_reader, add_reader_args
+from lmdb_shards import get_shard_paths
+
+# Evaluates a classifier on lmdbs of DocumentDatums, voting over several transforms
+# of each image.  caffe_test.py, caffe_test_skimage.py, caffe_test_multiple_ar.py and
+# clamm/clamm_test.py are this evaluator with different defaults.  The pluggable parts:
+#   backend: decodes and transforms the images of a record (see register_backend)
+#   iteration: 'aligned' reads the delimited lmdbs as slices of the same images,
+#              'per-lmdb' reads them one after the other (e.g. one lmdb per aspect ratio)
+#   weighting: how the transform votes of an image are combined.  'uniform', 'tuned'
+#              (per-transform weights from the --tune-lmdbs) or 'record' (weights
+#              produced by the backend for each record)
+
+# name -> (processor class, processor kwargs)
+BACKENDS = collections.OrderedDict([
+	('cv2', (DocDatumProcessor, dict(decode_fn=decode_cv2, transform_fn=utils.apply_all_transforms))),
+	('skimage', (DocDatumProcessor, dict(decode_fn=skimage_transforms.decode_skimage,
+		transform_fn=skimage_transforms.apply_all_transforms))),
+])
+ITERATIONS = ['aligned', 'per-lmdb']
+WEIGHTINGS = ['uniform', 'tuned', 'record']
+
+
+# processor_cls(slice_params, transforms, **kwargs) is called on the serialized
+# values and keys of each record and returns (ims, label, key), or (ims, label, key,
+# weights) for the 'record' weighting
+def register_backend(name, processor_cls=DocDatumProcessor, **kwargs):
+	BACKENDS[name] = (processor_cls, kwargs)
+
+
+def init_caffe(args):
+	if args.gpu >= 0:
+		caffe.set_mode_gpu()
+		caffe.set_device(args.gpu)
+	else:
+		caffe.set_mode_cpu()
+
+	caffenet = caffe.Net(args.caffe_model, args.caffe_weights, caffe.TEST)
+	return caffenet
+
+
+def log(args, s, newline=True):
+	print s
+	if args.log_file:
+		if not hasattr(args, 'log'):
+			args.log = open(args.log_file, 'w')
+		if newline:
+			args.log.write("%s\n" % s)
+		else:
+			args.log.write(s)
+
+
+def get_reader_for(db_str, transforms, max_images, args):
+	processor_cls, kwargs = BACKENDS[args.backend]
+	return get_reader(db_str, args, transforms, max_images, processor_cls=processor_cls, **kwargs)
+
+
+def iter_per_lmdb(db_str, transforms, max_images, args):
+	num_total = 0
+	for db_path in db_str.split(args.delimiter):
+		if num_total == max_images:
+			break
+		log(args, "Opening test lmdb %s" % db_path)
+		for record in get_reader_for(db_path, transforms, max_images - num_total, args):
+			num_total += 1
+			yield record
+
+
+# records of (ims, label, key[, weights]) from the delimited lmdbs of db_str
+def get_records(db_str, transforms, max_images, args):
+	if args.iteration == 'per-lmdb':
+		return iter_per_lmdb(db_str, transforms, max_images, args)
+	return get_reader_for(db_str, transforms, max_images, args)
+
+
+# ims is an NCHW array
+def fprop(caffenet, ims, batchsize=64):
+	# batch up all transforms at once
+	outputs = caffenet.forward_batched(ims, ["prob"], batchsize, "data", channels_last=False)["prob"]
+	if outputs.ndim > 2:
+		outputs = np.squeeze(outputs, axis=(2,3))
+	return outputs
+
+
+# Packs the transformed images of consecutive records into full batches, so the
+# batch size does not depend on the number of transforms.  records are tuples that
+# start with the NCHW images.  Yields the outputs of each record's images followed
+# by the rest of the record, in record order
+def fprop_records(caffenet, records, batchsize=64):
+	pending_ims = list()
+	num_pending = 0
+	pending_records = collections.deque()
+	outputs = np.zeros((0, 0), dtype=np.float32)
+
+	for record in records:
+		ims = record[0]
+		if pending_ims and ims.shape[1:] != pending_ims[0].shape[1:]:
+			# image size changed, so the partial batch goes through on its own
+			outputs = _append(outputs, fprop(caffenet, np.concatenate(pending_ims, axis=0), batchsize))
+			pending_ims, num_pending = list(), 0
+
+		pending_ims.append(ims)
+		num_pending += ims.shape[0]
+		pending_records.append( (ims.shape[0], tuple(record[1:])) )
+
+		if num_pending >= batchsize:
+			# only run full batches, the remainder waits for the next record
+			batch = np.concatenate(pending_ims, axis=0)
+			num_full = (num_pending // batchsize) * batchsize
+			outputs = _append(outputs, fprop(caffenet, batch[:num_full], batchsize))
+			pending_ims = [batch[num_full:]] if num_full < num_pending else list()
+			num_pending -= num_full
+
+		# hand back every record whose images have all been run
+		while pending_records and pending_records[0][0] <= outputs.shape[0]:
+			num_ims, rest = pending_records.popleft()
+			yield (outputs[:num_ims],) + rest
+			outputs = outputs[num_ims:]
+
+	if pending_ims:
+		outputs = _append(outputs, fprop(caffenet, np.concatenate(pending_ims, axis=0), batchsize))
+	for num_ims, rest in pending_records:
+		yield (outputs[:num_ims],) + rest
+		outputs = outputs[num_ims:]
+
+
+def _append(outputs, new_outputs):
+	if outputs.shape[0] == 0:
+		return new_outputs
+	return np.concatenate([outputs, new_outputs], axis=0)
+
+
+def get_vote_for_label(all_outputs, label, hard=False):
+	if hard:
+		# use 1/0 right or not
+		predictions = np.argmax(all_outputs, axis=1)
+		accuracy = np.zeros(shape=(all_outputs.shape[0],))
+		accuracy[predictions == label] = 1
+		return accuracy
+	else:
+		# use the probability of the correct label
+		return all_outputs[:, label]
+
+
+# per-transform weights from the outputs of the tune images
+def set_transform_weights(output_records, num_transforms, args):
+	weights = np.zeros(shape=(num_transforms,))
+	num_total = 0
+	for record in output_records:
+		all_outputs, label = record[:2]
+		if num_total % args.print_count == 0:
+			print "Tuned %d images" % num_total
+		num_total += 1
+
+		# get the per-transform vote for the correct label
+		weights += get_vote_for_label(all_outputs, label, args.hard_weights)
+
+	return weights / num_total
+
+
+def get_prob_cache_files(cache_dir, name):
+	base = os.path.join(cache_dir, name)
+	return base + ".json", base + ".probs", base + ".weights"
+
+
+# Caches the per-image, per-transform outputs of one pass (name is 'tune' or 'test'),
+# so that the votes can be recombined offline without running the network again.
+# name.probs holds the float32 outputs of all images back to back, name.weights the float64
+# per-image weights of the 'record' weighting, if any, and name.json the number of
+# outputs of each image, the labels and the keys.  name.json is written last, so a
+# cache without it is incomplete
+class ProbCacheWriter(object):
+
+	def __init__(self, cache_dir, name):
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		self.meta_file, self.probs_file, self.weights_file = get_prob_cache_files(cache_dir, name)
+		if os.path.exists(self.meta_file):
+			os.remove(self.meta_file)
+		self.probs_fd = open(self.probs_file, 'wb')
+		self.weights_fd = None
+		self.meta = {'num_output': None, 'counts': list(), 'labels': list(), 'keys': list()}
+
+	def add(self, record):
+		all_outputs, label, key = record[:3]
+		self.meta['num_output'] = all_outputs.shape[1]
+		self.meta['counts'].append(all_outputs.shape[0])
+		self.meta['labels'].append(int(label))
+		self.meta['keys'].append(key)
+		self.probs_fd.write(np.ascontiguousarray(all_outputs, dtype=np.float32).tostring())
+		if len(record) > 3:
+			if self.weights_fd is None:
+				self.weights_fd = open(self.weights_file, 'wb')
+			self.weights_fd.write(np.asarray(record[3], dtype=np.float64).tostring())
+
+	def close(self):
+		self.probs_fd.close()
+		if self.weights_fd is not None:
+			self.weights_fd.close()
+		self.meta['has_weights'] = self.weights_fd is not None
+		tmp_file = self.meta_file + ".tmp"
+		with open(tmp_file, 'w') as f:
+			json.dump(self.meta, f)
+		os.rename(tmp_file, self.meta_file)
+
+
+# passes the output records through, caching them with writer
+def cache_records(output_records, writer):
+	for record in output_records:
+		writer.add(record)
+		yield record
+	writer.close()
+
+
+# Returns the number of outputs per image and the output records of a cached pass
+def load_prob_cache(cache_dir, name):
+	meta_file, probs_file, weights_file = get_prob_cache_files(cache_dir, name)
+	if not os.path.exists(meta_file):
+		raise Exception("No complete %s outputs cached in %s" % (name, cache_dir))
+	meta = json.load(open(meta_file, 'r'))
+	num_output = meta['num_output']
+	counts = np.asarray(meta['counts'], dtype=np.int64)
+	offsets = np.concatenate([[0], np.cumsum(counts)])
+	if offsets[-1] == 0:
+		return num_output, iter([])
+	probs = np.memmap(probs_file, dtype=np.float32, mode='r', shape=(offsets[-1], num_output))
+	weights = np.memmap(weights_file, dtype=np.float64, mode='r') if meta['has_weights'] else None
+
+	def iter_records():
+		for idx, (label, key) in enumerate(zip(meta['labels'], meta['keys'])):
+			start, end = offsets[idx], offsets[idx + 1]
+			record = (np.array(probs[start:end]), label, str(key))
+			if weights is not None:
+				record += (np.array(weights[start:end]),)
+			yield record
+	return num_output, iter_records()
+
+
+def hash_file(md5, path):
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), ''):
+			md5.update(chunk)
+
+
+# args that change the network outputs of a pass over db_str
+CACHE_KEY_ARGS = ['channels', 'means', 'scales', 'delimiter', 'backend', 'iteration', 'max_images']
+
+# Content address of the outputs of a pass: the network definition and weights, the
+# path, size and modification time of every lmdb (shard) and the preprocessing
+def get_cache_key(db_str, transforms, args):
+	md5 = hashlib.md5()
+	hash_file(md5, args.caffe_model)
+	hash_file(md5, args.caffe_weights)
+	for db_path in db_str.split(args.delimiter):
+		for shard_path in get_shard_paths(db_path):
+			stat = os.stat(os.path.join(shard_path, "data.mdb"))
+			md5.update("%s %d %d" % (os.path.abspath(shard_path), stat.st_size, int(stat.st_mtime)))
+	md5.update("\n".join(transforms))
+	md5.update(json.dumps(dict( (key, getattr(args, key)) for key in CACHE_KEY_ARGS), sort_keys=True))
+	return md5.hexdigest()
+
+
+# (num_output, output records) for the images of db_str.  The output records are
+# (all_outputs, label, key[, weights]).  If args.offline, they are the outputs cached
+# by an earlier run with the same --prob-cache.  With a --cache-root, outputs cached
+# for the same network, lmdbs and preprocessing are reused and new ones are cached.
+# Otherwise get_net() runs the network
+def get_output_records(get_net, db_str, transforms, name, args):
+	if args.offline:
+		return load_prob_cache(args.prob_cache, name)
+
+	cache_dir = None
+	if args.cache_root:
+		cache_dir = os.path.join(args.cache_root, get_cache_key(db_str, transforms, args))
+		if os.path.exists(get_prob_cache_files(cache_dir, 'outputs')[0]):
+			log(args, "Using the outputs cached in %s" % cache_dir)
+			return load_prob_cache(cache_dir, 'outputs')
+
+	caffenet = get_net()
+	records = fprop_records(caffenet, get_records(db_str, transforms, args.max_images, args), args.batch_size)
+	if cache_dir:
+		records = cache_records(records, ProbCacheWriter(cache_dir, 'outputs'))
+	if args.prob_cache:
+		records = cache_records(records, ProbCacheWriter(args.prob_cache, name))
+	return caffenet.blobs["prob"].data.shape[1], records
+
+
+# Combines the per-transform outputs of one image.  Outputs of classes outside of
+# class_mask are zeroed first.  Returns the predicted label, the per-transform
+# predictions and the combined outputs
+def predict(all_outputs, weights=None, class_mask=None):
+	labels, all_predictions, mean_outputs = predict_batch(all_outputs[np.newaxis], weights, class_mask)
+	return labels[0], all_predictions[0], mean_outputs[0]
+
+
+# predict for B images with the same number of transforms T.  all_outputs is B x T x C
+# and weights are None, T per-transform weights or B x T per-image weights
+def predict_batch(all_outputs, weights=None, class_mask=None):
+	all_predictions = np.argmax(all_outputs, axis=2)
+	if class_mask is not None:
+		all_outputs = all_outputs * class_mask
+
+	if weights is None:
+		mean_outputs = np.mean(all_outputs, axis=1)
+	else:
+		weights = np.broadcast_to(weights, all_outputs.shape[:2])
+		mean_outputs = np.einsum('bt,btc->bc', weights, all_outputs)
+		totals = weights.sum(axis=1)
+		mean_outputs[totals > 0] /= totals[totals > 0, np.newaxis]
+	labels = np.argmax(mean_outputs, axis=1)
+	return labels, all_predictions, mean_outputs
+
+
+# "start,stop" -> mask of the classes in [start, stop)
+def get_class_mask(class_range, num_output):
+	if not class_range:
+		return None
+	start, stop = map(int, class_range.split(','))
+	class_mask = np.zeros(num_output)
+	class_mask[start:stop] = 1
+	return class_mask
+
+
+# number of classes scored above the true label of each image, so that the label is
+# in the top k if its rank is < k
+def get_label_ranks(mean_outputs, labels):
+	label_outputs = mean_outputs[np.arange(len(labels)), labels]
+	return np.sum(mean_outputs > label_outputs[:,np.newaxis], axis=1)
+
+
+# Metrics accumulated from batches of images
+class Results(object):
+
+	def __init__(self, num_output, num_transforms):
+		self.conf_mat = np.zeros(shape=(num_output, num_output), dtype=np.int)
+		self.rank_counts = np.zeros(shape=(num_output,), dtype=np.int)
+		self.num_total = 0
+		self.num_correct = 0
+		self.all_num_correct = np.zeros(shape=(num_transforms,))
+		self.all_mean_outputs = list()
+		self.all_labels = list()
+
+	# labels, predicted_labels and label_ranks have one entry per image.  all_predictions
+	# are the B x T per-transform predictions, which only count towards the per-transform
+	# accuracy if T is the number of transforms
+	def add(self, labels, predicted_labels, label_ranks, all_predictions):
+		np.add.at(self.conf_mat, (labels, predicted_labels), 1)
+		self.rank_counts += np.bincount(label_ranks, minlength=self.rank_counts.shape[0])
+		self.num_total += len(labels)
+		self.num_correct += np.count_nonzero(labels == predicted_labels)
+		if all_predictions.shape[1] == self.all_num_correct.shape[0]:
+			self.all_num_correct += np.sum(all_predictions == labels[:,np.newaxis], axis=0)
+
+	def overall_acc(self):
+		return float(self.num_correct) / max(self.num_total, 1)
+
+	def transform_accs(self):
+		return self.all_num_correct / max(self.num_total, 1)
+
+	def top_k_acc(self, k):
+		return float(self.rank_counts[:k].sum()) / max(self.num_total, 1)
+
+	def to_json(self, top_ks):
+		support = self.conf_mat.sum(axis=1)
+		num_predicted = self.conf_mat.sum(axis=0)
+		true_positives = np.diag(self.conf_mat)
+		precision = true_positives / np.maximum(num_predicted, 1).astype(float)
+		recall = true_positives / np.maximum(support, 1).astype(float)
+		classes = [{'class': c, 'support': int(support[c]), 'predicted': int(num_predicted[c]),
+					'precision': precision[c], 'recall': recall[c]}
+					for c in xrange(self.conf_mat.shape[0]) if support[c] or num_predicted[c]]
+		return {'num_total': self.num_total, 'num_correct': self.num_correct, 'accuracy': self.overall_acc(),
+				'top_k': dict( (str(k), self.top_k_acc(k)) for k in top_ks),
+				'transform_accuracy': list(self.transform_accs()), 'classes': classes}
+
+
+def write_metrics_json(results, args):
+	tmp_file = args.metrics_json + ".tmp"
+	with open(tmp_file, 'w') as f:
+		json.dump(results.to_json(map(int, args.top_k.split(','))), f, indent=1)
+	os.rename(tmp_file, args.metrics_json)
+
+
+def print_record(key, label, predicted_label, mean_outputs):
+	print key
+	print "%s: Actual: %d\tPrediction: %d" % ("Correct" if label == predicted_label else "Wrong", label, predicted_label)
+	_sorted = np.sort(mean_outputs)[::-1]
+	if predicted_label == label:
+		margin = _sorted[0] - _sorted[1]
+	else:
+		margin = mean_outputs[label] - _sorted[0]
+	print mean_outputs
+	print "margin: %.3f\n" % margin
+
+
+# number of images whose votes are combined and counted at once
+EVAL_BATCH_SIZE = 256
+
+def evaluate(output_records, num_output, num_transforms, weights, args):
+	class_mask = get_class_mask(args.class_range, num_output)
+	num_kept = int(args.class_range.split(',')[1]) if args.class_range else num_output
+	results = Results(num_output, num_transforms)
+	batch = list()
+
+	# images in a batch have the same number of transforms
+	def flush():
+		all_outputs = np.asarray([record[0] for record in batch])
+		labels = np.asarray([record[1] for record in batch])
+		if args.weighting == 'record':
+			batch_weights = np.asarray([record[3] for record in batch])
+		else:
+			batch_weights = weights
+		predicted_labels, all_predictions, mean_outputs = predict_batch(all_outputs, batch_weights, class_mask)
+		results.add(labels, predicted_labels, get_label_ranks(mean_outputs, labels), all_predictions)
+
+		if args.verbose:
+			for record, predicted_label, record_mean_outputs in zip(batch, predicted_labels, mean_outputs):
+				print_record(record[2], record[1], predicted_label, record_mean_outputs)
+		if args.out:
+			results.all_mean_outputs.extend(mean_outputs[:,:num_kept])
+			results.all_labels.extend(labels)
+		del batch[:]
+
+	num_seen = 0
+	for record in output_records:
+		if batch and (len(batch) == EVAL_BATCH_SIZE or record[0].shape[0] != batch[0][0].shape[0]):
+			flush()
+		if num_seen % args.print_count == 0:
+			print "Processed %d images" % num_seen
+			if args.metrics_json and results.num_total:
+				write_metrics_json(results, args)
+		num_seen += 1
+		batch.append(record)
+	if batch:
+		flush()
+	if args.metrics_json:
+		write_metrics_json(results, args)
+
+	return results
+
+
+def main(args):
+	log(args, str(sys.argv))
+
+	# load transforms from file
+	log(args, "Loading transforms")
+	transforms, fixed_transforms = utils.get_transforms(args.transform_file)
+	log(args, "Fixed Transforms: %s" % str(fixed_transforms))
+
+	# one network for both the tune and test passes, only loaded if some outputs are not cached
+	nets = list()
+	def get_net():
+		if not nets:
+			log(args, "Initializing network")
+			nets.append(init_caffe(args))
+		return nets[0]
+
+	# get per-transform weights.  Can be none if transforms produce variable numbers of images, or
+	# no lmdb is provided to tune the weights
+	weights = None
+	if args.weighting == 'tuned' and args.tune_lmdbs and fixed_transforms:
+		log(args, "Setting the transform weights...")
+		num_output, tune_records = get_output_records(get_net, args.tune_lmdbs, transforms, 'tune', args)
+		weights = set_transform_weights(tune_records, len(transforms), args)
+		weight_str = np.array_str(weights, max_line_width=80, precision=4) if weights is not None else str(weights)
+		log(args, "Weights: %s" % weight_str)
+
+	log(args, "Opening test lmdbs")
+	num_output, test_records = get_output_records(get_net, args.test_lmdbs, transforms, 'test', args)
+
+	try:
+		results = evaluate(test_records, num_output, len(transforms), weights, args)
+
+		log(args, "Done")
+		log(args, "Conf Mat:\n %r" % results.conf_mat)
+		log(args, "\nTransform Accuracy:\n %r" % results.transform_accs())
+		log(args, "\nCorrect/Total:\n %r/%r" % (results.num_correct, results.num_total))
+		log(args, "\nOverall Accuracy: %f" % results.overall_acc())
+
+		if args.out:
+			with open(args.out, 'wb') as fd:
+				pickle.dump( (results.all_mean_outputs, results.all_labels), fd)
+	finally:
+		if args.log_file:
+			args.log.close()
+
+
+def check_args(args):
+	num_tune_lmdbs = 0 if args.tune_lmdbs == "" else len(args.tune_lmdbs.split(args.delimiter))
+	num_test_lmdbs = 0 if args.test_lmdbs == "" else len(args.test_lmdbs.split(args.delimiter))
+	if num_test_lmdbs == 0:
+		raise Exception("No test lmdbs specified");
+	if args.offline and not args.prob_cache:
+		raise Exception("--offline needs the --prob-cache of an earlier run")
+	if args.backend not in BACKENDS:
+		raise Exception("Unknown backend %r, expected one of %r" % (args.backend, BACKENDS.keys()))
+	if args.iteration == 'per-lmdb':
+		# every lmdb is read as the only slice
+		num_test_lmdbs = 1
+	elif num_tune_lmdbs != 0 and num_tune_lmdbs != num_test_lmdbs:
+		raise Exception("Different number of tune and test lmdbs: %d vs %d" % (num_tune_lmdbs, num_test_lmdbs))
+
+	num_scales = len(args.scales.split(args.delimiter))
+	if num_scales != 1 and num_scales != num_test_lmdbs:
+		raise Exception("Different number of test lmdbs and scales: %d vs %d" % (num_test_lmdbs, num_scales))
+
+	num_means = len(args.means.split(args.delimiter))
+	if num_means != 1 and num_means != num_test_lmdbs:
+		raise Exception("Different number of test lmdbs and means: %d vs %d" % (num_test_lmdbs, num_means))
+
+	num_channels = len(args.channels.split(args.delimiter))
+	if num_channels != 1 and num_channels != num_test_lmdbs:
+		raise Exception("Different number of test lmdbs and channels: %d vs %d" % (num_test_lmdbs, num_channels))
+
+
+def get_parser(description="Classifies data"):
+	parser = argparse.ArgumentParser(description=description)
+	parser.add_argument("caffe_model",
+				help="The model definition file (e.g. deploy.prototxt)")
+	parser.add_argument("caffe_weights",
+				help="The model weight file (e.g. net.caffemodel)")
+	parser.add_argument("test_lmdbs",
+				help="LMDBs of test images (encoded DocDatums), files separated with :")
+
+	parser.add_argument("-m", "--means", type=str, default="",
+				help="Optional mean values per the channel (e.g. 127 for grayscale or 182,192,112 for BGR)")
+	parser.add_argument("--gpu", type=int, default=-1,
+				help="GPU to use for running the network")
+	parser.add_argument('-c', '--channels', default="0", type=str,
+				help='Number of channels to take from each slice')
+	parser.add_argument("-a", "--scales", type=str, default=str(1.0 / 255),
+				help="Optional scale factor")
+	parser.add_argument("-t", "--transform-file", "--transform_file", dest="transform_file", type=str, default="",
+				help="File containing transformations to do")
+	parser.add_argument("-l", "--tune-lmdbs", type=str, default="",
+				help="Tune the weighted averaging to minmize CE loss on this data")
+	parser.add_argument("-f", "--log-file", type=str, default="",
+				help="Log File")
+	parser.add_argument("-z", "--hard-weights", default=False, action="store_true",
+				help="Compute Transform weights using hard assignment")
+	parser.add_argument("--print-count", default=1000, type=int,
+				help="Print every print-count images processed")
+	parser.add_argument("--max-images", default=40000, type=int,
+				help="Max number of images for processing or tuning")
+	parser.add_argument("-d", "--delimiter", default=':', type=str,
+				help="Delimiter used for indicating multiple image slice parameters")
+	parser.add_argument("-b", "--batch-size", default=64, type=int,
+				help="Max number of images in a single batch.  Transforms of consecutive images share batches")
+
+	group = parser.add_argument_group('Evaluation', 'How images are read and votes are combined')
+	group.add_argument("--backend", type=str, default="cv2",
+				help="Image decoding and transforms: %s" % ", ".join(BACKENDS.keys()))
+	group.add_argument("--iteration", type=str, default="aligned", choices=ITERATIONS,
+				help="Read the lmdbs as aligned slices of each image, or one lmdb after the other")
+	group.add_argument("--weighting", type=str, default="tuned", choices=WEIGHTINGS,
+				help="Combine transform votes uniformly, with weights tuned on --tune-lmdbs, or with the backend's per-image weights")
+	group.add_argument("--class-range", type=str, default="",
+				help="start,stop.  Only classes in [start, stop) are voted for")
+	group.add_argument("-v", "--verbose", default=False, action="store_true",
+				help="Print the prediction and margin of every image")
+	group.add_argument("-o", "--out", default="", type=str,
+				help="Output pickle of the combined outputs and labels, for use in ensembling")
+	group.add_argument("--metrics-json", default="", type=str,
+				help="Output json of the accuracy, top-k accuracy, per-transform accuracy and per-class precision and recall.  Updated as images are processed")
+	group.add_argument("--top-k", default="1,5", type=str,
+				help="Comma separated k of the top-k accuracies in --metrics-json")
+
+	group = parser.add_argument_group('Caching', 'Recombine the transform votes without running the network again')
+	group.add_argument("-p", "--prob-cache", default="", type=str,
+				help="Directory where the per-image, per-transform outputs of the tune and test images are cached")
+	group.add_argument("--offline", default=False, action="store_true",
+				help="Evaluate the outputs in --prob-cache instead of running the network")
+	group.add_argument("--cache-root", default="", type=str,
+				help="Directory of outputs cached by network, lmdbs and preprocessing, which later runs reuse")
+	add_reader_args(parser)
+	return parser
+
+
+def get_args(parser=None):
+	if parser is None:
+		parser = get_parser()
+	args = parser.parse_args()
+
+	check_args(args)
+	return args
+
+
+if __name__ == "__main__":
+	args = get_args()
+	main(args)
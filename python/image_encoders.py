@@ -0,0 +1,115 @@
+import StringIO
+import numpy as np
+import cv2
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from PIL import Image
+
+BACKENDS = ['matplotlib', 'cv2', 'pil']
+
+
+# float images are assumed to be in [0,1] (skimage convention), integer images in [0,255]
+def to_ubyte(im):
+	if im.dtype == np.uint8:
+		return im
+	if np.issubdtype(im.dtype, np.floating):
+		im = np.round(im * 255)
+	return np.clip(im, 0, 255).astype(np.uint8)
+
+
+def is_jpeg(encoding):
+	return encoding.lower() in ['jpg', 'jpeg']
+
+
+def is_png(encoding):
+	return encoding.lower() == 'png'
+
+
+# Encodes an HxW or HxWxC image into the bytes stored in a DocumentDatum.
+# bgr indicates the channel order of color images (cv2 convention) vs RGB (skimage)
+class ImageEncoder(object):
+
+	def __init__(self, encoding, backend='matplotlib', bgr=False, jpeg_quality=95, png_compression=3):
+		if backend not in BACKENDS:
+			raise Exception("Unknown encoder backend: %r" % backend)
+		self.encoding = encoding
+		self.backend = backend
+		self.bgr = bgr
+		self.jpeg_quality = jpeg_quality
+		self.png_compression = png_compression
+
+	def encode(self, im):
+		if self.encoding == 'none':
+			return self.encode_raw(im)
+		if im.ndim == 3 and im.shape[2] == 1:
+			im = im[:,:,0]
+		if self.backend == 'cv2':
+			return self.encode_cv2(im)
+		elif self.backend == 'pil':
+			return self.encode_pil(im)
+		else:
+			return self.encode_matplotlib(im)
+
+	# unencoded channel x height x width bytes
+	def encode_raw(self, im):
+		pix = np.atleast_3d(to_ubyte(im)).transpose(2, 0, 1)
+		return pix.tostring()
+
+	def encode_cv2(self, im):
+		im = to_ubyte(im)
+		if im.ndim == 3 and not self.bgr:
+			im = im[:,:,::-1]
+		params = list()
+		if is_jpeg(self.encoding):
+			params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+		elif is_png(self.encoding):
+			params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+		success, buf = cv2.imencode('.' + self.encoding, im, params)
+		if not success:
+			raise Exception("cv2 could not encode image as %s" % self.encoding)
+		return buf.tostring()
+
+	def encode_pil(self, im):
+		im = to_ubyte(im)
+		if im.ndim == 3 and self.bgr:
+			im = im[:,:,::-1]
+		kwargs = dict()
+		if is_jpeg(self.encoding):
+			kwargs['quality'] = self.jpeg_quality
+			fmt = 'JPEG'
+		elif is_png(self.encoding):
+			kwargs['compress_level'] = self.png_compression
+			fmt = 'PNG'
+		else:
+			fmt = self.encoding.upper()
+		buf = StringIO.StringIO()
+		Image.fromarray(np.ascontiguousarray(im)).save(buf, format=fmt, **kwargs)
+		return buf.getvalue()
+
+	# the original encoding path.  Slow, as it goes through colormapping and writes RGBA
+	def encode_matplotlib(self, im):
+		if im.ndim == 3 and self.bgr:
+			im = im[:,:,::-1]
+		vmax = 1 if np.issubdtype(im.dtype, np.floating) else 255
+		buf = StringIO.StringIO()
+		if im.ndim == 2:
+			plt.imsave(buf, im, format=self.encoding, vmin=0, vmax=vmax, cmap='gray')
+		else:
+			plt.imsave(buf, im, format=self.encoding, vmin=0, vmax=vmax)
+		return buf.getvalue()
+
+
+def add_encoder_args(parser):
+	group = parser.add_argument_group('Encoder', 'How images are encoded in the DocumentDatums')
+	group.add_argument('--encoder', type=str, default='matplotlib', choices=BACKENDS,
+						help='Library used to encode images')
+	group.add_argument('--jpeg-quality', type=int, default=95,
+						help='JPEG quality (0-100).  Ignored by the matplotlib encoder')
+	group.add_argument('--png-compression', type=int, default=3,
+						help='PNG compression level (0-9).  Ignored by the matplotlib encoder')
+	return group
+
+
+def get_encoder(encoding, args, bgr=False):
+	return ImageEncoder(encoding, args.encoder, bgr, args.jpeg_quality, args.png_compression)
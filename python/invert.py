@@ -1,10 +1,11 @@
 #!/usr/bin/python
 
 import os
-import sys
+import argparse
 import numpy as np
 import caffe
 import cv2
+from tiling import TiledInference
 
 
 # acceptable image suffixes
@@ -19,151 +20,64 @@ PADDING_SIZE = 6
 # The larger the batch size, the more memory is consumed (both CPU and GPU)
 BATCH_SIZE=1
 
-LEFT_EDGE = -2
-TOP_EDGE = -1
-MIDDLE = 0
-RIGHT_EDGE = 1
-BOTTOM_EDGE = 2
-
 
 def setup_network(network, weights):
 	network = caffe.Net(network, weights, caffe.TEST)
 	return network
 
 
-def fprop(network, ims, batchsize=BATCH_SIZE):
-	# batch up all transforms at once
-	idx = 0
-	responses = list()
-	while idx < len(ims):
-		sub_ims = ims[idx:idx+batchsize]
-		network.blobs["data"].reshape(len(sub_ims), 3, ims[0].shape[0], ims[0].shape[1]) 
-		for x, im in enumerate(sub_ims):
-			transposed = np.transpose(im, [2,0,1])
-			transposed = transposed[np.newaxis, :, :, :]
-			network.blobs["data"].data[x,:,:,:] = transposed
-		idx += batchsize
-
-		# propagate on batch
-		network.forward()
-		output = np.copy(network.blobs["output"].data)
-		responses.append(output)
-		print "Progress %d%%" % int(100 * min(idx, len(ims)) / float(len(ims)))
-	return np.concatenate(responses, axis=0)
-
-
-def predict(network, ims):
-	all_outputs = fprop(network, ims)
-	predictions = 127.5 * (all_outputs + 1)
-	predictions = predictions.astype(np.uint8)
-	predictions = np.transpose(predictions, [0, 2, 3, 1])
-
-	return predictions
-
-
-def get_subwindows(im):
-	height, width, = TILE_SIZE, TILE_SIZE
-	y_stride, x_stride, = TILE_SIZE - (2 * PADDING_SIZE), TILE_SIZE - (2 * PADDING_SIZE)
-	if (height > im.shape[0]) or (width > im.shape[1]):
-		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
-		exit(1)
-	ims = list()
-	locations = list()
-	y = 0
-	y_done = False
-	while y  <= im.shape[0] and not y_done:
-		x = 0
-		if y + height > im.shape[0]:
-			y = im.shape[0] - height
-			y_done = True
-		x_done = False
-		while x <= im.shape[1] and not x_done:
-			if x + width > im.shape[1]:
-				x = im.shape[1] - width
-				x_done = True
-			locations.append( ((y, x, y + height, x + width), 
-					(y + PADDING_SIZE, x + PADDING_SIZE, y + y_stride, x + x_stride),
-					 TOP_EDGE if y == 0 else (BOTTOM_EDGE if y == (im.shape[0] - height) else MIDDLE),
-					  LEFT_EDGE if x == 0 else (RIGHT_EDGE if x == (im.shape[1] - width) else MIDDLE) 
-			) )
-			ims.append(im[y:y+height,x:x+width])
-			x += x_stride
-		y += y_stride
-
-	return locations, ims
-
-
-def stich_together(locations, subwindows, size):
-	output = np.zeros(size, dtype=np.uint8)
-	for location, subwindow in zip(locations, subwindows):
-		outer_bounding_box, inner_bounding_box, y_type, x_type = location
-		y_paste, x_paste, y_cut, x_cut, height_paste, width_paste = -1, -1, -1, -1, -1, -1
-
-		if y_type == TOP_EDGE:
-			y_cut = 0
-			y_paste = 0
-			height_paste = TILE_SIZE - PADDING_SIZE
-		elif y_type == MIDDLE:
-			y_cut = PADDING_SIZE
-			y_paste = inner_bounding_box[0]
-			height_paste = TILE_SIZE - 2 * PADDING_SIZE
-		elif y_type == BOTTOM_EDGE:
-			y_cut = PADDING_SIZE
-			y_paste = inner_bounding_box[0]
-			height_paste = TILE_SIZE - PADDING_SIZE
-
-		if x_type == LEFT_EDGE:
-			x_cut = 0
-			x_paste = 0
-			width_paste = TILE_SIZE - PADDING_SIZE
-		elif x_type == MIDDLE:
-			x_cut = PADDING_SIZE
-			x_paste = inner_bounding_box[1]
-			width_paste = TILE_SIZE - 2 * PADDING_SIZE
-		elif x_type == RIGHT_EDGE:
-			x_cut = PADDING_SIZE
-			x_paste = inner_bounding_box[1]
-			width_paste = TILE_SIZE - PADDING_SIZE
-
-		output[y_paste:y_paste+height_paste, x_paste:x_paste+width_paste] = subwindow[y_cut:y_cut+height_paste, x_cut:x_cut+width_paste]
-
-	return output
-	
-
-def main(network, weights, in_image, out_image):
-	image = cv2.imread(in_image, cv2.IMREAD_COLOR)
+def predict(output):
+	predictions = 127.5 * (output + 1)
+	return predictions.astype(np.uint8)
+
+
+def main(args):
+	image = cv2.imread(args.in_image, cv2.IMREAD_COLOR)
 	image = 0.0039 * (image - 127.)
 
-	network = setup_network(network, weights)
-	locations, subwindows = get_subwindows(image)
-	binarized_subwindows = predict(network, subwindows)
-	
-	result = stich_together(locations, binarized_subwindows, image.shape)
-	cv2.imwrite(out_image, result)
+	network = setup_network(args.network, args.weights)
+	engine = TiledInference(network, args.tile_size, args.pad, args.batch_size, "output",
+		stride=args.stride, blend=args.blend)
+	for _, image, output in engine.run([(args.in_image, image)]):
+		result = predict(output)
+		cv2.imwrite(args.out_image, result)
+	print engine.report()
+
+
+def get_args():
+	parser = argparse.ArgumentParser(description="Inverts an image with a fully convolutional network")
+	parser.add_argument("network",
+				help="The deploy.prototxt file")
+	parser.add_argument("weights",
+				help="The weights.caffemodel file")
+	parser.add_argument("in_image",
+				help="The input image to be inverted")
+	parser.add_argument("out_image",
+				help="Where the inverted image will be written to")
+	parser.add_argument("gpu", nargs='?', default=-1, type=int,
+				help="Device ID to run networks on the specified GPU.  If ommitted, CPU mode is used")
+
+	parser.add_argument("-b", "--batch-size", default=BATCH_SIZE, type=int,
+				help="Max number of tiles in a single batch")
+	parser.add_argument("-p", "--pad", default=PADDING_SIZE, type=int,
+				help="Padding size")
+	parser.add_argument("-t", "--tile-size", default=TILE_SIZE, type=int,
+				help="Size of tiles to extract")
+	parser.add_argument("--stride", default=0, type=int,
+				help="Offset between tiles.  Defaults to tile-size - 2 * pad.  Larger strides (up to tile-size) need --blend")
+	parser.add_argument("--blend", default=False, action='store_true',
+				help="Blend overlapping tiles with weights that fade out over the padding instead of cutting the padding off")
+	return parser.parse_args()
 
 
 if __name__ == "__main__":
-	if len(sys.argv) < 4:
-		print "USAGE: python invert.py network weights in_image out_image [gpu#]"
-		print "\tnetwork is the deploy.prototxt file"
-		print "\tweights is the weights.caffemodel file"
-		print "\tin_image is the input image to be inverted"
-		print "\tout_image is where the inverted image will be written to"
-		print "\tgpu is an integer device ID to run networks on the specified GPU.  If ommitted, CPU mode is used"
-		exit(1)
-	network = sys.argv[1]
-	weights = sys.argv[2]
-	in_image = sys.argv[3]
-	out_image = sys.argv[4]
+	args = get_args()
 
 	# use gpu if specified
-	try:
-		gpu = int(sys.argv[5])
-		if gpu >= 0:
-			caffe.set_mode_gpu()
-			caffe.set_device(gpu)
-	except:
+	if args.gpu >= 0:
+		caffe.set_mode_gpu()
+		caffe.set_device(args.gpu)
+	else:
 		caffe.set_mode_cpu()
 
-	main(network, weights, in_image, out_image)
-	
+	main(args)
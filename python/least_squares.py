@@ -0,0 +1,78 @@
+import numpy as np
+
+# Linear least squares Y ~= X W^T + b from the normal equations, which are
+# accumulated over batches of rows so that memory only depends on the number of
+# columns of X and Y, not on the number of rows
+BATCH_SIZE = 4096
+RCOND = 1e-10
+
+
+class NormalEquations(object):
+
+	def __init__(self, num_inputs, num_outputs):
+		self.xtx = np.zeros((num_inputs, num_inputs), dtype=np.float64)
+		self.xty = np.zeros((num_inputs, num_outputs), dtype=np.float64)
+		self.x_sum = np.zeros(num_inputs, dtype=np.float64)
+		self.y_sum = np.zeros(num_outputs, dtype=np.float64)
+		self.num_rows = 0
+		self.x_shift = None
+		self.y_shift = None
+
+	# rows are shifted by the means of the first batch, which keeps the accumulated
+	# sums of squares from swamping the centered ones for inputs with large means
+	def add(self, X, Y):
+		X = np.asarray(X, dtype=np.float64)
+		Y = np.asarray(Y, dtype=np.float64)
+		if Y.ndim == 1:
+			Y = Y[:,np.newaxis]
+		if self.x_shift is None:
+			self.x_shift = X.mean(axis=0)
+			self.y_shift = Y.mean(axis=0)
+		X = X - self.x_shift
+		Y = Y - self.y_shift
+		self.xtx += np.dot(X.T, X)
+		self.xty += np.dot(X.T, Y)
+		self.x_sum += X.sum(axis=0)
+		self.y_sum += Y.sum(axis=0)
+		self.num_rows += X.shape[0]
+
+	# Returns (W, b), W is num_outputs x num_inputs.  ridge penalizes |W|^2 but not
+	# the intercept.  Without it, rank deficient inputs (e.g. dead units) get the
+	# minimum norm solution, as with a least squares solver
+	def solve(self, ridge=0.):
+		if self.num_rows == 0:
+			raise Exception("No rows to solve for")
+		# center the accumulated (shifted) sums, which solves for the intercept
+		x_mean = self.x_sum / self.num_rows
+		y_mean = self.y_sum / self.num_rows
+		xtx = self.xtx - self.num_rows * np.outer(x_mean, x_mean)
+		xty = self.xty - self.num_rows * np.outer(x_mean, y_mean)
+		if ridge > 0:
+			xtx[np.diag_indices_from(xtx)] += ridge
+
+		W = None
+		try:
+			factor = np.linalg.cholesky(xtx)
+			# tiny pivots mean that xtx is (numerically) singular
+			if np.min(np.diag(factor)) ** 2 > RCOND * np.max(np.diag(xtx)):
+				W = np.linalg.solve(factor.T, np.linalg.solve(factor, xty))
+		except np.linalg.LinAlgError:
+			pass
+		if W is None:
+			W = np.linalg.lstsq(xtx, xty, rcond=RCOND)[0]
+		b = (y_mean + self.y_shift) - np.dot(x_mean + self.x_shift, W)
+		return W.T, b
+
+
+# Fits outputs ~= inputs[:,columns] W^T + b, reading inputs and outputs (e.g. memory
+# mapped activations) batch_size rows at a time
+def fit_least_squares(inputs, outputs, columns=None, ridge=0., batch_size=BATCH_SIZE):
+	num_inputs = inputs.shape[1] if columns is None else len(columns)
+	num_outputs = outputs.shape[1] if outputs.ndim > 1 else 1
+	equations = NormalEquations(num_inputs, num_outputs)
+	for start in xrange(0, inputs.shape[0], batch_size):
+		X = inputs[start:start + batch_size]
+		if columns is not None:
+			X = X[:,columns]
+		equations.add(X, outputs[start:start + batch_size])
+	return equations.solve(ridge)
@@ -0,0 +1,96 @@
+import os
+import json
+import zlib
+import collections
+import lmdb
+import caffe.proto.caffe_pb2
+
+# A sharded db is a directory holding shard_0 ... shard_{K-1} lmdbs, a
+# shard_<i>_index.json per shard and the merged index.json:
+#   {"num_shards": K, "method": ..., "shard_counts": [...], "class_counts": {dbid: count},
+#    "shard_class_counts": [{dbid: count}, ...], "key_ranges": [[first_key, last_key], ...]}
+# Keys are not listed individually, so the index stays small for large dbs
+INDEX_FILE = "index.json"
+SHARD_METHODS = ['hash', 'round-robin']
+
+
+# name is the part of the key that identifies the image, so hashing puts an image
+# in the same shard regardless of the manifest order
+def get_shard(x, name, num_shards, method='hash'):
+	if method == 'round-robin':
+		return x % num_shards
+	return (zlib.crc32(name) & 0xffffffff) % num_shards
+
+
+def get_shard_path(db_dir, shard):
+	return os.path.join(db_dir, "shard_%d" % shard)
+
+
+def get_shard_index_file(db_dir, shard):
+	return os.path.join(db_dir, "shard_%d_%s" % (shard, INDEX_FILE))
+
+
+def write_json(obj, out_file):
+	tmp_file = out_file + ".tmp"
+	with open(tmp_file, 'w') as f:
+		json.dump(obj, f)
+	os.rename(tmp_file, out_file)
+
+
+# scans a finished shard for its key range and per-class counts.  Shards that were
+# never written to are created empty so that readers see contiguous shards
+def build_shard_index(db_dir, shard, method):
+	env = lmdb.open(get_shard_path(db_dir, shard), map_size=int(2 ** 42))
+	count = 0
+	key_range = None
+	class_counts = collections.Counter()
+	doc_datum = caffe.proto.caffe_pb2.DocumentDatum()
+	with env.begin(write=False) as txn:
+		for key, val in txn.cursor():
+			doc_datum.ParseFromString(val)
+			# lmdb iterates in key order
+			key_range = [key, key] if key_range is None else [key_range[0], key]
+			count += 1
+			class_counts[doc_datum.dbid] += 1
+	env.close()
+
+	shard_index = {'shard': shard, 'method': method, 'count': count, 'class_counts': class_counts, 'key_range': key_range}
+	write_json(shard_index, get_shard_index_file(db_dir, shard))
+	return shard_index
+
+
+# Writes index.json once the index of every shard exists.  Returns True if it was written
+def merge_shard_index(db_dir, num_shards):
+	shard_files = [get_shard_index_file(db_dir, shard) for shard in xrange(num_shards)]
+	if not all(map(os.path.exists, shard_files)):
+		return False
+
+	index = {'num_shards': num_shards, 'shard_counts': list(), 'class_counts': collections.Counter(),
+			 'shard_class_counts': list(), 'key_ranges': list()}
+	for shard, shard_file in enumerate(shard_files):
+		shard_index = json.load(open(shard_file, 'r'))
+		index['method'] = shard_index['method']
+		index['shard_counts'].append(shard_index['count'])
+		index['shard_class_counts'].append(shard_index['class_counts'])
+		index['class_counts'].update(dict( (int(dbid), count) for dbid, count in shard_index['class_counts'].items()))
+		index['key_ranges'].append(shard_index['key_range'])
+	write_json(index, os.path.join(db_dir, INDEX_FILE))
+	return True
+
+
+def is_sharded(db_path):
+	return os.path.isdir(get_shard_path(db_path, 0))
+
+
+def load_shard_index(db_dir):
+	return json.load(open(os.path.join(db_dir, INDEX_FILE), 'r'))
+
+
+# the lmdbs that make up db_path, which is either a single lmdb or a sharded db
+def get_shard_paths(db_path):
+	if not is_sharded(db_path):
+		return [db_path]
+	paths = list()
+	while os.path.isdir(get_shard_path(db_path, len(paths))):
+		paths.append(get_shard_path(db_path, len(paths)))
+	return paths
@@ -2,11 +2,9 @@
 import os
 import re
 import sys
-import caffe  # must come before cv2
-import cv2
+import caffe  # must come before cv2 (imported by utils)
 import h5py
 import math
-import lmdb
 import errno
 import shutil
 import random
@@ -19,7 +17,8 @@ import numpy as np
 import scipy.ndimage
 import caffe.proto.caffe_pb2
 from caffe import layers as L, params as P
-from utils import get_transforms, apply_all_transforms, safe_mkdir
+from utils import get_transforms, safe_mkdir
+from doc_reader import get_reader, add_reader_args
 
 #LOSS_TYPES = ['l2', 'ce_soft', 'ce_hard']
 LOSS_TYPES = ['l2']
@@ -165,115 +164,18 @@ def log(args, s, newline=True):
 
 
 
-def open_dbs(db_paths):
-	dbs = list()
-	for path in db_paths:
-		env = lmdb.open(path, readonly=True, map_size=int(2 ** 42))
-		txn = env.begin(write=False)
-		cursor = txn.cursor()
-		cursor.first()
-		dbs.append( (env, txn, cursor) )
-	return dbs
-
-
-def close_dbs(dbs):
-	for env, txn, cursor in dbs:
-		txn.abort()
-		env.close()
-
-
+# ims is an NCHW array
 def fprop(model, ims, args):
 	# batch up all transforms at once
-	transposed = np.transpose(ims, [0,3,1,2])
-	model.blobs[args.input_blob].reshape(*transposed.shape)
-	model.blobs[args.input_blob].data[:,:,:,:] = transposed
+	model.blobs[args.input_blob].reshape(*ims.shape)
+	model.blobs[args.input_blob].data[...] = ims
 	model.forward()
 
 	
-def get_image(dd_serialized, slice_idx, args):
-	doc_datum = caffe.proto.caffe_pb2.DocumentDatum()
-	doc_datum.ParseFromString(dd_serialized)	
-
-	channel_tokens = args.channels.split(args.delimiter)
-	channel_idx = min(slice_idx, len(channel_tokens)-1)
-	num_channels = int(channel_tokens[channel_idx])
-
-	nparr = np.fromstring(doc_datum.image.data, np.uint8)
-	im = cv2.imdecode(nparr, int(num_channels == 3) )
-	if im.ndim == 2:
-		# explicit single channel to match dimensions of color
-		im = im[:,:,np.newaxis]
-	label = doc_datum.dbid
-	return im, label
-
-
-def scale_shift_im(im, slice_idx, args):
-
-	# find the correct mean values.  
-	means_tokens = args.means.split(args.delimiter)
-	mean_idx = min(slice_idx, len(means_tokens) - 1)
-	mean_vals = np.asarray(map(int, means_tokens[mean_idx].split(',')))
-
-	# find the correct scale value
-	scale_tokens = args.scales.split(args.delimiter)
-	scale_idx = min(slice_idx, len(scale_tokens) - 1)
-	scale_val = float(scale_tokens[scale_idx]) 
-
-	preprocessed_im = scale_val * (im - mean_vals)
-	return preprocessed_im
-
-
-def prepare_images(dbs, transforms, args):
-	ims_slice_transforms = list()
-	labels = list()
-	keys = list()
-
-	# apply the transformations to every slice of the image independently
-	for slice_idx, entry in enumerate(dbs):
-		env, txn, cursor = entry
-
-		im_slice, label_slice = get_image(cursor.value(), slice_idx, args)
-		cursor.next()
-		transformed_slices = apply_all_transforms(im_slice, transforms)
-		for transform_idx in xrange(len(transformed_slices)):
-			transformed_slices[transform_idx] = scale_shift_im(transformed_slices[transform_idx], slice_idx, args)
-
-		ims_slice_transforms.append(transformed_slices)
-		labels.append(label_slice)
-		keys.append(cursor.key())
-
-	# check that all keys match
-	key = keys[0]
-	for slice_idx, _key in enumerate(keys):
-		if _key != key:
-			log(args, "WARNING!, keys differ %s vs %s for slices %d and %d" % (key, _key, 0, slice_idx))
-
-	
-	# check that all labels match
-	label = labels[0]
-	for slice_idx, _label in enumerate(labels):
-		if _label != label:
-			log(args, "WARNING!, key %s has differing labels: %d vs %d for slices %d and %d" % (key, label, _label, 0, slice_idx))
-
-	# stack each set of slices (along channels) into a single numpy array
-	num_transforms = len(ims_slice_transforms[0])
-	num_slices = len(ims_slice_transforms)
-	ims = list()
-	for transform_idx in xrange(num_transforms):
-		im_slices = list()
-		for slice_idx in xrange(num_slices):
-			im_slice = ims_slice_transforms[slice_idx][transform_idx]
-			im_slices.append(np.atleast_3d(im_slice))
-		whole_im = np.concatenate(im_slices, axis=2) # append along channels
-		ims.append(whole_im)
-
-	return ims, label
-
-
 def get_activations(model, transforms, lmdb_files, args):
-	dbs = open_dbs(lmdb_files)
+	reader = get_reader(args.delimiter.join(lmdb_files), args, transforms, args.max_images)
 
-	num_images = min(args.max_images, dbs[0][0].stat()['entries'])
+	num_images = len(reader)
 	num_activations = model.blobs[args.blob].data.shape[1]
 	num_classes = model.blobs['prob'].data.shape[1]
 
@@ -282,8 +184,7 @@ def get_activations(model, transforms, lmdb_files, args):
 	classifications = {transform: np.zeros((num_images,))  for transform in transforms}
 	labels = list()
 	
-	for iter_num in xrange(num_images):
-		ims, label = prepare_images(dbs, transforms, args)
+	for iter_num, (ims, label, key) in enumerate(reader):
 		labels.append(label)
 
 		fprop(model, ims, args)
@@ -303,7 +204,6 @@ def get_activations(model, transforms, lmdb_files, args):
 			activations[transform] = activations[transform][p]
 			output_probs[transform] = output_probs[transform][p]
 			classifications[transform] = classifications[transform][p]
-	close_dbs(dbs)
 	return activations, output_probs, classifications, labels
 
 
@@ -771,6 +671,8 @@ def get_args():
 	parser.add_argument("--shuffle", default=False, action="store_true",
 				help="Name of blob on which to measure equivariance")
 
+	add_reader_args(parser)
+
 	args = parser.parse_args()
 	check_args(args)
 	args.train_batch_size = 1
@@ -0,0 +1,234 @@
+import math
+import random
+import StringIO
+import skimage
+import skimage.io
+import skimage.color
+import skimage.transform
+import scipy.ndimage.filters
+import numpy as np
+
+# skimage versions of the transforms in utils.py, for networks trained on images
+# decoded and augmented with skimage
+
+# "crop y x height width"
+def apply_crop(im, tokens):
+	y, x = int(tokens[1]), int(tokens[2])
+	height, width = int(tokens[3]), int(tokens[4])
+	if y >= im.shape[0] or x >= im.shape[1]:
+		print "Invalid crop: (y,x) outside image bounds (%r with %r)" % (im.shape, tokens)
+		exit(1)
+	if (y < 0 and y + height >= 0) or (x < 0 and x + width >= 0):
+		print "Invalid crop: negative indexing has wrap around (%r with %r)" % (im.shape, tokens)
+		exit(1)
+	if (height > im.shape[0]) or (width > im.shape[1]):
+		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
+		exit(1)
+	if (y + height > im.shape[0]) or (x + width > im.shape[1]):
+		print "Invalid crop: crop goes off edge of image (%r with %r)" % (im.shape, tokens)
+		exit(1)
+		
+	return im[y:y+height,x:x+width]
+
+def apply_dense_crop(im, tokens):
+	height, width, = int(tokens[1]), int(tokens[2])
+	y_stride, x_stride, = int(tokens[3]), int(tokens[4])
+	if (height > im.shape[0]) or (width > im.shape[1]):
+		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
+		exit(1)
+	ims = list()
+	y = 0
+	while (y + height) <= im.shape[0]:
+		x = 0
+		while (x + width) <= im.shape[1]:
+			ims.append(im[y:y+height,x:x+width])
+			x += x_stride
+		y += y_stride
+	
+	return ims
+
+def apply_rand_crop(im, tokens):
+	height, width = int(tokens[1]), int(tokens[2])
+	if (height > im.shape[0]) or (width > im.shape[1]):
+		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
+		exit(1)
+
+	y = random.randint(0, im.shape[0] - height)
+	x = random.randint(0, im.shape[1] - width)
+	return im[y:y+height,x:x+width]
+
+# "resize height width"
+def apply_resize(im, tokens):
+	size = int(tokens[1]), int(tokens[2])
+	return skimage.transform.resize(im, size, preserve_range=True, mode='reflect').astype(np.uint8)
+
+# "mirror {h,v,hv}"
+def apply_mirror(im, tokens):
+	if tokens[1] == 'h':
+		return np.fliplr(im)
+	elif tokens[1] == 'v':
+		return np.flipud(im)
+	elif tokens[1] == 'hv':
+		return np.fliplr(np.flipud(im))
+	else:
+		print "Unrecongized mirror operation %r" % tokens
+		exit(1)
+
+# "guassnoise seed sigma"
+def apply_gaussnoise(im, tokens):
+	seed, sigma = int(tokens[1]), float(tokens[2])
+	np.random.seed(seed)
+	noise = np.random.normal(0, sigma, im.shape[:2])
+	if len(im.shape) == 2:
+		im = (im + noise)
+	else:
+		im = (im + noise[:,:,np.newaxis])
+	im = np.clip(im, 0, 255)
+	im = im.astype(np.uint8)
+	return im
+
+# "rotation degree"
+def apply_rotation(im, tokens):
+	degree = float(tokens[1])
+	return skimage.img_as_ubyte(skimage.transform.rotate(im, degree))
+
+# ported from openCV imgproc/smooth.cpp
+def cv_gauss_1d_kernel(sigma, n):
+	kernel = [0.0] * n
+
+	scale2X = -0.5/(sigma*sigma);
+	_sum = 0
+	for i in xrange(n):
+		x = i - (n-1)*0.5
+		t = math.exp(scale2X * x * x)
+		kernel[i] = t
+		_sum += t
+	for i in xrange(n):
+		kernel[i] /= _sum
+
+	return kernel
+
+# "blur sigma"
+def apply_blur(im, tokens):
+	sigma = float(tokens[1])
+	size = int(sigma * 4 + .999)
+	if size % 2 == 0:
+		size += 1
+	kernel = cv_gauss_1d_kernel(sigma, size)
+	im2 = im.astype(float)
+	im2 = scipy.ndimage.filters.convolve1d(im2, kernel, axis=0)
+	im2 = scipy.ndimage.filters.convolve1d(im2, kernel, axis=1)
+	#float_response = skimage.filters.gaussian_filter(im, sigma, multichannel=True, mode='reflect')
+	return im2.astype(np.uint8) #skimage.img_as_ubyte(np.clip(float_response, -1, 1))
+	
+# "unsharpmask sigma amount"
+def apply_unsharpmask(im, tokens):
+	blurred = apply_blur(im, tokens)
+	amount = float(tokens[2])
+	sharpened = (1 + amount) * im + (-amount * blurred)
+	sharpened = np.clip(sharpened, 0, 255)
+	return sharpened.astype(np.uint8)
+
+# "shear degree {h,v}"
+def apply_shear(im, tokens):
+	degree = float(tokens[1])
+	radians = -1 * math.tan(degree * math.pi / 180)
+	shear_mat = np.array([ [1, 0, 0], [0, 1, 0], [0, 0, 1] ], dtype=np.float)
+	if tokens[2] == 'h':
+		shear_mat[0,1] = radians
+	elif tokens[2] == 'v':
+		shear_mat[1,0] = radians
+	else:
+		print "Invalid shear type: %r" % tokens
+	# the shear parameter of AffineTransform.__init__ doesn't specify x or y
+	tform = skimage.transform.AffineTransform(matrix=shear_mat)
+	return skimage.img_as_ubyte(skimage.transform.warp(im, tform))
+
+# "perspective dy1 dx1 dy2 dx2 dy3 dx3 dy4 dx4"
+def apply_perspective(im, tokens):
+	pts1 = np.array([[0,0],[1,0],[1,1],[0,1]], dtype=np.float32)
+	pts2 = np.array([[0 + float(tokens[1]) ,0 + float(tokens[2])],
+					   [1 + float(tokens[3]) ,0 + float(tokens[4])],
+					   [1 + float(tokens[5]) ,1 + float(tokens[6])],
+					   [0 + float(tokens[7]) ,1 + float(tokens[8])]
+					   ], dtype=np.float32)
+	tform = skimage.transform.ProjectiveTransform()
+	tform.estimate(pts2, pts1)
+	return skimage.img_as_ubyte(skimage.transform.warp(im, tform))
+
+
+def apply_transform(im, transform_str):
+	tokens = transform_str.split()
+	if tokens[0] == 'crop':
+		return apply_crop(im, tokens)
+	if tokens[0] == 'densecrop':
+		return apply_dense_crop(im, tokens)
+	if tokens[0] == 'randcrop':
+		return apply_rand_crop(im, tokens)
+	elif tokens[0] == 'resize':
+		return apply_resize(im, tokens)
+	elif tokens[0] == 'mirror':
+		return apply_mirror(im, tokens)
+	elif tokens[0] == 'gaussnoise':
+		return apply_gaussnoise(im, tokens)
+	elif tokens[0] == 'rotation':
+		return apply_rotation(im, tokens)
+	elif tokens[0] == 'blur':
+		return apply_blur(im, tokens)
+	elif tokens[0] == 'unsharpmask':
+		return apply_unsharpmask(im, tokens)
+	elif tokens[0] == 'shear':
+		return apply_shear(im, tokens)
+	elif tokens[0] == 'perspective':
+		return apply_perspective(im, tokens)
+	elif tokens[0] == 'none':
+		return im
+	else:
+		print "Unknown transform: %r" % transform_str
+		exit(1)
+
+# all transforms must yield images of the same dimensions
+def apply_transforms(im, multi_transform_str):
+	transform_strs = multi_transform_str.split(';')
+	for ts in transform_strs:
+		im = apply_transform(im, ts)
+	return im
+
+def apply_all_transforms(im, transform_strs):
+	ims = list()
+	for ts in transform_strs:
+		im_out = apply_transforms(im, ts)
+		if type(im_out) is list:
+			ims.extend(im_out)
+		else:
+			ims.append(im_out)
+	return ims
+
+
+def decode_skimage(doc_datum, num_channels):
+	# decode the image from the doc datum
+	string_fd = StringIO.StringIO(doc_datum.image.data)
+	im = skimage.img_as_ubyte(skimage.io.imread(string_fd))
+
+	# 0 for default, 1 for grayscale, 2 for abstract, 3 for RGB
+	num_cur_channels = im.shape[2] if len(im.shape) > 2 else 1
+
+	if num_channels != num_cur_channels and num_channels != 0:
+		if num_channels > 3:
+			raise Exception("Cannot request for more than 3 channels if not already supplied")
+		if num_cur_channels > num_channels:
+			if num_cur_channels > 2 and num_channels == 1:
+				# RGB -> Gray or RGBA -> Gray
+				im = skimage.img_as_ubyte(skimage.color.rgb2gray(im))
+			else:
+				# lop off excess channels (3,4 -> 2 or 4 -> 3)
+				im = im[:,:,num_channels]
+		else:
+			# num_cur_channels < num_channels
+			if num_cur_channels == 1:
+				im = skimage.img_as_ubyte(skimage.color.gray2rgb(im))
+				im = im[:,:,num_channels]
+			else:
+				raise Exception("How did we get here? (%d, %d)" % (num_channels, num_cur_channels))
+
+	return im
@@ -0,0 +1,219 @@
+import os
+import time
+import Queue
+import tempfile
+import threading
+import collections
+import numpy as np
+
+
+# start offsets of the tiles along one axis.  Tiles advance by stride and the
+# last tile is aligned with the end of the axis
+def get_tile_starts(length, tile_size, stride):
+	if tile_size > length:
+		raise Exception("Invalid crop: crop dims larger than image (%d with %d)" % (length, tile_size))
+	starts = np.arange(0, length - tile_size + 1, stride)
+	if starts[-1] + tile_size < length:
+		starts = np.append(starts, length - tile_size)
+	return starts
+
+
+# The (cut, paste, size) of each tile along one axis: tile[cut:cut+size] is pasted
+# at output[paste:paste+size].  The pad_size border of each tile is dropped, except
+# at the edges of the image
+def get_paste_params(starts, length, tile_size, pad_size):
+	first = starts == 0
+	last = starts == length - tile_size
+	cuts = np.where(first, 0, pad_size)
+	pastes = starts + cuts
+	sizes = tile_size - pad_size - np.where(first | last, 0, pad_size)
+	return cuts, pastes, sizes
+
+
+# (N, 6) array of (y, x, y_cut, x_cut, height, width) for the N tiles of an image,
+# in row major order.  The tile is image[y:y+tile_size,x:x+tile_size].  stride
+# defaults to tile_size - 2 * pad_size, so that the pasted tile centers cover the image
+def get_tiles(shape, tile_size, pad_size, stride=None):
+	if stride is None:
+		stride = tile_size - 2 * pad_size
+	ys = get_tile_starts(shape[0], tile_size, stride)
+	xs = get_tile_starts(shape[1], tile_size, stride)
+	y_cuts, y_pastes, heights = get_paste_params(ys, shape[0], tile_size, pad_size)
+	x_cuts, x_pastes, widths = get_paste_params(xs, shape[1], tile_size, pad_size)
+
+	y_idx, x_idx = np.meshgrid(np.arange(len(ys)), np.arange(len(xs)), indexing='ij')
+	y_idx, x_idx = y_idx.ravel(), x_idx.ravel()
+	return np.column_stack([ys[y_idx], xs[x_idx], y_cuts[y_idx], x_cuts[x_idx], heights[y_idx], widths[x_idx]])
+
+
+# Separable weights for blending overlapping tiles.  Weights ramp up linearly over
+# the ramp_size pixels at the tile border, where the network sees the least context
+def get_blend_window(tile_size, ramp_size):
+	ramp_size = max(ramp_size, 1)
+	dist = np.minimum(np.arange(1, tile_size + 1), np.arange(tile_size, 0, -1))
+	window = np.minimum(dist / float(ramp_size), 1).astype(np.float32)
+	return np.outer(window, window)
+
+
+# Iterates over items in a background thread, keeping at most size items ready
+def prefetch(items, size=2):
+	queue = Queue.Queue(max(size, 1))
+	done = object()
+	stop = threading.Event()
+
+	def produce():
+		try:
+			for item in items:
+				queue.put(item)
+				if stop.is_set():
+					break
+		except Exception as e:
+			queue.put(e)
+		finally:
+			queue.put(done)
+
+	producer = threading.Thread(target=produce)
+	producer.daemon = True
+	producer.start()
+	try:
+		while True:
+			item = queue.get()
+			if item is done:
+				break
+			if isinstance(item, Exception):
+				raise item
+			yield item
+	finally:
+		stop.set()
+		while producer.is_alive():
+			try:
+				queue.get(timeout=0.1)
+			except Queue.Empty:
+				pass
+
+
+class Page(object):
+
+	def __init__(self, page_id, image, tiles):
+		self.page_id = page_id
+		self.image = image
+		self.tiles = tiles
+		self.output = None
+		self.weights = None
+		self.num_remaining = len(tiles)
+
+
+# Runs a fully convolutional network over pages that are larger than its input
+# by cutting them into overlapping tile_size tiles.  Tiles from consecutive pages
+# share batches, so every forward pass but the last is a full batch_size, and the
+# tile outputs are pasted into an H x W x K output preallocated for each page.  If
+# memmap_dir is given, the outputs are memory mapped files in that directory,
+# which are unlinked right away and so are removed once the output is freed.
+#
+# By default the pad_size border of each tile is discarded and the centers are
+# pasted, which needs stride <= tile_size - 2 * pad_size.  With blend, whole tiles
+# are accumulated with a weight window that fades out over the pad_size border
+# and normalized by the total weight, which allows strides up to tile_size
+class TiledInference(object):
+
+	def __init__(self, network, tile_size, pad_size, batch_size, out_blob, in_blob="data",
+			dtype=np.float32, memmap_dir=None, stride=None, blend=False):
+		self.network = network
+		self.tile_size = tile_size
+		self.pad_size = pad_size
+		self.batch_size = batch_size
+		self.out_blob = out_blob
+		self.in_blob = in_blob
+		self.dtype = dtype
+		self.memmap_dir = memmap_dir
+		self.stride = stride if stride else tile_size - 2 * pad_size
+		self.blend = blend
+		if self.stride <= 0:
+			raise Exception("Tile stride must be positive: %d" % self.stride)
+		if not blend and self.stride > tile_size - 2 * pad_size:
+			raise Exception("Stride %d leaves gaps between tile centers, use a stride <= %d or blending" % (
+				self.stride, tile_size - 2 * pad_size))
+		if blend and self.stride > tile_size:
+			# pixels between tiles would get no weight (and a 0/0 output)
+			raise Exception("Stride %d leaves gaps between tiles, use a stride <= %d" % (self.stride, tile_size))
+		self.window = get_blend_window(tile_size, pad_size) if blend else None
+
+		self.num_tiles = 0
+		self.num_batches = 0
+		self.num_pages = 0
+		self.num_pixels = 0
+		self.elapsed = 0.
+
+	def alloc_output(self, shape):
+		if self.memmap_dir is None:
+			return np.zeros(shape, dtype=self.dtype)
+		fd, path = tempfile.mkstemp(suffix='.npy', dir=self.memmap_dir)
+		os.close(fd)
+		output = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+		os.remove(path)
+		return output
+
+	def paste(self, page, tile_idx, tile_output):
+		y, x, y_cut, x_cut, height, width = page.tiles[tile_idx]
+		if page.output is None:
+			page.output = self.alloc_output(page.image.shape[:2] + (tile_output.shape[0],))
+			if self.blend:
+				page.weights = np.zeros(page.image.shape[:2], dtype=np.float32)
+		if self.blend:
+			size = self.tile_size
+			page.output[y:y+size, x:x+size] += tile_output.transpose(1, 2, 0) * self.window[:,:,np.newaxis]
+			page.weights[y:y+size, x:x+size] += self.window
+		else:
+			page.output[y+y_cut:y+y_cut+height, x+x_cut:x+x_cut+width] = \
+				tile_output[:, y_cut:y_cut+height, x_cut:x_cut+width].transpose(1, 2, 0)
+
+	def finish(self, page):
+		if self.blend:
+			page.output /= page.weights[:,:,np.newaxis]
+			page.weights = None
+		self.num_pages += 1
+		self.num_pixels += page.image.shape[0] * page.image.shape[1]
+		return page.page_id, page.image, page.output
+
+	def run_batch(self, pending):
+		ims = [page.image[y:y+self.tile_size, x:x+self.tile_size] for page, tile_idx, y, x in pending]
+		outputs = self.network.forward_batched(ims, [self.out_blob], len(ims), self.in_blob)[self.out_blob]
+		self.num_batches += 1
+		self.num_tiles += len(ims)
+		for (page, tile_idx, y, x), tile_output in zip(pending, outputs):
+			self.paste(page, tile_idx, tile_output)
+			page.num_remaining -= 1
+
+	# pages is an iterable of (page_id, H x W x C image).  Yields (page_id, image, output)
+	# for each page, in order, once all of its tiles have been run
+	def run(self, pages):
+		pending = collections.deque()
+		in_flight = collections.deque()
+		start_time = time.time()
+		try:
+			for page_id, image in pages:
+				page = Page(page_id, image, get_tiles(image.shape, self.tile_size, self.pad_size, self.stride))
+				in_flight.append(page)
+				for tile_idx, (y, x) in enumerate(page.tiles[:, :2]):
+					pending.append( (page, tile_idx, y, x) )
+					if len(pending) == self.batch_size:
+						self.run_batch(pending)
+						pending.clear()
+
+				while in_flight and in_flight[0].num_remaining == 0:
+					yield self.finish(in_flight.popleft())
+
+			if pending:
+				self.run_batch(pending)
+			for page in in_flight:
+				yield self.finish(page)
+		finally:
+			self.elapsed += time.time() - start_time
+
+	# cost summary for picking the tile stride.  Wall time includes consuming the outputs
+	def report(self):
+		megapixels = self.num_pixels / 1e6
+		return "%d images (%.1f MP), %d tiles in %d batches, %.2f tiles/MP, %.1f s (%.2f s/image, %.2f s/MP)" % (
+			self.num_pages, megapixels, self.num_tiles, self.num_batches,
+			self.num_tiles / max(megapixels, 1e-9), self.elapsed,
+			self.elapsed / max(self.num_pages, 1), self.elapsed / max(megapixels, 1e-9))
@@ -3,7 +3,10 @@ import numpy as np
 import cv2
 import math
 import os
+import random
 import errno
+import threading
+import collections
 import scipy.ndimage
 
 
@@ -15,51 +18,104 @@ def safe_mkdir(_dir):
 			raise
 
 
+# Thread safe least recently used cache of the random fields used by the seeded
+# transforms.  Since the seed is part of the transform string, the field only
+# depends on the transform and the image shape.  Holds one field for each seeded
+# transform of the plans in use (see TransformPlan) and at most maxbytes in total,
+# so large images evict fields instead of using unbounded memory
+SEEDED_TRANSFORMS = ['salt', 'elastic', 'color_jitter', 'gaussnoise']
+FIELD_CACHE_BYTES = 256 * 1024 * 1024
+
+class FieldCache(object):
+
+	def __init__(self, maxsize=0, maxbytes=FIELD_CACHE_BYTES):
+		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.nbytes = 0
+		self.fields = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	# room for num fields, e.g. the number of seeded transforms of a plan
+	def reserve(self, num):
+		with self.lock:
+			self.maxsize = max(self.maxsize, num)
+
+	def get(self, tokens, shape, make_field):
+		key = (tuple(tokens), shape)
+		with self.lock:
+			if key in self.fields:
+				field = self.fields.pop(key)
+				self.fields[key] = field
+				return field
+
+		field = make_field()
+		arrs = field if type(field) is tuple else (field,)
+		for arr in arrs:
+			# shared between images, so must not be modified
+			arr.flags.writeable = False
+		nbytes = sum(arr.nbytes for arr in arrs)
+		with self.lock:
+			if key not in self.fields and nbytes <= self.maxbytes:
+				self.fields[key] = field
+				self.nbytes += nbytes
+			while self.fields and (len(self.fields) > self.maxsize or self.nbytes > self.maxbytes):
+				_, evicted = self.fields.popitem(last=False)
+				self.nbytes -= sum(arr.nbytes for arr in (evicted if type(evicted) is tuple else (evicted,)))
+		return field
+
+_field_cache = FieldCache()
+
+
+# "salt perc_pixels salt_perc seed"
+def make_salt_masks(shape, perc_pixels, salt_perc, seed):
+	rng = np.random.RandomState(seed)
+	flip_map = rng.uniform(0, 1, shape)
+	salt_map = rng.uniform(0, 1, shape)
+	salt_mask = np.logical_and(flip_map < perc_pixels, salt_map <= salt_perc)
+	pepper_mask = np.logical_and(flip_map < perc_pixels, salt_map > salt_perc)
+	return salt_mask, pepper_mask
+
+
 def apply_salt(im, tokens):
 	perc_pixels, salt_perc, seed = float(tokens[1]), float(tokens[2]), int(tokens[3])
-	np.random.seed(seed)
-
-	flip_map = np.random.uniform(0, 1, im.shape)
-	salt_map = np.random.uniform(0, 1, im.shape)
+	salt_mask, pepper_mask = _field_cache.get(tokens, im.shape,
+		lambda: make_salt_masks(im.shape, perc_pixels, salt_perc, seed))
 
 	out = np.copy(im)
-	out[np.logical_and(flip_map < perc_pixels, salt_map <= salt_perc)] = 255  # salt
-	out[np.logical_and(flip_map < perc_pixels, salt_map > salt_perc)] = 0     # pepper
+	out[salt_mask] = 255  # salt
+	out[pepper_mask] = 0  # pepper
 
 	return out
 
 
-def apply_elastic_deformation(im, tokens):
-	sigma, alpha, seed = float(tokens[1]), float(tokens[2]), int(tokens[3])
-	np.random.seed(seed)
-
-	displacement_x = np.random.uniform(-1 * alpha, alpha, im.shape[:2])
-	displacement_y = np.random.uniform(-1 * alpha, alpha, im.shape[:2])
+# "elastic sigma alpha seed"
+def make_elastic_coords(shape, sigma, alpha, seed):
+	rng = np.random.RandomState(seed)
+	displacement_x = rng.uniform(-1 * alpha, alpha, shape[:2])
+	displacement_y = rng.uniform(-1 * alpha, alpha, shape[:2])
 
 	displacement_x = scipy.ndimage.gaussian_filter(displacement_x, sigma, truncate=2)
 	displacement_y = scipy.ndimage.gaussian_filter(displacement_y, sigma, truncate=2)
 
-	coords_y = np.asarray( [ [y] * im.shape[1] for y in xrange(im.shape[0]) ])
-	coords_y = np.clip(coords_y + displacement_y, 0, im.shape[0])
-
-	coords_x = np.transpose(np.asarray( [ [x] * im.shape[0] for x in xrange(im.shape[1]) ] ))
-	coords_x = np.clip(coords_x + displacement_x, 0, im.shape[1])
+	coords_y, coords_x = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+	coords_y = np.clip(coords_y + displacement_y, 0, shape[0])
+	coords_x = np.clip(coords_x + displacement_x, 0, shape[1])
 
 	# the backwards mapping function, which assures that all coords are in
 	# the range of the input
-	if im.ndim == 3:
-		coords_y = coords_y[:,:,np.newaxis]
-		coords_y = np.concatenate(im.shape[2] * [coords_y], axis=2)[np.newaxis,:,:,:]
+	if len(shape) == 3:
+		coords = np.empty((3,) + shape)
+		coords[0] = coords_y[:,:,np.newaxis]
+		coords[1] = coords_x[:,:,np.newaxis]
+		coords[2] = np.arange(shape[2])
+	else:
+		coords = np.array([coords_y, coords_x])
+	return coords
 
-		coords_x = coords_x[:,:,np.newaxis]
-		coords_x = np.concatenate(im.shape[2] * [coords_x], axis=2)[np.newaxis,:,:,:]
 
-		coords_d = np.zeros_like(coords_x)
-		for x in xrange(im.shape[2]):
-			coords_d[:,:,:,x] = x
-		coords = np.concatenate( (coords_y, coords_x, coords_d), axis=0)
-	else:
-		coords = np.concatenate( (coords_y[np.newaxis,:,:], coords_x[np.newaxis,:,:]), axis=0)
+def apply_elastic_deformation(im, tokens):
+	sigma, alpha, seed = float(tokens[1]), float(tokens[2]), int(tokens[3])
+	coords = _field_cache.get(tokens, im.shape, lambda: make_elastic_coords(im.shape, sigma, alpha, seed))
 
 	## first order spline interpoloation (bilinear?) using the backwards mapping
 	output = scipy.ndimage.map_coordinates(im, coords, order=1, mode='reflect')
@@ -107,22 +163,34 @@ def apply_corner_crop(im, tokens):
 	return apply_crop(im, ("crop %d %d %d %d" % (y, x, height, width)).split())
 
 
-def apply_dense_crop(im, tokens):
+# (y, x) of the crops of "densecrop height width y_stride x_stride [snap]" on an image
+# of shape.  With snap, the last row and column of crops are moved to the image edge
+# once the next stride would run past it, so the whole image is covered
+def get_dense_crop_positions(shape, tokens):
 	height, width, = int(tokens[1]), int(tokens[2])
 	y_stride, x_stride, = int(tokens[3]), int(tokens[4])
-	if (height > im.shape[0]) or (width > im.shape[1]):
-		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
-		exit(1)
-	ims = list()
+	snap = len(tokens) > 5 and tokens[5] == 'snap'
+	positions = list()
 	y = 0
-	while (y + height) <= im.shape[0]:
+	while (y + height) <= shape[0]:
+		if snap and (y + height + y_stride) > shape[0]:
+			y = shape[0] - height
 		x = 0
-		while (x + width) <= im.shape[1]:
-			ims.append(im[y:y+height,x:x+width])
+		while (x + width) <= shape[1]:
+			if snap and (x + width + x_stride) > shape[1]:
+				x = shape[1] - width
+			positions.append( (y, x) )
 			x += x_stride
 		y += y_stride
-	
-	return ims
+	return positions
+
+
+def apply_dense_crop(im, tokens):
+	height, width, = int(tokens[1]), int(tokens[2])
+	if (height > im.shape[0]) or (width > im.shape[1]):
+		print "Invalid crop: crop dims larger than image (%r with %r)" % (im.shape, tokens)
+		exit(1)
+	return [im[y:y+height,x:x+width] for y, x in get_dense_crop_positions(im.shape, tokens)]
 
 def apply_rand_crop(im, tokens):
 	height, width = int(tokens[1]), int(tokens[2])
@@ -139,6 +207,13 @@ def apply_resize(im, tokens):
 	size = int(tokens[2]), int(tokens[1])
 	return cv2.resize(im, size)
 
+# "resize2 scale_factor"
+def apply_resize2(im, tokens):
+	scale_factor = float(tokens[1])
+	new_height = int(scale_factor * im.shape[0])
+	new_width = int(scale_factor * im.shape[1])
+	return cv2.resize(im, (new_width, new_height))
+
 # "mirror {h,v,hv}"
 def apply_mirror(im, tokens):
 	if tokens[1] == 'h':
@@ -164,26 +239,36 @@ def apply_shift(im, tokens):
 	return im
 
 
+# "color_jitter sigma seed"
+def make_color_jitter(num_channels, sigma, seed):
+	rng = np.random.RandomState(seed)
+	return np.array([int(rng.normal(0, sigma)) for c in xrange(num_channels)])
+
+
 def apply_color_jitter(im, tokens):
 	sigma, seed = float(tokens[1]), int(tokens[2])
-	np.random.seed(seed)
+	num_channels = 1 if im.ndim == 2 else im.shape[2]
+	jitter = _field_cache.get(tokens, num_channels, lambda: make_color_jitter(num_channels, sigma, seed))
 	im = im.astype(int)  # protect against over-flow wrapping
-	if im.shape == 2:
-		im = im + int(np.random.normal(0, sigma))
+	if im.ndim == 2:
+		im = im + jitter[0]
 	else:
-		for c in xrange(im.shape[2]):
-			im[:,:,c] = im[:,:,c] + int(np.random.normal(0, sigma))
-	
+		im = im + jitter
+
 	# truncate back to image range
 	im = np.clip(im, 0, 255)
 	im = im.astype(np.uint8) 
 	return im
 
 # "guassnoise sigma seed"
+def make_gaussnoise(shape, sigma, seed):
+	rng = np.random.RandomState(seed)
+	return rng.normal(0, sigma, shape[:2])
+
+
 def apply_gaussnoise(im, tokens):
 	sigma, seed = float(tokens[1]), int(tokens[2])
-	np.random.seed(seed)
-	noise = np.random.normal(0, sigma, im.shape[:2])
+	noise = _field_cache.get(tokens, im.shape[:2], lambda: make_gaussnoise(im.shape, sigma, seed))
 	if len(im.shape) == 2:
 		im = (im + noise)
 	else:
@@ -240,44 +325,35 @@ def apply_perspective(im, tokens):
 	return cv2.warpPerspective(im, M, (im.shape[1], im.shape[0]))
 
 
+TRANSFORM_FNS = {
+	'crop': apply_crop,
+	'corner_crop': apply_corner_crop,
+	'densecrop': apply_dense_crop,
+	'randcrop': apply_rand_crop,
+	'resize': apply_resize,
+	'resize2': apply_resize2,
+	'mirror': apply_mirror,
+	'gaussnoise': apply_gaussnoise,
+	'rotation': apply_rotation,
+	'blur': apply_blur,
+	'unsharpmask': apply_unsharpmask,
+	'unsharp': apply_unsharpmask,
+	'shear': apply_shear,
+	'perspective': apply_perspective,
+	'color_jitter': apply_color_jitter,
+	'salt': apply_salt,
+	'shift': apply_shift,
+	'elastic': apply_elastic_deformation,
+}
+
+
 def apply_transform(im, transform_str):
 	tokens = transform_str.split()
-	if tokens[0] == 'crop':
-		return apply_crop(im, tokens)
-	if tokens[0] == 'corner_crop':
-		return apply_corner_crop(im, tokens)
-	if tokens[0] == 'densecrop':
-		return apply_dense_crop(im, tokens)
-	if tokens[0] == 'randcrop':
-		return apply_rand_crop(im, tokens)
-	elif tokens[0] == 'resize':
-		return apply_resize(im, tokens)
-	elif tokens[0] == 'mirror':
-		return apply_mirror(im, tokens)
-	elif tokens[0] == 'gaussnoise':
-		return apply_gaussnoise(im, tokens)
-	elif tokens[0] == 'rotation':
-		return apply_rotation(im, tokens)
-	elif tokens[0] == 'blur':
-		return apply_blur(im, tokens)
-	elif tokens[0] == 'unsharpmask' or tokens[0] == 'unsharp':
-		return apply_unsharpmask(im, tokens)
-	elif tokens[0] == 'shear':
-		return apply_shear(im, tokens)
-	elif tokens[0] == 'perspective':
-		return apply_perspective(im, tokens)
-	elif tokens[0] == 'color_jitter':
-		return apply_color_jitter(im, tokens)
-	elif tokens[0] == 'salt':
-		return apply_salt(im, tokens)
-	elif tokens[0] == 'shift':
-		return apply_shift(im, tokens)
-	elif tokens[0] == 'elastic':
-		return apply_elastic_deformation(im, tokens)
-	elif tokens[0] == 'none':
+	if tokens[0] == 'none':
 		return im
-	else:
+	if tokens[0] not in TRANSFORM_FNS:
 		raise Exception("Unknown transform: %r" % transform_str)
+	return TRANSFORM_FNS[tokens[0]](im, tokens)
 
 
 # all transforms must yield images of the same dimensions
@@ -288,15 +364,227 @@ def apply_transforms(im, multi_transform_str):
 	return im
 
 
-def apply_all_transforms(im, transform_strs):
-	ims = list()
-	for ts in transform_strs:
-		im_out = apply_transforms(im, ts)
-		if type(im_out) is list:
-			ims.extend(im_out)
+# A single parsed transform (e.g. "blur 1.5").  key identifies the sequence of
+# transforms that produced its output, so that plans can share common prefixes
+class Transform(object):
+	geometric = False
+	deterministic = True
+
+	def __init__(self, tokens, key):
+		self.tokens = tokens
+		self.key = key
+		self.fn = TRANSFORM_FNS[tokens[0]]
+
+	def __call__(self, im):
+		return self.fn(im, self.tokens)
+
+
+class RandomTransform(Transform):
+	deterministic = False
+
+
+# Transforms that are a warp of the image coordinates.  get_matrix() gives the
+# 3x3 matrix mapping input (x, y) to output (x, y) and the output (height, width)
+class GeometricTransform(Transform):
+	geometric = True
+
+	def get_matrix(self, shape):
+		raise NotImplementedError
+
+
+class MirrorTransform(GeometricTransform):
+
+	def __init__(self, tokens, key):
+		if tokens[1] not in ['h', 'v', 'hv']:
+			raise Exception("Unrecongized mirror operation %r" % tokens)
+		super(MirrorTransform, self).__init__(tokens, key)
+
+	# a flipped view instead of a copy.  Only used for the last step of a pipeline, as the
+	# negative strides are not accepted by every cv2 function
+	def view(self, im):
+		if im.ndim == 3 and im.shape[2] == 1:
+			# match cv2.flip
+			im = im[:,:,0]
+		if self.tokens[1] == 'h':
+			return im[::-1]
+		elif self.tokens[1] == 'v':
+			return im[:,::-1]
+		return im[::-1,::-1]
+
+	def get_matrix(self, shape):
+		M = np.eye(3)
+		if 'h' in self.tokens[1]:
+			M[1,1], M[1,2] = -1, shape[0] - 1
+		if 'v' in self.tokens[1]:
+			M[0,0], M[0,2] = -1, shape[1] - 1
+		return M, shape[:2]
+
+
+class RotationTransform(GeometricTransform):
+
+	def get_matrix(self, shape):
+		center = (shape[0] / 2, shape[1] / 2)
+		rot_mat = cv2.getRotationMatrix2D(center, float(self.tokens[1]), 1.0)
+		return np.vstack([rot_mat, [0, 0, 1]]), shape[:2]
+
+
+class ShearTransform(GeometricTransform):
+
+	def __init__(self, tokens, key):
+		if tokens[2] not in ['h', 'v']:
+			raise Exception("Invalid shear type: %r" % tokens)
+		super(ShearTransform, self).__init__(tokens, key)
+
+	def get_matrix(self, shape):
+		M = np.eye(3)
+		radians = math.tan(float(self.tokens[1]) * math.pi / 180)
+		if self.tokens[2] == 'h':
+			M[0,1] = radians
 		else:
-			ims.append(im_out)
-	return ims
+			M[1,0] = radians
+		return M, shape[:2]
+
+
+class PerspectiveTransform(GeometricTransform):
+
+	def get_matrix(self, shape):
+		pts1 = np.array([[0,0],[1,0],[1,1],[0,1]], dtype=np.float32)
+		offsets = np.array(map(float, self.tokens[1:9]), dtype=np.float32).reshape(4, 2)
+		return cv2.getPerspectiveTransform(pts1, pts1 + offsets), shape[:2]
+
+
+class ResizeTransform(GeometricTransform):
+
+	def get_matrix(self, shape):
+		height, width = int(self.tokens[1]), int(self.tokens[2])
+		sy, sx = float(height) / shape[0], float(width) / shape[1]
+		# cv2.resize aligns pixel centers
+		M = np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]])
+		return M, (height, width)
+
+
+# Consecutive geometric transforms composed into a single warp, so the image
+# is only interpolated once
+class FusedTransform(GeometricTransform):
+
+	def __init__(self, transforms):
+		self.transforms = transforms
+		self.key = transforms[-1].key
+
+	def get_matrix(self, shape):
+		M = np.eye(3)
+		for transform in self.transforms:
+			_M, shape = transform.get_matrix(shape)
+			M = np.dot(_M, M)
+		return M, shape
+
+	def __call__(self, im):
+		M, (height, width) = self.get_matrix(im.shape)
+		if np.allclose(M[2], [0, 0, 1]):
+			return cv2.warpAffine(im, M[:2], (width, height), flags=cv2.INTER_LINEAR)
+		return cv2.warpPerspective(im, M, (width, height))
+
+
+TRANSFORM_CLASSES = {
+	'randcrop': RandomTransform,
+	'mirror': MirrorTransform,
+	'rotation': RotationTransform,
+	'shear': ShearTransform,
+	'perspective': PerspectiveTransform,
+	'resize': ResizeTransform,
+}
+
+
+def parse_transform(transform_str, key):
+	tokens = transform_str.split()
+	if tokens[0] not in TRANSFORM_FNS:
+		raise Exception("Unknown transform: %r" % transform_str)
+	return TRANSFORM_CLASSES.get(tokens[0], Transform)(tokens, key)
+
+
+# parses "t1;t2;..." into a list of transforms, fusing runs of geometric transforms
+def parse_pipeline(multi_transform_str):
+	pipeline = list()
+	run = list()
+	key = tuple()
+	for ts in multi_transform_str.split(';'):
+		if ts.split()[0] == 'none':
+			continue
+		key = key + (' '.join(ts.split()),)
+		transform = parse_transform(ts, key)
+		if transform.geometric:
+			run.append(transform)
+			continue
+		if run:
+			pipeline.append(run[0] if len(run) == 1 else FusedTransform(run))
+			run = list()
+		pipeline.append(transform)
+	if run:
+		pipeline.append(run[0] if len(run) == 1 else FusedTransform(run))
+	return pipeline
+
+
+# A list of transform strings parsed once.  Applying it to an image gives the
+# images of apply_transforms() on each string, but intermediate results shared
+# by several strings (e.g. the "resize 256 256" of "resize 256 256;crop ...")
+# are only computed once per image, and a trailing mirror or crop is a view.
+# Runs of geometric transforms (mirror, rotation, shear, perspective, resize)
+# are fused into one warp that interpolates once, so their outputs differ in
+# some pixels from apply_transforms(), which interpolates after every step.
+# Evaluations with a plan are therefore close to, not bit-identical with, ones
+# without it
+class TransformPlan(object):
+
+	def __init__(self, transform_strs):
+		self.transform_strs = list(transform_strs)
+		self.pipelines = map(parse_pipeline, self.transform_strs)
+		# the fields of all seeded transforms are reused for every image
+		seeded = set()
+		for ts in self.transform_strs:
+			for t in ts.split(';'):
+				if t.split()[0] in SEEDED_TRANSFORMS:
+					seeded.add(' '.join(t.split()))
+		_field_cache.reserve(len(seeded))
+
+	def __call__(self, im):
+		# intermediate results of this image, by key
+		cache = dict()
+		ims = list()
+		for pipeline in self.pipelines:
+			im_out = self.apply_pipeline(im, pipeline, cache)
+			if type(im_out) is list:
+				ims.extend(im_out)
+			else:
+				ims.append(im_out)
+		return ims
+
+	def apply_pipeline(self, im, pipeline, cache):
+		for idx, transform in enumerate(pipeline):
+			if transform.key in cache:
+				im = cache[transform.key]
+			elif isinstance(transform, MirrorTransform) and idx == len(pipeline) - 1:
+				# views are not cached, as later transforms may need contiguous input
+				im = transform.view(im)
+			else:
+				im = transform(im)
+				if transform.deterministic:
+					cache[transform.key] = im
+		return im
+
+
+_transform_plans = dict()
+def get_transform_plan(transform_strs):
+	key = tuple(transform_strs)
+	if key not in _transform_plans:
+		_transform_plans[key] = TransformPlan(transform_strs)
+	return _transform_plans[key]
+
+
+# transform_strs is a list of transform strings or a TransformPlan
+def apply_all_transforms(im, transform_strs):
+	if not isinstance(transform_strs, TransformPlan):
+		transform_strs = get_transform_plan(transform_strs)
+	return transform_strs(im)
 
 
 def get_transforms(transform_file):